@@ -76,10 +76,13 @@ setup(name='superlance',
       entry_points = """\
       [console_scripts]
       httpok = superlance.httpok:main
+      iomon = superlance.iomon:main
       crashsms = superlance.crashsms:main
+      cpumon = superlance.cpumon:main
       crashmail = superlance.crashmail:main
       crashmailbatch = superlance.crashmailbatch:main
       fatalmailbatch = superlance.fatalmailbatch:main
+      fdmon = superlance.fdmon:main
       memmon = superlance.memmon:main
       oome_monitor = superlance.oome_monitor:main
       """
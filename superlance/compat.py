@@ -24,3 +24,8 @@ try:
     import xmlrpc.client as xmlrpclib
 except ImportError:
     import xmlrpclib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
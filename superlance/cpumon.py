@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# A event listener meant to be subscribed to TICK_60 (or TICK_5)
+# events, which restarts any processes that are children of
+# supervisord that keep using "too much" CPU, e.g. workers stuck in a
+# busy loop.  CPU time is read from /proc/<pid>/stat, so it only works
+# on Linux.
+
+# A supervisor config snippet that tells supervisor to use this script
+# as a listener is below.
+#
+# [eventlistener:cpumon]
+# command=python cpumon.py [options]
+# events=TICK_60
+
+doc = """\
+cpumon.py [-c] [-p processname=limit] [-g groupname=limit]
+          [-a limit] [-s sendmail] [-m email_address]
+          [-u uptime] [-n cpumon_name]
+
+Options:
+
+-c -- Check against cumulative CPU usage.  Also count the CPU time of
+      the process' children, including the children which exited since
+      the last tick.
+
+-p -- specify a process_name=limit pair.  The limit is a percentage of
+      one CPU (e.g. 90, or 250 for two and a half CPUs), optionally
+      followed by rules (see below).  Restart the supervisor process
+      named 'process_name' when it uses more CPU than that in between
+      two ticks.  If this process is in a group, it can be specified
+      using the 'group_name:process_name' syntax.  The name may be a glob
+      pattern (e.g. 'worker_*') or, prefixed with 're:', a regular
+      expression (e.g. 're:worker_[0-9]+').
+
+-g -- specify a group_name=limit pair.  Restart any process in this group
+      when it uses more CPU than the limit.  The group name may be a
+      pattern like for -p.
+
+-a -- specify a global limit.  Restart any child of the supervisord
+      under which this runs if it uses more CPU than the limit.
+
+-s -- the sendmail command to use to send email
+      (e.g. "/usr/sbin/sendmail -t -i").  Must be a command which accepts
+      header and message data on stdin and sends mail.
+      Default is "/usr/sbin/sendmail -t -i".
+
+-m -- specify an email address.  The script will send mail to this
+      address when any process is restarted.  If no email address is
+      specified, email will not be sent.
+
+-u -- optionally specify the minimum uptime in seconds for the process.
+      if the process uptime is longer than this value, no email is sent
+      (useful to only be notified if processes are restarted too often/early)
+
+      seconds can be specified as plain integer values or a suffix-multiplied integer
+      (e.g. 1m). Valid suffixes are m (minute), h (hour) and d (day).
+
+-n -- optionally specify the name of the cpumon process. This name will
+      be used in the email subject to identify which cpumon process
+      restarted the process.
+
+The -p and -g options may be specified more than once, allowing for
+specification of multiple groups and processes.  A process is checked
+against the most specific limit that matches it: -p before -g before -a,
+and exact names before patterns.
+
+CPU usage is measured over the time between two ticks, so a process is
+first checked on the second tick after it started.  A busy process may
+well use all of a CPU for a tick or two, so a limit is best followed by
+comma-separated rules:
+
+  sustain=N/M -- only restart the process when it was over the limit
+                 in N of its last M samples (M is at most 64).
+
+  rearm=limit -- once the process went over the limit, keep counting
+                 its samples as over until it drops to this limit.
+
+For example, -g workers=90,sustain=4/5,rearm=50.
+
+A sample invocation:
+
+cpumon.py -p program1=95 -g thegroup=90,sustain=3/3 -a 180 -m chrism@plope.com -n "Project 1"
+"""
+
+import os
+import sys
+import time
+from superlance.compat import maxint
+from superlance.procfs import cpu_times
+from superlance.procfs import default_procfs
+from superlance.rules import Limit
+from superlance.rules import parse_namelimit
+from superlance.rules import parse_seconds
+from superlance.rules import parse_sustain
+from superlance.rules import ProcessTree
+from superlance.rules import RuleListener
+from superlance.rules import RuleTable
+
+from supervisor import childutils
+
+def usage():
+    print(doc)
+    sys.exit(255)
+
+class CpuSample(object):
+    """The CPU time a process had used at the time of the last tick."""
+    __slots__ = ('pid', 'start', 'time', 'cpu')
+
+    def __init__(self, pid, start, time, cpu):
+        self.pid = pid
+        self.start = start
+        self.time = time
+        self.cpu = cpu
+
+class Cpumon(RuleListener):
+    listener = 'cpumon'
+    because = 'it was using too much CPU'
+
+    def __init__(self, cumulative, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None, procfs=None):
+        self.cumulative = cumulative
+        self.programs = programs
+        self.groups = groups
+        self.any = any
+        self.sendmail = sendmail
+        self.email = email
+        self.email_uptime_limit = email_uptime_limit
+        self.cpumonName = name
+        self.rpc = rpc
+        self.procfs = procfs
+        self.rules = None
+        self.samples = {}
+        self.breaches = {}
+        self.stats = None
+        self.tree = None
+        self.stdin = sys.stdin
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        self.mailed = False # for unit tests
+
+    def tick(self):
+        """Measure the CPU usage of the monitored processes since the last
+        tick and restart the ones over their limit."""
+        now = time.time()
+        self.stats = None
+        self.tree = None
+        seen = set()
+        infos = self.rpc.supervisor.getAllProcessInfo()
+        if self.rules is None:
+            self.rules = RuleTable(self.programs, self.groups, self.any)
+        self.rules.refresh([(x['group'], x['name']) for x in infos])
+
+        for info in infos:
+            pid = info['pid']
+            name = info['name']
+            group = info['group']
+            pname = '%s:%s' % (group, name)
+
+            if not pid:
+                continue
+
+            limit = self.rules.lookup(name, group, pname)
+            if limit is None:
+                continue
+
+            times = self.cpu_time(pid)
+            if times is None:
+                # no such pid (deal with race conditions)
+                continue
+
+            seen.add(pname)
+            cpu = self.usage(pname, pid, now, times)
+            if cpu is None:
+                # first sample of this process
+                continue
+            self.stderr.write('CPU of %s is %.1f%%\n' % (pname, cpu))
+            if self.breached(pname, pid, cpu, limit):
+                self.restart(pname, '%.1f%% of a CPU' % cpu, info)
+
+        # drop the state of processes that went away
+        self.forget(seen)
+
+    def states(self):
+        return self.samples, self.breaches
+
+    def stat(self, pid):
+        """Return the stat fields of a process.  With -c, the stat files of
+        all processes are read once per tick, for the process tree and the
+        CPU times of its children alike."""
+        if not self.cumulative:
+            return self.procfs.stat(pid)
+        if self.stats is None:
+            self.stats = {}
+            for p in self.procfs.pids():
+                fields = self.procfs.stat(p)
+                if fields is not None:
+                    self.stats[p] = fields
+        return self.stats.get(pid)
+
+    def cpu_time(self, pid):
+        """Return the CPU seconds used by a process (and with -c, by its
+        children) so far, along with its start time."""
+        fields = self.stat(pid)
+        times = fields and cpu_times(fields)
+        if not times:
+            return None
+        own, reaped, start = times
+        if not self.cumulative:
+            return own, start
+        if self.tree is None:
+            self.tree = ProcessTree(dict(
+                [(p, int(f[1])) for p, f in self.stats.items()]))
+        # reaped children are accounted for in their parent's figures,
+        # so the total doesn't drop when a child exits
+        total = own + reaped
+        for child in self.tree.subtree(pid)[1:]:
+            times = cpu_times(self.stats[child])
+            if times:
+                total += times[0] + times[1]
+        return total, start
+
+    def usage(self, name, pid, now, times):
+        """Remember the CPU time of a process and return its CPU usage in
+        percent of one CPU since the previous tick, or None if there is no
+        previous sample of the same process."""
+        cpu, start = times
+        sample = self.samples.get(name)
+        self.samples[name] = CpuSample(pid, start, now, cpu)
+        if sample is None or sample.pid != pid or sample.start != start:
+            return None
+        elapsed = now - sample.time
+        if elapsed <= 0:
+            return None
+        # children leaving the process tree can make the total go down
+        return max(cpu - sample.cpu, 0) * 100 / elapsed
+
+def parse_limit(option, value):
+    """Parse a CPU percentage optionally followed by comma-separated
+    sustain=N/M and rearm=percentage rules."""
+    parts = value.split(',')
+    limit = parse_percentage(option, parts[0])
+    rules = {}
+    for part in parts[1:]:
+        key, _, rule = part.partition('=')
+        if key == 'sustain':
+            rules['sustain'], rules['window'] = parse_sustain(
+                option, value, usage, rule)
+        elif key == 'rearm':
+            rules['rearm'] = parse_percentage(option, rule)
+            if rules['rearm'] > limit:
+                print('The rearm limit in %r for %r must not exceed the '
+                      'limit' % (value, option))
+                usage()
+        else:
+            print('Unknown rule %r in %r for %r' % (part, value, option))
+            usage()
+    if not rules:
+        return limit
+    return Limit(limit, **rules)
+
+def parse_percentage(option, value):
+    try:
+        percentage = int(value.rstrip('%'))
+    except ValueError:
+        percentage = None
+    if percentage is None or percentage < 0:
+        print('Unparseable percentage in %r for %r' % (value, option))
+        usage()
+    return percentage
+
+def cpumon_from_args(arguments):
+    import getopt
+    short_args = "hcp:g:a:s:m:n:u:"
+    long_args = [
+        "help",
+        "cumulative",
+        "program=",
+        "group=",
+        "any=",
+        "sendmail_program=",
+        "email=",
+        "uptime=",
+        "name=",
+        ]
+
+    if not arguments:
+        return None
+    try:
+        opts, args = getopt.getopt(arguments, short_args, long_args)
+    except:
+        return None
+
+    cumulative = False
+    programs = {}
+    groups = {}
+    any = None
+    sendmail = '/usr/sbin/sendmail -t -i'
+    email = None
+    uptime_limit = maxint
+    name = None
+
+    for option, value in opts:
+
+        if option in ('-h', '--help'):
+            return None
+
+        if option in ('-c', '--cumulative'):
+            cumulative = True
+
+        if option in ('-p', '--program'):
+            pattern, limit = parse_namelimit(option, value, usage,
+                                             parse_limit)
+            programs[pattern] = limit
+
+        if option in ('-g', '--group'):
+            pattern, limit = parse_namelimit(option, value, usage,
+                                             parse_limit)
+            groups[pattern] = limit
+
+        if option in ('-a', '--any'):
+            any = parse_limit(option, value)
+
+        if option in ('-s', '--sendmail_program'):
+            sendmail = value
+
+        if option in ('-m', '--email'):
+            email = value
+
+        if option in ('-u', '--uptime'):
+            uptime_limit = parse_seconds(option, value, usage)
+
+        if option in ('-n', '--name'):
+            name = value
+
+    procfs = default_procfs()
+    if procfs is None:
+        print('cpumon needs /proc')
+        usage()
+
+    cpumon = Cpumon(cumulative=cumulative,
+                    programs=programs,
+                    groups=groups,
+                    any=any,
+                    sendmail=sendmail,
+                    email=email,
+                    email_uptime_limit=uptime_limit,
+                    name=name,
+                    procfs=procfs)
+    return cpumon
+
+def main():
+    cpumon = cpumon_from_args(sys.argv[1:])
+    if cpumon is None:
+        # something went wrong or -h has been given
+        usage()
+    cpumon.rpc = childutils.getRPCInterface(os.environ)
+    cpumon.runforever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# A event listener meant to be subscribed to TICK_60 (or TICK_5)
+# events, which restarts any processes that are children of
+# supervisord that leak file descriptors (e.g. connections) or threads,
+# before they run out of them and start failing requests.  The counts
+# are read from /proc, so it only works on Linux.
+
+# A supervisor config snippet that tells supervisor to use this script
+# as a listener is below.
+#
+# [eventlistener:fdmon]
+# command=python fdmon.py [options]
+# events=TICK_60
+
+doc = """\
+fdmon.py [-p processname=limit] [-g groupname=limit] [-a limit]
+         [-s sendmail] [-m email_address] [-u uptime] [-n fdmon_name]
+         [--trend=seconds [--trend-window=samples]]
+
+Options:
+
+-p -- specify a process_name=limit pair.  The limit is the number of open
+      file descriptors, or a percentage (e.g. 80%) of the process' own
+      limit on open files (RLIMIT_NOFILE), optionally followed by rules
+      (see below).  Restart the supervisor process named 'process_name'
+      when it has more file descriptors open.  If this process is in a
+      group, it can be specified using the 'group_name:process_name'
+      syntax.  The name may be a glob pattern (e.g. 'worker_*') or,
+      prefixed with 're:', a regular expression (e.g. 're:worker_[0-9]+').
+
+-g -- specify a group_name=limit pair.  Restart any process in this group
+      when it exceeds the limit.  The group name may be a pattern like
+      for -p.
+
+-a -- specify a global limit.  Restart any child of the supervisord
+      under which this runs if it exceeds the limit.
+
+-s -- the sendmail command to use to send email
+      (e.g. "/usr/sbin/sendmail -t -i").  Must be a command which accepts
+      header and message data on stdin and sends mail.
+      Default is "/usr/sbin/sendmail -t -i".
+
+-m -- specify an email address.  The script will send mail to this
+      address when any process is restarted.  If no email address is
+      specified, email will not be sent.
+
+-u -- optionally specify the minimum uptime in seconds for the process.
+      if the process uptime is longer than this value, no email is sent
+      (useful to only be notified if processes are restarted too often/early)
+
+      seconds can be specified as plain integer values or a suffix-multiplied integer
+      (e.g. 1m). Valid suffixes are m (minute), h (hour) and d (day).
+
+-n -- optionally specify the name of the fdmon process. This name will
+      be used in the email subject to identify which fdmon process
+      restarted the process.
+
+--trend -- predict leaks: restart a process whose file descriptors (or
+      threads) keep growing at a rate that would take it over its limit
+      within this many seconds (suffixes as for -u), before it gets there.
+
+--trend-window -- the number of samples (ticks) the growth rate is
+      fitted over.  Default is 10.
+
+The -p and -g options may be specified more than once, allowing for
+specification of multiple groups and processes.  A process is checked
+against the most specific limit that matches it: -p before -g before -a,
+and exact names before patterns.
+
+A limit may be followed (or, for threads only, replaced) by
+comma-separated rules:
+
+  threads=count -- also restart the process when it runs more than this
+                 many threads.
+
+  sustain=N/M -- only restart the process when it was over a limit in N
+                 of its last M samples (M is at most 64).
+
+For example, -g web=80%,threads=500 or -a threads=2000,sustain=2/3.
+
+A sample invocation:
+
+fdmon.py -p program1=4000 -g thegroup=80%,threads=500 --trend=1h -m chrism@plope.com -n "Project 1"
+"""
+
+import os
+import sys
+import time
+from superlance.compat import maxint
+from superlance.procfs import default_procfs
+from superlance.rules import parse_count
+from superlance.rules import parse_namelimit
+from superlance.rules import parse_percentage
+from superlance.rules import parse_seconds
+from superlance.rules import parse_sustain
+from superlance.rules import Percentage
+from superlance.rules import RuleListener
+from superlance.rules import RuleTable
+from superlance.rules import SampleRing
+
+from supervisor import childutils
+
+def usage():
+    print(doc)
+    sys.exit(255)
+
+class FdLimit:
+    """The file descriptor and thread limits of a process, along with the
+    sustain rule for acting on them.  The fd limit may be a Percentage of
+    the process' RLIMIT_NOFILE."""
+    def __init__(self, fds=None, threads=None, sustain=1, window=1):
+        self.fds = fds
+        self.threads = threads
+        self.sustain = sustain
+        self.window = window
+
+    def __str__(self):
+        spec = []
+        if self.fds is not None:
+            spec.append(str(self.fds))
+        if self.threads is not None:
+            spec.append('threads=%d' % self.threads)
+        if self.window > 1:
+            spec.append('sustain=%d/%d' % (self.sustain, self.window))
+        return ','.join(spec)
+
+class Fdmon(RuleListener):
+    listener = 'fdmon'
+    because = 'of its file descriptors or threads'
+
+    def __init__(self, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None, procfs=None, trend=None, trend_window=10):
+        self.programs = programs
+        self.groups = groups
+        self.any = any
+        self.sendmail = sendmail
+        self.email = email
+        self.email_uptime_limit = email_uptime_limit
+        self.fdmonName = name
+        self.rpc = rpc
+        self.procfs = procfs
+        self.trend = trend
+        self.trend_window = trend_window
+        self.rules = None
+        self.breaches = {}
+        self.history = {}
+        self.stdin = sys.stdin
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        self.mailed = False # for unit tests
+
+    def tick(self):
+        """Count the file descriptors and threads of the monitored
+        processes and restart the ones over (or heading for) their
+        limits."""
+        now = time.time()
+        seen = set()
+        infos = self.rpc.supervisor.getAllProcessInfo()
+        if self.rules is None:
+            self.rules = RuleTable(self.programs, self.groups, self.any)
+        self.rules.refresh([(x['group'], x['name']) for x in infos])
+
+        for info in infos:
+            pid = info['pid']
+            name = info['name']
+            group = info['group']
+            pname = '%s:%s' % (group, name)
+
+            if not pid:
+                continue
+
+            limit = self.rules.lookup(name, group, pname)
+            if limit is None:
+                continue
+
+            fds = self.procfs.fd_count(pid)
+            if fds is None:
+                # no such pid (deal with race conditions)
+                continue
+            status = self.procfs.status(pid) or {}
+            threads = status.get('Threads')
+            fd_limit = self.resolve(pid, limit.fds)
+
+            seen.add(pname)
+            if threads is None:
+                self.stderr.write('%s has %d fds\n' % (pname, fds))
+            else:
+                self.stderr.write('%s has %d fds and %d threads\n' % (
+                    pname, fds, threads))
+
+            reasons = []
+            for value, maximum, what in ((fds, fd_limit, 'fds'),
+                                         (threads, limit.threads, 'threads')):
+                if value is not None and maximum is not None and \
+                        value > maximum:
+                    reasons.append('%d %s, over %d' % (value, what, maximum))
+            if self.breached(pname, pid, None, limit, over=bool(reasons)):
+                self.restart(pname, '; '.join(reasons), info)
+                continue
+            if self.trend is None:
+                continue
+            reason = self.predict(pname, pid, now, fds, fd_limit, threads,
+                                  limit.threads)
+            if reason is not None:
+                self.stderr.write('%s is heading for its limits: %s\n' % (
+                    pname, reason))
+                self.restart(pname, reason, info)
+
+        # drop the state of processes that went away
+        self.forget(seen)
+
+    def states(self):
+        return self.breaches, self.history
+
+    def resolve(self, pid, fds):
+        """Return the fd limit of a process in descriptors, resolving a
+        percentage against the process' own limit on open files."""
+        if not isinstance(fds, Percentage):
+            return fds
+        limits = self.procfs.limits(pid) or {}
+        nofile = limits.get('Max open files')
+        if nofile is None:
+            # unlimited, or the process went away
+            return None
+        return fds.of(nofile)
+
+    def predict(self, name, pid, now, fds, fd_limit, threads, thread_limit):
+        """Add a sample to the history of a process and return why it is
+        due for a restart if its fds or threads grow fast enough to exceed
+        their limit within the trend horizon, otherwise None."""
+        rings = self.history.get(name)
+        if rings is None or rings[0].pid != pid:
+            rings = self.history[name] = (
+                SampleRing(self.trend_window, pid),
+                SampleRing(self.trend_window, pid))
+        reason = None
+        for ring, value, maximum, what in ((rings[0], fds, fd_limit, 'fds'),
+                                           (rings[1], threads, thread_limit,
+                                            'threads')):
+            if value is None:
+                continue
+            ring.append(now, value)
+            if maximum is None or len(ring) < self.trend_window:
+                continue
+            if value >= maximum:
+                # already there; it's up to the sustain rule whether the
+                # process is restarted
+                continue
+            slope = ring.slope()
+            if not slope or slope <= 0:
+                continue
+            eta = (maximum - value) / slope
+            if eta < self.trend and reason is None:
+                reason = '%s grow by %.2f/s and will exceed %d in %ds' % (
+                    what, slope, maximum, eta)
+        return reason
+
+def parse_limit(option, value):
+    """Parse an fd count or percentage followed by comma-separated
+    threads=count and sustain=N/M rules.  The fd count may be left out
+    when there is a threads rule."""
+    rules = {}
+    for i, part in enumerate(value.split(',')):
+        key, sep, rule = part.partition('=')
+        if i == 0 and not sep:
+            key, rule = 'fds', part
+        if key == 'fds':
+            if rule.endswith('%'):
+                rules['fds'] = parse_percentage(option, rule, usage)
+            else:
+                rules['fds'] = parse_count(option, rule, usage)
+        elif key == 'threads':
+            rules['threads'] = parse_count(option, rule, usage)
+        elif key == 'sustain':
+            rules['sustain'], rules['window'] = parse_sustain(
+                option, value, usage, rule)
+        else:
+            print('Unknown rule %r in %r for %r' % (part, value, option))
+            usage()
+    if rules.get('fds') is None and rules.get('threads') is None:
+        print('No fd or threads limit in %r for %r' % (value, option))
+        usage()
+    return FdLimit(**rules)
+
+def fdmon_from_args(arguments):
+    import getopt
+    short_args = "hp:g:a:s:m:n:u:"
+    long_args = [
+        "help",
+        "program=",
+        "group=",
+        "any=",
+        "sendmail_program=",
+        "email=",
+        "uptime=",
+        "name=",
+        "trend=",
+        "trend-window=",
+        ]
+
+    if not arguments:
+        return None
+    try:
+        opts, args = getopt.getopt(arguments, short_args, long_args)
+    except:
+        return None
+
+    programs = {}
+    groups = {}
+    any = None
+    sendmail = '/usr/sbin/sendmail -t -i'
+    email = None
+    uptime_limit = maxint
+    name = None
+    trend = None
+    trend_window = 10
+
+    for option, value in opts:
+
+        if option in ('-h', '--help'):
+            return None
+
+        if option in ('-p', '--program'):
+            pattern, limit = parse_namelimit(option, value, usage,
+                                             parse_limit)
+            programs[pattern] = limit
+
+        if option in ('-g', '--group'):
+            pattern, limit = parse_namelimit(option, value, usage,
+                                             parse_limit)
+            groups[pattern] = limit
+
+        if option in ('-a', '--any'):
+            any = parse_limit(option, value)
+
+        if option in ('-s', '--sendmail_program'):
+            sendmail = value
+
+        if option in ('-m', '--email'):
+            email = value
+
+        if option in ('-u', '--uptime'):
+            uptime_limit = parse_seconds(option, value, usage)
+
+        if option in ('-n', '--name'):
+            name = value
+
+        if option == '--trend':
+            trend = parse_seconds(option, value, usage)
+
+        if option == '--trend-window':
+            trend_window = parse_count(option, value, usage, minimum=2)
+
+    procfs = default_procfs()
+    if procfs is None:
+        print('fdmon needs /proc')
+        usage()
+
+    fdmon = Fdmon(programs=programs,
+                  groups=groups,
+                  any=any,
+                  sendmail=sendmail,
+                  email=email,
+                  email_uptime_limit=uptime_limit,
+                  name=name,
+                  procfs=procfs,
+                  trend=trend,
+                  trend_window=trend_window)
+    return fdmon
+
+def main():
+    fdmon = fdmon_from_args(sys.argv[1:])
+    if fdmon is None:
+        # something went wrong or -h has been given
+        usage()
+    fdmon.rpc = childutils.getRPCInterface(os.environ)
+    fdmon.runforever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Module wraps the Linux inotify API through ctypes, so listeners can react
+# to files appearing as soon as they do instead of polling for them on
+# TICK events, without depending on a third party package.
+#
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def libc():
+    """
+    Returns the C library with the inotify functions.
+
+    :raises OSError: if inotify isn't available on this platform
+    """
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        lib = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                          use_errno=True)
+        if not hasattr(lib, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'the C library has no inotify')
+        _libc = lib
+    return _libc
+
+class Event(object):
+    """
+    A file system event of a watched directory.
+    """
+    def __init__(self, wd, mask, cookie, name):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+    def __repr__(self):
+        return '<Event wd=%d mask=%#x name=%r>' % (self.wd, self.mask,
+                                                   self.name)
+
+class Inotify(object):
+    """
+    An inotify instance.  Its file descriptor becomes readable when one of
+    the watched paths changes, so it can be passed to select() along with
+    other file descriptors.
+    """
+    def __init__(self):
+        """
+        :raises OSError: if inotify isn't available or the per-user limit
+            of inotify instances is reached
+        """
+        self.libc = libc()
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise self.error()
+        self.fd = fd
+
+    def error(self, path=None):
+        code = ctypes.get_errno()
+        return OSError(code, os.strerror(code), path)
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Watches a path.  Watching the same path again replaces its mask.
+
+        :param path: file or directory name
+        :type path: str
+        :param mask: IN_* events to report
+        :type mask: int
+        :returns: the watch descriptor reported with the events of the path
+        :rtype: int
+        :raises OSError: if the path doesn't exist or the per-user limit of
+            watches is reached
+        """
+        name = path
+        if not isinstance(name, bytes):
+            name = name.encode(sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.fd, ctypes.c_char_p(name), mask)
+        if wd < 0:
+            raise self.error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Stops watching a path.  Removing a watch the kernel already dropped,
+        e.g. for a deleted directory, is not an error.
+
+        :param wd: watch descriptor returned by add_watch()
+        :type wd: int
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Returns the pending events without blocking.
+
+        :returns: list of Event
+        :rtype: list
+        """
+        events = []
+        while 1:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            if not data:
+                return events
+            events.extend(parse_events(data))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def parse_events(data):
+    """
+    Parses the struct inotify_event records read from an inotify instance.
+
+    :returns: list of Event with names decoded to str
+    :rtype: list
+    """
+    events = []
+    offset = 0
+    while offset + EVENT.size <= len(data):
+        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        if not isinstance(name, str):
+            name = name.decode(sys.getfilesystemencoding())
+        events.append(Event(wd, mask, cookie, name))
+    return events
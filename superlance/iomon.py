@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# A event listener meant to be subscribed to TICK_60 (or TICK_5)
+# events, which reports, signals or restarts any processes that are
+# children of supervisord that read or write "too much" from or to disk,
+# e.g. a runaway logger slowing down every other program on the host.
+# The I/O counters are read from /proc/<pid>/io, so it only works on
+# Linux.
+
+# A supervisor config snippet that tells supervisor to use this script
+# as a listener is below.
+#
+# [eventlistener:iomon]
+# command=python iomon.py [options]
+# events=TICK_60
+
+doc = """\
+iomon.py [-p processname=limit] [-g groupname=limit] [-a limit]
+         [-s sendmail] [-m email_address] [-u uptime] [-n iomon_name]
+         [--rate-window=ticks] [--action=restart|signal|report]
+         [--signal=signal]
+
+Options:
+
+-p -- specify a process_name=limit pair.  The limit is a byte_size per
+      second the process may read and write from and to disk (together),
+      optionally followed by rules (see below).  Act on the supervisor
+      process named 'process_name' when it does more I/O.  If this process
+      is in a group, it can be specified using the
+      'group_name:process_name' syntax.  The name may be a glob pattern
+      (e.g. 'worker_*') or, prefixed with 're:', a regular expression
+      (e.g. 're:worker_[0-9]+').
+
+-g -- specify a group_name=limit pair.  Act on any process in this group
+      when it exceeds the limit.  The group name may be a pattern like
+      for -p.
+
+-a -- specify a global limit.  Act on any child of the supervisord under
+      which this runs if it exceeds the limit.
+
+-s -- the sendmail command to use to send email
+      (e.g. "/usr/sbin/sendmail -t -i").  Must be a command which accepts
+      header and message data on stdin and sends mail.
+      Default is "/usr/sbin/sendmail -t -i".
+
+-m -- specify an email address.  The script will send mail to this
+      address when it acts on any process.  If no email address is
+      specified, email will not be sent.
+
+-u -- optionally specify the minimum uptime in seconds for the process.
+      if the process uptime is longer than this value, no email is sent
+      (useful to only be notified if processes are restarted too often/early)
+
+      seconds can be specified as plain integer values or a suffix-multiplied integer
+      (e.g. 1m). Valid suffixes are m (minute), h (hour) and d (day).
+
+-n -- optionally specify the name of the iomon process. This name will
+      be used in the email subject to identify which iomon process
+      acted on the process.
+
+--rate-window -- the number of ticks the I/O rates are computed over.
+      Default is 1, i.e. the rates since the previous tick.
+
+--action -- what to do with a process over its limit: 'restart' it (the
+      default), send it the --signal ('signal'), or only log it and send
+      mail ('report').  A process is signalled or reported once each time
+      it goes over its limit.
+
+--signal -- the signal sent by --action=signal, e.g. USR1 or STOP.
+      Default is USR1.
+
+The -p and -g options may be specified more than once, allowing for
+specification of multiple groups and processes.  A process is checked
+against the most specific limit that matches it: -p before -g before -a,
+and exact names before patterns.
+
+A limit may be followed (or replaced) by comma-separated rules:
+
+  read=byte_size -- also act when the process reads more than this per
+                 second.
+
+  write=byte_size -- also act when the process writes more than this
+                 per second.
+
+  sustain=N/M -- only act when the process was over a limit in N of its
+                 last M samples (M is at most 64).
+
+For example, -g loggers=write=20MB,sustain=3/5.
+
+Any byte_size can be specified as a plain integer (10000) or a
+suffix-multiplied integer (e.g. 1GB).  Valid suffixes are 'KB', 'MB'
+and 'GB'.
+
+A sample invocation:
+
+iomon.py -p program1=50MB -g thegroup=write=20MB -a 200MB -m chrism@plope.com -n "Project 1"
+"""
+
+import os
+import sys
+import time
+from collections import deque
+from superlance.compat import maxint
+from superlance.compat import xmlrpclib
+from superlance.procfs import default_procfs
+from superlance.rules import parse_byte_size
+from superlance.rules import parse_count
+from superlance.rules import parse_namelimit
+from superlance.rules import parse_seconds
+from superlance.rules import parse_sustain
+from superlance.rules import RuleListener
+from superlance.rules import RuleTable
+
+from supervisor import childutils
+from supervisor.datatypes import signal_number
+
+ACTIONS = ('restart', 'signal', 'report')
+
+def usage():
+    print(doc)
+    sys.exit(255)
+
+class IoLimit:
+    """The I/O rate limits of a process in bytes per second: for reads and
+    writes together, and for each of them, along with the sustain rule
+    for acting on them."""
+    def __init__(self, total=None, read=None, write=None, sustain=1,
+                 window=1):
+        self.total = total
+        self.read = read
+        self.write = write
+        self.sustain = sustain
+        self.window = window
+
+    def __str__(self):
+        spec = []
+        if self.total is not None:
+            spec.append(str(self.total))
+        if self.read is not None:
+            spec.append('read=%d' % self.read)
+        if self.write is not None:
+            spec.append('write=%d' % self.write)
+        if self.window > 1:
+            spec.append('sustain=%d/%d' % (self.sustain, self.window))
+        return ','.join(spec)
+
+class IoHistory(object):
+    """The (time, read_bytes, write_bytes) samples of a process over the
+    rate window."""
+    __slots__ = ('pid', 'samples')
+
+    def __init__(self, pid, window):
+        self.pid = pid
+        self.samples = deque(maxlen=window + 1)
+
+class Iomon(RuleListener):
+    listener = 'iomon'
+    because = 'it was doing too much I/O'
+
+    def __init__(self, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None, procfs=None, rate_window=1, action='restart', signal='USR1'):
+        self.programs = programs
+        self.groups = groups
+        self.any = any
+        self.sendmail = sendmail
+        self.email = email
+        self.email_uptime_limit = email_uptime_limit
+        self.iomonName = name
+        self.rpc = rpc
+        self.procfs = procfs
+        self.rate_window = rate_window
+        self.action = action
+        self.signal = signal
+        self.rules = None
+        self.history = {}
+        self.breaches = {}
+        self.acted = {}
+        self.stdin = sys.stdin
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        self.mailed = False # for unit tests
+
+    def tick(self):
+        """Work out the I/O rates of the monitored processes and act on
+        the ones over their limits."""
+        now = time.time()
+        seen = set()
+        infos = self.rpc.supervisor.getAllProcessInfo()
+        if self.rules is None:
+            self.rules = RuleTable(self.programs, self.groups, self.any)
+        self.rules.refresh([(x['group'], x['name']) for x in infos])
+
+        for info in infos:
+            pid = info['pid']
+            name = info['name']
+            group = info['group']
+            pname = '%s:%s' % (group, name)
+
+            if not pid:
+                continue
+
+            limit = self.rules.lookup(name, group, pname)
+            if limit is None:
+                continue
+
+            counters = self.procfs.io(pid)
+            if not counters or 'read_bytes' not in counters:
+                # no such pid (deal with race conditions) or no permission
+                continue
+
+            seen.add(pname)
+            rates = self.rates(pname, pid, now, counters['read_bytes'],
+                               counters['write_bytes'])
+            if rates is None:
+                # first sample of this process
+                continue
+            read, write = rates
+            self.stderr.write('%s reads %d and writes %d bytes/s\n' % (
+                pname, read, write))
+
+            reasons = []
+            for value, maximum, what in ((read + write, limit.total, 'I/O'),
+                                         (read, limit.read, 'reads'),
+                                         (write, limit.write, 'writes')):
+                if maximum is not None and value > maximum:
+                    reasons.append('%s of %d bytes/s, over %d' % (
+                        what, value, maximum))
+            if not self.breached(pname, pid, None, limit,
+                                 over=bool(reasons)):
+                self.acted.pop(pname, None)
+                continue
+            reason = '; '.join(reasons) or 'recently over its limits'
+            if self.action == 'restart':
+                self.restart(pname, reason, info)
+            elif self.acted.get(pname) != pid:
+                # once per excursion over the limit
+                self.acted[pname] = pid
+                if self.action == 'signal':
+                    self.send_signal(pname, reason, info)
+                else:
+                    self.report(pname, reason, info)
+
+        # drop the state of processes that went away
+        self.forget(seen)
+
+    def states(self):
+        return self.history, self.breaches, self.acted
+
+    def rates(self, name, pid, now, read, write):
+        """Add a sample to the history of a process and return its read
+        and write rates in bytes per second over the rate window, or None
+        if there is no earlier sample of the same process."""
+        history = self.history.get(name)
+        if history is None or history.pid != pid:
+            history = self.history[name] = IoHistory(pid, self.rate_window)
+        history.samples.append((now, read, write))
+        if len(history.samples) < 2:
+            return None
+        then, first_read, first_write = history.samples[0]
+        elapsed = now - then
+        if elapsed <= 0:
+            return None
+        return ((read - first_read) / elapsed,
+                (write - first_write) / elapsed)
+
+    def report(self, name, reason, info):
+        msg = '%s is doing too much I/O (%s)' % (name, reason)
+        self.stderr.write('%s\n' % msg)
+        self.notify(name, 'process %s is doing too much I/O' % name, msg,
+                    info)
+
+    def send_signal(self, name, reason, info):
+        self.stderr.write('Sending SIG%s to %s (%s)\n' % (self.signal, name,
+                                                         reason))
+        try:
+            self.rpc.supervisor.signalProcess(name, self.signal)
+        except xmlrpclib.Fault as e:
+            self.stderr.write('Failed to signal process %s: %s\n' % (name, e))
+            return
+        msg = ('iomon.py sent SIG%s to the process named %s at %s because '
+               '%s (%s)' % (self.signal, name, time.asctime(), self.because,
+                            reason))
+        self.notify(name, 'process %s signalled' % name, msg, info)
+
+def parse_limit(option, value):
+    """Parse a byte_size per second followed by comma-separated
+    read=byte_size, write=byte_size and sustain=N/M rules.  The first
+    byte_size may be left out when there is a read or write rule."""
+    rules = {}
+    for i, part in enumerate(value.split(',')):
+        key, sep, rule = part.partition('=')
+        if i == 0 and not sep:
+            key, rule = 'total', part
+        if key in ('total', 'read', 'write'):
+            rules[key] = parse_byte_size(option, rule, usage)
+        elif key == 'sustain':
+            rules['sustain'], rules['window'] = parse_sustain(
+                option, value, usage, rule)
+        else:
+            print('Unknown rule %r in %r for %r' % (part, value, option))
+            usage()
+    if not [k for k in ('total', 'read', 'write') if k in rules]:
+        print('No byte_size in %r for %r' % (value, option))
+        usage()
+    return IoLimit(**rules)
+
+def iomon_from_args(arguments):
+    import getopt
+    short_args = "hp:g:a:s:m:n:u:"
+    long_args = [
+        "help",
+        "program=",
+        "group=",
+        "any=",
+        "sendmail_program=",
+        "email=",
+        "uptime=",
+        "name=",
+        "rate-window=",
+        "action=",
+        "signal=",
+        ]
+
+    if not arguments:
+        return None
+    try:
+        opts, args = getopt.getopt(arguments, short_args, long_args)
+    except:
+        return None
+
+    programs = {}
+    groups = {}
+    any = None
+    sendmail = '/usr/sbin/sendmail -t -i'
+    email = None
+    uptime_limit = maxint
+    name = None
+    rate_window = 1
+    action = 'restart'
+    signal = 'USR1'
+
+    for option, value in opts:
+
+        if option in ('-h', '--help'):
+            return None
+
+        if option in ('-p', '--program'):
+            pattern, limit = parse_namelimit(option, value, usage,
+                                             parse_limit)
+            programs[pattern] = limit
+
+        if option in ('-g', '--group'):
+            pattern, limit = parse_namelimit(option, value, usage,
+                                             parse_limit)
+            groups[pattern] = limit
+
+        if option in ('-a', '--any'):
+            any = parse_limit(option, value)
+
+        if option in ('-s', '--sendmail_program'):
+            sendmail = value
+
+        if option in ('-m', '--email'):
+            email = value
+
+        if option in ('-u', '--uptime'):
+            uptime_limit = parse_seconds(option, value, usage)
+
+        if option in ('-n', '--name'):
+            name = value
+
+        if option == '--rate-window':
+            rate_window = parse_count(option, value, usage)
+
+        if option == '--action':
+            if value not in ACTIONS:
+                print('Unknown action %r for %r, use one of %s' % (
+                    value, option, ', '.join(ACTIONS)))
+                usage()
+            action = value
+
+        if option == '--signal':
+            try:
+                signal_number(value)
+            except ValueError:
+                print('Unknown signal %r for %r' % (value, option))
+                usage()
+            signal = value.upper()
+            if signal.startswith('SIG'):
+                signal = signal[3:]
+
+    procfs = default_procfs()
+    if procfs is None:
+        print('iomon needs /proc')
+        usage()
+
+    iomon = Iomon(programs=programs,
+                  groups=groups,
+                  any=any,
+                  sendmail=sendmail,
+                  email=email,
+                  email_uptime_limit=uptime_limit,
+                  name=name,
+                  procfs=procfs,
+                  rate_window=rate_window,
+                  action=action,
+                  signal=signal)
+    return iomon
+
+def main():
+    iomon = iomon_from_args(sys.argv[1:])
+    if iomon is None:
+        # something went wrong or -h has been given
+        usage()
+    iomon.rpc = childutils.getRPCInterface(os.environ)
+    iomon.runforever()
+
+if __name__ == '__main__':
+    main()
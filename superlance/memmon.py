@@ -15,7 +15,8 @@
 
 # A event listener meant to be subscribed to TICK_60 (or TICK_5)
 # events, which restarts any processes that are children of
-# supervisord that consume "too much" memory.  Performs horrendous
+# supervisord that consume "too much" memory.  On Linux, memory figures
+# are read straight from /proc; elsewhere it falls back to horrendous
 # screenscrapes of ps output.  Works on Linux and OS X (Tiger/Leopard)
 # as far as I know.
 
@@ -27,9 +28,15 @@
 # events=TICK_60
 
 doc = """\
-memmon.py [-c] [-p processname=byte_size] [-g groupname=byte_size]
-          [-a byte_size] [-s sendmail] [-m email_address]
-          [-u uptime] [-n memmon_name]
+memmon.py [-c] [-p processname=limit] [-g groupname=limit]
+          [-a limit] [-s sendmail] [-m email_address]
+          [-u uptime] [-n memmon_name] [-M metric] [--ps]
+          [--leak=seconds [--leak-window=samples] [--leak-warn]]
+          [--pressure=levels [--pressure-victim=largest|fastest]]
+          [--interval=seconds]
+          [--group-restarts=count] [--group-spacing=seconds]
+          [--soft-signal=signal] [--soft-cooldown=seconds]
+          [--export=file [--export-format=csv|openmetrics]] [--summary]
 
 Options:
 
@@ -37,15 +44,20 @@ Options:
       consider its child processes. With this option `memmon` will sum up
       the RSS of the process to be monitored and all its children.
 
--p -- specify a process_name=byte_size pair.  Restart the supervisor
+-p -- specify a process_name=limit pair.  The limit is a byte_size,
+      optionally followed by rules (see below).  Restart the supervisor
       process named 'process_name' when it uses more than byte_size
       RSS.  If this process is in a group, it can be specified using
-      the 'process_name:group_name' syntax.
+      the 'group_name:process_name' syntax.  The name may be a glob
+      pattern (e.g. 'worker_*') or, prefixed with 're:', a regular
+      expression (e.g. 're:worker_[0-9]+'), matched against both
+      'process_name' and 'group_name:process_name'.
 
--g -- specify a group_name=byte_size pair.  Restart any process in this group
-      when it uses more than byte_size RSS.
+-g -- specify a group_name=limit pair.  Restart any process in this group
+      when it uses more than byte_size RSS.  The group name may be a
+      pattern like for -p.
 
--a -- specify a global byte_size.  Restart any child of the supervisord
+-a -- specify a global limit.  Restart any child of the supervisord
       under which this runs if it uses more than byte_size RSS.
 
 -s -- the sendmail command to use to send email
@@ -68,12 +80,122 @@ Options:
       be used in the email subject to identify which memmon process
       restarted the process.
 
+-M -- specify which memory figure the -p, -g and -a byte sizes are checked
+      against: 'rss' (resident set size, the default), 'pss' (proportional
+      set size, shared pages divided among the processes sharing them) or
+      'uss' (unique set size, pages private to the process).  'pss' and
+      'uss' are read from /proc/<pid>/smaps_rollup and need a Linux /proc.
+      Use them with -c for pre-forking servers, whose workers share most
+      of their memory with their master.
+
+      'swap' checks the swap used by the process (VmSwap from
+      /proc/<pid>/status), which is how a leaking process that got
+      swapped out shows up.  'rss+swap' checks its RSS and swap added up,
+      from the same read.  'pss+swap' and 'uss+swap' add the swap from
+      smaps_rollup to PSS or USS.
+
+      'cgroup' checks the memory.current of the cgroup (v2) the process
+      belongs to instead, which includes its helpers and page cache and is
+      what the kernel OOM killer goes by.  'cgroup-ws' subtracts the
+      inactive file cache (from memory.stat) from that, leaving the
+      working set.  Each cgroup is read once per tick, however many
+      processes share it.  These are only useful if each program runs in
+      a cgroup of its own.  With -c, the cgroups of the process' children
+      are added up as well.
+
+--ps -- always screenscrape ps output instead of reading /proc.  memmon
+      reads memory figures from /proc when it is available and only falls
+      back to ps on systems without it.
+
+--leak -- predict leaks: restart a process whose memory keeps growing
+      at a rate that would take it over its byte_size within this many
+      seconds (suffixes as for -u), before it actually gets there.  The
+      growth rate is fitted over the last --leak-window samples.
+
+--leak-window -- the number of samples (ticks) the growth rate is fitted
+      over.  Default is 10.  No prediction is made before a process has
+      been sampled this many times, so a brief spike after a restart
+      doesn't count as a leak.
+
+--leak-warn -- only log (and mail, if -m is given) predicted leaks
+      instead of restarting the process.  A process is warned about once,
+      until it is no longer predicted to leak or gets a new pid.
+
+--pressure -- restart a process when the whole host is under memory
+      pressure, even if no process exceeds its limit.  The levels are
+      comma-separated thresholds for the 'some' and/or 'full' pressure
+      stall percentages read from /proc/pressure/memory, optionally with
+      the average they apply to (avg=10, 60 or 300 seconds, default 10),
+      e.g. "some=20,full=5,avg=60".  The largest of the processes matched
+      by -p, -g or -a (or of all processes, if none of them is given) is
+      restarted, at most once per averaging period.
+
+--pressure-victim -- which process to restart under memory pressure:
+      'largest' (the default) or 'fastest' growing, as fitted over the
+      last --leak-window samples.
+
+--interval -- also sample the monitored processes every this many
+      seconds (e.g. 0.5) in between ticks, so a process which balloons in
+      between ticks isn't missed.  On the next tick, the processes are
+      checked against the highest of these samples.
+
+--group-restarts -- restart at most this many processes of a group per
+      tick.  The processes furthest over their limit are restarted first;
+      the others are restarted on later ticks if they are still over.
+
+--group-spacing -- wait at least this many seconds (suffixes as for -u)
+      between restarting two processes of the same group.
+
+--soft-signal -- the signal sent to a process going over the soft size
+      of its limit (see below), e.g. HUP or USR2.  Default is USR1.
+
+--soft-cooldown -- how many seconds (suffixes as for -u) a signalled
+      process gets to come back down before it is restarted.  Default is
+      0, i.e. it is restarted on the next tick if it is still over its
+      limit then.
+
+--export -- write every sample taken on a tick to this file.  In csv
+      format (the default) a row per process (time, name, pid, metric,
+      value, limit) is appended to it.  In openmetrics format the file is
+      replaced on every tick, through a rename so it is never seen half
+      written, e.g. for the node_exporter textfile collector.
+
+--export-format -- 'csv' or 'openmetrics'.
+
+--summary -- instead of a line per process, log a single line per tick
+      with the number of processes checked, their total and the largest
+      one.  Restarts are still logged.
+
 The -p and -g options may be specified more than once, allowing for
-specification of multiple groups and processes.
+specification of multiple groups and processes.  A process is checked
+against the most specific limit that matches it: -p before -g before -a,
+and exact names before patterns.
+
+A limit may be followed by comma-separated rules to avoid restarting a
+process because of a brief peak (e.g. during garbage collection):
+
+  sustain=N/M -- only restart the process when it was over byte_size
+                 in N of its last M samples (M is at most 64).
+
+  rearm=byte_size -- once the process went over the limit, keep counting
+                 its samples as over until it drops to this size.
+
+  soft=byte_size -- send the process the --soft-signal (through
+                 supervisord) when it goes over this size, and only
+                 restart it if it is still over the limit after the
+                 --soft-cooldown.  It is signalled again only after it
+                 has dropped to this size in between.
+
+For example, -g workers=1GB,sustain=3/5,rearm=900MB or
+-p cache=2GB,soft=1500MB.
 
 Any byte_size can be specified as a plain integer (10000) or a
 suffix-multiplied integer (e.g. 1GB).  Valid suffixes are 'KB', 'MB'
-and 'GB'.
+and 'GB'.  The byte_size of a limit (and its rearm size) can also be
+given as a percentage (e.g. 15%) of the memory available to the
+programs: the MemTotal of the host or, if it is lower, the memory limit
+of the cgroup (v2) memmon runs in.  It is checked on every tick, so the
+limits follow when the available memory changes.
 
 A sample invocation:
 
@@ -82,13 +204,70 @@ memmon.py -p program1=200MB -p theprog:thegroup=100MB -g thegroup=100MB -a 1GB -
 
 import os
 import sys
+import threading
 import time
-from collections import namedtuple
 from superlance.compat import maxint
 from superlance.compat import xmlrpclib
+from superlance.procfs import default_cgroupfs
+from superlance.procfs import default_procfs
+from superlance.rules import Limit
+from superlance.rules import parse_byte_size
+from superlance.rules import parse_count
+from superlance.rules import parse_namelimit
+from superlance.rules import parse_percentage
+from superlance.rules import parse_seconds
+from superlance.rules import parse_sustain
+from superlance.rules import Percentage
+from superlance.rules import ProcessTree
+from superlance.rules import RuleListener
+from superlance.rules import RuleTable
+from superlance.rules import SampleRing
+from superlance.rules import seconds_size
 
 from supervisor import childutils
-from supervisor.datatypes import byte_size, SuffixMultiplier
+from supervisor.datatypes import signal_number
+
+METRICS = ('rss', 'pss', 'uss', 'swap', 'rss+swap', 'pss+swap', 'uss+swap',
+           'cgroup', 'cgroup-ws')
+STATUS_METRICS = ('swap', 'rss+swap')
+CGROUP_METRICS = ('cgroup', 'cgroup-ws')
+
+CSV_HEADER = 'time,name,pid,metric,value,limit\n'
+
+def format_csv(measured, metric, now):
+    """Format the samples of a tick as CSV rows."""
+    rows = []
+    for pname, group, pid, value, limit in measured:
+        rows.append('%d,%s,%d,%s,%d,%s\n' % (
+            now, pname, pid, metric, value, '' if limit is None else
+            int(limit)))
+    return ''.join(rows)
+
+def format_openmetrics(measured, metric):
+    """Format the samples of a tick in the OpenMetrics text format."""
+    lines = [
+        '# TYPE memmon_memory_bytes gauge',
+        '# HELP memmon_memory_bytes Memory used by a supervisord process, '
+        'as checked by memmon.',
+        ]
+    limits = []
+    for pname, group, pid, value, limit in measured:
+        labels = 'name="%s",group="%s",metric="%s"' % (
+            escape_label(pname), escape_label(group), metric)
+        lines.append('memmon_memory_bytes{%s} %d' % (labels, value))
+        if limit is not None:
+            limits.append('memmon_limit_bytes{%s} %d' % (labels, limit))
+    if limits:
+        lines.append('# TYPE memmon_limit_bytes gauge')
+        lines.append('# HELP memmon_limit_bytes Memory limit a supervisord '
+                     'process is restarted at.')
+        lines.extend(limits)
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
 
 def usage():
     print(doc)
@@ -98,8 +277,100 @@ def shell(cmd):
     with os.popen(cmd) as f:
         return f.read()
 
-class Memmon:
-    def __init__(self, cumulative, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None):
+class RelativeLimit:
+    """A limit whose size (or rearm or soft size) is a Percentage.  It
+    resolves to a Limit, which is only recomputed when the memory total
+    changes."""
+    def __init__(self, size, sustain=1, window=1, rearm=None, soft=None):
+        self.size = size
+        self.sustain = sustain
+        self.window = window
+        self.rearm = rearm
+        self.soft = soft
+        self.total = None
+        self.limit = None
+
+    def __str__(self):
+        spec = [str(self.size)]
+        if self.window > 1:
+            spec.append('sustain=%d/%d' % (self.sustain, self.window))
+        if self.rearm is not None:
+            spec.append('rearm=%s' % self.rearm)
+        if self.soft is not None:
+            spec.append('soft=%s' % self.soft)
+        return ','.join(spec)
+
+    def resolve(self, total):
+        if total is None:
+            return None
+        if total != self.total:
+            size = rearm = self.size
+            if isinstance(size, Percentage):
+                size = size.of(total)
+            if self.rearm is not None:
+                rearm = self.rearm
+                if isinstance(rearm, Percentage):
+                    rearm = rearm.of(total)
+                rearm = min(rearm, size)
+            else:
+                rearm = size
+            soft = self.soft
+            if isinstance(soft, Percentage):
+                soft = soft.of(total)
+            if soft is not None:
+                soft = min(soft, size)
+            self.limit = Limit(size, self.sustain, self.window, rearm, soft)
+            self.total = total
+        return self.limit
+
+class SignalState(object):
+    """Per-process record of when it was sent the soft limit signal."""
+    __slots__ = ('pid', 'time')
+
+    def __init__(self, pid, time):
+        self.pid = pid
+        self.time = time
+
+class Peak(object):
+    """Aggregate of the samples taken of a process in between ticks."""
+    __slots__ = ('pid', 'max', 'total', 'count')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.max = 0
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        if value > self.max:
+            self.max = value
+        self.total += value
+        self.count += 1
+
+class Sampler(threading.Thread):
+    """Samples the processes memmon watches every `interval` seconds in
+    between ticks, leaving the event listener protocol to the main thread."""
+    def __init__(self, memmon, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.memmon = memmon
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            if not self.stopped.is_set():
+                self.memmon.sample_between_ticks()
+
+    def stop(self):
+        self.stopped.set()
+
+class Memmon(RuleListener):
+    listener = 'memmon'
+    because = 'it was consuming too much memory'
+
+    def __init__(self, cumulative, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None, procfs=None, metric='rss', leak=None, leak_window=10, leak_warn=False, cgroupfs=None, pressure=None, pressure_victim='largest', interval=None, group_restarts=None, group_spacing=0, soft_signal='USR1', soft_cooldown=0, export=None, export_format='csv', summary=False):
         self.cumulative = cumulative
         self.programs = programs
         self.groups = groups
@@ -109,162 +380,495 @@ class Memmon:
         self.email_uptime_limit = email_uptime_limit
         self.memmonName = name
         self.rpc = rpc
+        self.procfs = procfs
+        self.cgroupfs = cgroupfs
+        self.memory_total = None
+        self.pressure = pressure
+        self.pressure_victim = pressure_victim
+        self.pressure_restarted = None
+        self.interval = interval
+        self.sampler = None
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.peaks = {}
+        self.rules = None
+        self.group_restarts = group_restarts
+        self.group_spacing = group_spacing
+        self.group_restarted = {}
+        self.infos = {}
+        self.pending = []
+        self.soft_signal = soft_signal
+        self.soft_cooldown = soft_cooldown
+        self.signalled = {}
+        self.export = export
+        self.export_format = export_format
+        self.summary = summary
+        self.metric = metric
+        self.leak = leak
+        self.leak_window = leak_window
+        self.leak_warn = leak_warn
+        self.warned = {}
+        self.history = {}
+        self.breaches = {}
         self.stdin = sys.stdin
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self.pscommand = 'ps -orss= -p %s'
         self.pstreecommand = 'ps ax -o "pid= ppid= rss="'
+        self.tree = None
+        self.samples = {}
+        self.cgroups = {}
         self.mailed = False # for unit tests
 
     def runforever(self, test=False):
-        while 1:
-            # we explicitly use self.stdin, self.stdout, and self.stderr
-            # instead of sys.* so we can unit test this code
-            headers, payload = childutils.listener.wait(self.stdin, self.stdout)
-
-            if not headers['eventname'].startswith('TICK'):
-                # do nothing with non-TICK events
-                childutils.listener.ok(self.stdout)
-                if test:
-                    break
+        if self.interval and self.sampler is None:
+            self.sampler = Sampler(self, self.interval)
+            self.sampler.start()
+        RuleListener.runforever(self, test)
+
+    def status(self):
+        if self.summary:
+            return []
+        status = RuleListener.status(self)
+        if self.pressure:
+            status.append('Checking memory pressure %s' % ','.join(
+                ['%s=%s' % (k, self.pressure[k])
+                 for k in sorted(self.pressure)]))
+        return status
+
+    def tick(self):
+        """Measure the monitored processes and act on them."""
+        self.refresh_memory_total()
+        # keep the sampler thread out while we use the caches
+        self.lock.acquire()
+        try:
+            self.check_all()
+        finally:
+            self.lock.release()
+
+    def check_all(self):
+        """Measure the monitored processes and act on them, while holding
+        the lock."""
+        self.reset_caches()
+        now = time.time()
+        seen = set()
+        watched = {}
+        candidates = []
+        due = []
+        measured = []
+        everything = self.pressure and not (
+            self.programs or self.groups or self.any is not None)
+        infos = self.rpc.supervisor.getAllProcessInfo()
+        self.infos = {}
+        self.pending = []
+        if self.rules is None:
+            self.rules = RuleTable(self.programs, self.groups, self.any)
+        self.rules.refresh([(x['group'], x['name']) for x in infos])
+
+        for info in infos:
+            pid = info['pid']
+            name = info['name']
+            group = info['group']
+            pname = '%s:%s' % (group, name)
+            self.infos[pname] = info
+
+            if not pid:
+                # ps throws an error in this case (for processes
+                # in standby mode, non-auto-started).
                 continue
 
-            status = []
-            if self.programs:
-                keys = sorted(self.programs.keys())
-                status.append(
-                    'Checking programs %s' % ', '.join(
-                    [ '%s=%s' % (k, self.programs[k]) for k in keys ])
-                    )
-
-            if self.groups:
-                keys = sorted(self.groups.keys())
-                status.append(
-                    'Checking groups %s' % ', '.join(
-                    [ '%s=%s' % (k, self.groups[k]) for k in keys ])
-                    )
-            if self.any is not None:
-                status.append('Checking any=%s' % self.any)
-
-            self.stderr.write('\n'.join(status) + '\n')
-
-            infos = self.rpc.supervisor.getAllProcessInfo()
-
-            for info in infos:
-                pid = info['pid']
-                name = info['name']
-                group = info['group']
-                pname = '%s:%s' % (group, name)
+            limit = self.limit_for(name, group, pname)
+            if limit is None and not everything:
+                # not monitored, don't bother measuring it
+                continue
 
-                if not pid:
-                    # ps throws an error in this case (for processes
-                    # in standby mode, non-auto-started).
-                    continue
+            rss = self.calc_rss(pid)
+            if rss is None:
+                # no such pid (deal with race conditions) or
+                # rss couldn't be calculated for other reasons
+                continue
 
+            seen.add(pname)
+            self.record(pname, pid, now, rss)
+            watched[pname] = pid
+            peak = self.peaks.pop(pname, None)
+            if peak is not None and peak.pid == pid and peak.count:
+                peak.add(rss)
+                rss = peak.max
+                if not self.summary:
+                    self.stderr.write('%s of %s is %s (max of %d samples, '
+                                      'mean %d)\n' % (
+                        self.metric.upper(), pname, rss, peak.count,
+                        peak.total / peak.count))
+            elif not self.summary:
+                self.stderr.write('%s of %s is %s\n' % (
+                    self.metric.upper(), pname, rss))
+            measured.append((pname, group, pid, rss, limit))
+            restart = limit is not None and self.check(pname, pid, rss, limit)
+            if getattr(limit, 'soft', None) is not None:
+                restart = self.soften(pname, pid, rss, limit, restart, now)
+            if not restart:
+                candidates.append((pname, rss))
+            elif self.group_restarts is None and not self.group_spacing:
+                self.restart(pname, rss)
+            else:
+                due.append((float(rss) / max(limit, 1), pname, group, rss))
+
+        if self.summary:
+            self.summarize(measured)
+        if self.export:
+            self.write_export(measured, now)
+
+        if due:
+            self.schedule(due, now)
+
+        if self.pressure:
+            self.relieve_pressure(candidates, now)
+
+        self.restart_pending()
+
+        # drop the state of processes that went away
+        self.forget(seen)
+        self.watched = watched
+        self.peaks = {}
+
+    def summarize(self, measured):
+        """Write a single line about the processes checked on this tick,
+        instead of one line per process."""
+        if not measured:
+            self.stderr.write('Checked 0 processes\n')
+            return
+        largest = max(measured, key=lambda sample: sample[3])
+        total = sum([sample[3] for sample in measured])
+        self.stderr.write('Checked %d processes, %s total %d, largest %s '
+                          'is %d\n' % (len(measured), self.metric.upper(),
+                                       total, largest[0], largest[3]))
+
+    def write_export(self, measured, now):
+        """Export the samples of this tick: append them to a CSV file in a
+        single write, or replace an OpenMetrics textfile (as read by the
+        node_exporter textfile collector) by renaming a complete temporary
+        file over it, so a reader never sees a partial file."""
+        try:
+            if self.export_format == 'openmetrics':
+                temp = '%s.%d.tmp' % (self.export, os.getpid())
+                with open(temp, 'w') as f:
+                    f.write(format_openmetrics(measured, self.metric))
+                os.rename(temp, self.export)
+            else:
+                with open(self.export, 'a') as f:
+                    data = format_csv(measured, self.metric, now)
+                    if f.tell() == 0:
+                        data = CSV_HEADER + data
+                    f.write(data)
+        except (IOError, OSError) as e:
+            self.stderr.write('Failed to export samples to %s: %s\n' % (
+                self.export, e))
+
+    def sample_between_ticks(self):
+        """Sample the processes checked on the last tick, keeping only the
+        maximum and mean of the samples until the next tick."""
+        self.lock.acquire()
+        try:
+            self.reset_caches()
+            for pname, pid in self.watched.items():
                 rss = self.calc_rss(pid)
                 if rss is None:
-                    # no such pid (deal with race conditions) or
-                    # rss couldn't be calculated for other reasons
                     continue
-
-                for n in name, pname:
-                    if n in self.programs:
-                        self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                        if  rss > self.programs[name]:
-                            self.restart(pname, rss)
-                            continue
-
-                if group in self.groups:
-                    self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                    if rss > self.groups[group]:
-                        self.restart(pname, rss)
-                        continue
-
-                if self.any is not None:
-                    self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                    if rss > self.any:
-                        self.restart(pname, rss)
-                        continue
-
-            self.stderr.flush()
-            childutils.listener.ok(self.stdout)
-            if test:
-                break
+                peak = self.peaks.get(pname)
+                if peak is None or peak.pid != pid:
+                    peak = self.peaks[pname] = Peak(pid)
+                peak.add(rss)
+        finally:
+            self.lock.release()
+
+    def reset_caches(self):
+        """Forget the process snapshot and samples taken earlier."""
+        self.tree = None
+        self.samples = {}
+        self.cgroups = {}
+
+    def record(self, name, pid, now, rss):
+        """Add a sample to the history of a process when predicting leaks
+        or growth.  The history starts over when the process got a new pid."""
+        if self.leak is None and self.pressure_victim != 'fastest':
+            return
+        ring = self.history.get(name)
+        if ring is None or ring.pid != pid:
+            ring = self.history[name] = SampleRing(self.leak_window, pid)
+        ring.append(now, rss)
+
+    def relieve_pressure(self, candidates, now):
+        """Restart the largest or fastest growing candidate process if the
+        host is under memory pressure.  The pressure averages need time to
+        come down after a restart, so we wait for one averaging period
+        before restarting another process."""
+        window = self.pressure.get('avg', 10)
+        if (self.pressure_restarted is not None and
+                now - self.pressure_restarted < window):
+            return
+        pressure = self.procfs.pressure('memory')
+        if not pressure:
+            return
+        exceeded = []
+        for kind in 'some', 'full':
+            level = self.pressure.get(kind)
+            current = pressure.get(kind, {}).get('avg%d' % window)
+            if level is not None and current is not None and current > level:
+                exceeded.append('%s avg%d=%.2f' % (kind, window, current))
+        if not exceeded or not candidates:
+            return
+        if self.pressure_victim == 'fastest':
+            def growth(candidate):
+                ring = self.history.get(candidate[0])
+                return (ring and ring.slope() or 0, candidate[1])
+            victim, rss = max(candidates, key=growth)
+        else:
+            victim, rss = max(candidates, key=lambda candidate: candidate[1])
+        self.stderr.write('Memory pressure %s, restarting the %s process '
+                          '%s\n' % (', '.join(exceeded), self.pressure_victim,
+                                    victim))
+        self.pressure_restarted = now
+        self.restart(victim, rss)
+
+    def limit_for(self, name, group, pname):
+        """Return the limit of the most specific rule matching a process,
+        or None if it isn't monitored."""
+        return self.resolve(self.rules.lookup(name, group, pname))
+
+    def resolve(self, limit):
+        if isinstance(limit, RelativeLimit):
+            return limit.resolve(self.memory_total)
+        return limit
+
+    def refresh_memory_total(self):
+        """Measure the memory available to the programs of supervisord,
+        which relative limits are resolved against: the host's MemTotal or,
+        if it is lower, the memory limit of the cgroup we run in."""
+        limits = list(self.programs.values()) + list(self.groups.values())
+        limits.append(self.any)
+        if not [l for l in limits if isinstance(l, RelativeLimit)]:
+            return
+        total = None
+        meminfo = self.procfs and self.procfs.meminfo()
+        if meminfo:
+            total = meminfo.get('MemTotal')
+        path = self.cgroupfs and self.procfs.cgroup('self')
+        if path:
+            limit = self.cgroupfs.memory_limit(path)
+            if limit is not None and (total is None or limit < total):
+                total = limit
+        if total != self.memory_total:
+            self.stderr.write('Resolving relative limits against %s bytes '
+                              'of memory\n' % total)
+            self.memory_total = total
+
+    def check(self, name, pid, rss, limit):
+        """Return True if the process is due for a restart: it has been
+        over its limit for long enough or is predicted to get there within
+        the leak horizon."""
+        if self.breached(name, pid, rss, limit):
+            return True
+        if rss > limit:
+            # over the limit, but not for long enough yet
+            return False
+        if self.leak is None:
+            # the history is only kept to pick the fastest growing process
+            # under memory pressure, not to predict leaks
+            return False
+        ring = self.history.get(name)
+        if ring is None or len(ring) < self.leak_window:
+            return False
+        slope = ring.slope()
+        if not slope or slope <= 0:
+            self.warned.pop(name, None)
+            return False
+        eta = (limit - rss) / slope
+        if eta >= self.leak:
+            self.warned.pop(name, None)
+            return False
+        if self.leak_warn:
+            # once per leak, not on every tick it is still predicted
+            if self.warned.get(name) != pid:
+                self.warned[name] = pid
+                self.warn(name, rss, slope, eta)
+            return False
+        self.stderr.write('%s of %s grows by %d bytes/s and will exceed '
+                          '%d in %ds\n' % (self.metric.upper(), name,
+                                           slope, limit, eta))
+        return True
+
+    def soften(self, name, pid, rss, limit, due, now):
+        """Apply the soft tier of a limit and return True if the process
+        should still be restarted.  When the process first goes over the
+        soft size (or straight over the limit), it is sent the soft signal
+        instead, e.g. to make it collect garbage or trim its caches.  It is
+        only restarted if it is due for a restart after soft_cooldown
+        seconds have passed since.  It gets signalled again once it has
+        dropped to the soft size in between."""
+        state = self.signalled.get(name)
+        if state is not None and state.pid != pid:
+            del self.signalled[name]
+            state = None
+        if state is None:
+            if rss > limit.soft or due:
+                self.signal(name, rss, limit.soft)
+                self.signalled[name] = SignalState(pid, now)
+            return False
+        if due:
+            if now - state.time >= self.soft_cooldown:
+                return True
+            self.stderr.write('Waiting for %s to recover from SIG%s before '
+                              'restarting it\n' % (name, self.soft_signal))
+            return False
+        if rss <= limit.soft:
+            del self.signalled[name]
+        return False
+
+    def signal(self, name, rss, soft):
+        self.stderr.write('%s of %s is over its soft limit %d, sending it '
+                          'SIG%s\n' % (self.metric.upper(), name, soft,
+                                       self.soft_signal))
+        try:
+            self.rpc.supervisor.signalProcess(name, self.soft_signal)
+        except xmlrpclib.Fault as e:
+            # it will be restarted after the cool-down if it stays over
+            self.stderr.write('Failed to signal process %s: %s\n' % (name, e))
+
+    def schedule(self, due, now):
+        """Restart the processes which are due, furthest over their limit
+        first, restarting no more than group_restarts processes of a group
+        per tick and waiting group_spacing seconds between restarts in a
+        group.  The others are deferred; if they are still due on a later
+        tick they get their turn then."""
+        due.sort(key=lambda x: x[0], reverse=True)
+        restarted = {}
+        for overage, name, group, rss in due:
+            last = self.group_restarted.get(group)
+            if ((self.group_restarts is not None and
+                    restarted.get(group, 0) >= self.group_restarts) or
+                    (last is not None and now - last < self.group_spacing)):
+                self.stderr.write('Deferring restart of %s\n' % name)
+                continue
+            restarted[group] = restarted.get(group, 0) + 1
+            self.group_restarted[group] = now
+            self.restart(name, rss)
+
+    def states(self):
+        return self.history, self.breaches, self.signalled, self.warned
+
+    def warn(self, name, rss, slope, eta):
+        msg = ('%s of %s grows by %d bytes/s and will exceed its limit in %ds '
+               '(now %s bytes)' % (self.metric.upper(), name, slope, eta, rss))
+        self.stderr.write('%s\n' % msg)
+        info = self.infos[name]
+        uptime = info['now'] - info['start'] #uptime in seconds
+        if self.email and uptime <= self.email_uptime_limit:
+            subject = '%s: process %s is leaking memory' % (self.label(),
+                                                            name)
+            self.mail(self.email, subject, msg)
 
     def restart(self, name, rss):
-        info = self.rpc.supervisor.getProcessInfo(name)
-        uptime = info['now'] - info['start'] #uptime in seconds
+        """Queue a restart of a process.  The restarts of a tick are carried
+        out together by restart_pending() once all processes are checked,
+        instead of one by one like RuleListener.restart() does."""
         self.stderr.write('Restarting %s\n' % name)
-        memmonId = self.memmonName and " [%s]" % self.memmonName or ""
-        try:
-            self.rpc.supervisor.stopProcess(name)
-        except xmlrpclib.Fault as e:
-            msg = ('Failed to stop process %s (RSS %s), exiting: %s' %
-                   (name, rss, e))
+        self.pending.append((name, rss))
+
+    def restart_pending(self):
+        """Stop all processes queued for a restart with one system.multicall
+        and start the ones which stopped with another, so restarting many
+        processes costs two round-trips to supervisord instead of three per
+        process.  As before, memmon exits (by raising the first fault) if a
+        process could not be stopped or started; the other processes of the
+        batch are still restarted first."""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        failure = None
+        stopped = []
+        faults = self.multicall('supervisor.stopProcess',
+                                [name for name, rss in pending])
+        for (name, rss), fault in zip(pending, faults):
+            if fault is None:
+                stopped.append((name, rss))
+                continue
+            msg = ('Failed to stop process %s (%s %s), exiting: %s' %
+                   (name, self.metric.upper(), rss, fault))
             self.stderr.write(str(msg))
             if self.email:
-                subject = 'memmon%s: failed to stop process %s, exiting' % (memmonId, name)
+                subject = '%s: failed to stop process %s, exiting' % (self.label(), name)
                 self.mail(self.email, subject, msg)
-            raise
-
-        try:
-            self.rpc.supervisor.startProcess(name)
-        except xmlrpclib.Fault as e:
-            msg = ('Failed to start process %s after stopping it, '
-                   'exiting: %s' % (name, e))
-            self.stderr.write(str(msg))
-            if self.email:
-                subject = 'memmon%s: failed to start process %s, exiting' % (memmonId, name)
+            failure = failure or fault
+
+        faults = self.multicall('supervisor.startProcess',
+                                [name for name, rss in stopped])
+        for (name, rss), fault in zip(stopped, faults):
+            if fault is not None:
+                msg = ('Failed to start process %s after stopping it, '
+                       'exiting: %s' % (name, fault))
+                self.stderr.write(str(msg))
+                if self.email:
+                    subject = '%s: failed to start process %s, exiting' % (self.label(), name)
+                    self.mail(self.email, subject, msg)
+                failure = failure or fault
+                continue
+            if not self.email:
+                continue
+            info = self.infos.get(name)
+            if info is None:
+                info = self.rpc.supervisor.getProcessInfo(name)
+            uptime = info['now'] - info['start'] #uptime in seconds
+            if uptime <= self.email_uptime_limit:
+                now = time.asctime()
+                msg = (
+                    'memmon.py restarted the process named %s at %s because '
+                    'it was consuming too much memory (%s bytes %s)' % (
+                    name, now, rss, self.metric.upper())
+                    )
+                subject = '%s: process %s restarted' % (self.label(), name)
                 self.mail(self.email, subject, msg)
-            raise
 
-        if self.email and uptime <= self.email_uptime_limit:
-            now = time.asctime()
-            msg = (
-                'memmon.py restarted the process named %s at %s because '
-                'it was consuming too much memory (%s bytes RSS)' % (
-                name, now, rss)
-                )
-            subject = 'memmon%s: process %s restarted' % (memmonId, name)
-            self.mail(self.email, subject, msg)
+        if failure is not None:
+            raise failure
+
+    def multicall(self, method, names):
+        """Call an RPC method for each of the given names in a single
+        system.multicall and return a list with None for every call that
+        succeeded and the xmlrpclib.Fault for every call that failed."""
+        if not names:
+            return []
+        calls = [{'methodName': method, 'params': [name]} for name in names]
+        faults = []
+        for result in self.rpc.system.multicall(calls):
+            if isinstance(result, dict) and 'faultCode' in result:
+                faults.append(xmlrpclib.Fault(result['faultCode'],
+                                              result['faultString']))
+            else:
+                faults.append(None)
+        return faults
 
     def calc_rss(self, pid):
-
-        ProcInfo = namedtuple('ProcInfo', ['pid', 'ppid', 'rss'])
-
-        def find_children(parent_pid, procs):
-            children = []
-            for proc in procs:
-                pid, ppid, rss = proc
-                if ppid == parent_pid:
-                    children.append(proc)
-                    children.extend(find_children(pid, procs))
-            return children
-
-        def cum_rss(pid, procs):
-            parent_proc = [p for p in procs if p.pid == pid][0]
-            children = find_children(pid, procs)
-            tree = [parent_proc] + children
-            total_rss = sum(map(int, [p.rss for p in tree]))
-            return total_rss
-
-        def get_all_process_infos(data):
-            data = data.strip()
-            procs = []
-            for line in data.splitlines():
-                pid, ppid, rss = map(int, line.split())
-                procs.append(ProcInfo(pid=pid, ppid=ppid, rss=rss))
-            return procs
-
         if self.cumulative:
-            data = shell(self.pstreecommand)
-            procs = get_all_process_infos(data)
-
-            try:
-                rss = cum_rss(pid, procs)
-            except (ValueError, IndexError):
+            tree = self.process_tree()
+            pids = tree.subtree(pid)
+            if pids is None:
                 # Could not determine cumulative RSS
                 return None
+            if self.metric in CGROUP_METRICS:
+                return self.cumulative_cgroup_memory(pids)
+            if tree.rss is not None:
+                return sum([tree.rss[p] for p in pids])
+            total = self.measure(pid)
+            if total is None:
+                return None
+            for child in pids[1:]:
+                # children may exit while we walk the tree
+                total += self.measure(child) or 0
+            return total
+
+        elif self.procfs is not None:
+            return self.measure(pid)
 
         else:
             data = shell(self.pscommand % pid)
@@ -282,50 +886,157 @@ class Memmon:
         rss = rss * 1024  # rss is in KB
         return rss
 
-    def mail(self, email, subject, msg):
-        body = 'To: %s\n' % self.email
-        body += 'Subject: %s\n' % subject
-        body += '\n'
-        body += msg
-        with os.popen(self.sendmail, 'w') as m:
-            m.write(body)
-        self.mailed = body
-
-def parse_namesize(option, value):
-    try:
-        name, size = value.split('=')
-    except ValueError:
-        print('Unparseable value %r for %r' % (value, option))
-        usage()
-    size = parse_size(option, size)
-    return name, size
-
-def parse_size(option, value):
-    try:
-        size = byte_size(value)
-    except:
-        print('Unparseable byte_size in %r for %r' % (value, option))
-        usage()
-
-    return size
-
-seconds_size = SuffixMultiplier({'s': 1,
-                                 'm': 60,
-                                 'h': 60 * 60,
-                                 'd': 60 * 60 * 24
-                                 })
-
-def parse_seconds(option, value):
-    try:
-        seconds = seconds_size(value)
-    except:
-        print('Unparseable value for time in %r for %s' % (value, option))
+    def measure(self, pid):
+        """Return the configured memory figure of a single process in
+        bytes, reading each process at most once per tick."""
+        try:
+            return self.samples[pid]
+        except KeyError:
+            pass
+        if self.metric == 'rss':
+            # statm already reports bytes, no ps fork needed
+            value = self.procfs.rss(pid)
+        elif self.metric in CGROUP_METRICS:
+            path = self.procfs.cgroup(pid)
+            value = path and self.cgroup_memory(path)
+        elif self.metric in STATUS_METRICS:
+            # VmRSS and VmSwap come from the same read of the status file
+            status = self.procfs.status(pid)
+            if not status or 'VmRSS' not in status:
+                value = None
+            elif self.metric == 'swap':
+                value = status.get('VmSwap', 0)
+            else:
+                value = status['VmRSS'] + status.get('VmSwap', 0)
+        else:
+            smaps = self.procfs.smaps_rollup(pid)
+            metric = self.metric.split('+')
+            value = smaps and sum([smaps[x] for x in metric])
+        self.samples[pid] = value
+        return value
+
+    def cgroup_memory(self, path):
+        """Return the memory charged to a cgroup, reading each cgroup at
+        most once per tick."""
+        try:
+            return self.cgroups[path]
+        except KeyError:
+            pass
+        value = self.cgroupfs.memory_current(path)
+        if value is not None and self.metric == 'cgroup-ws':
+            stat = self.cgroupfs.memory_stat(path) or {}
+            value = max(value - stat.get('inactive_file', 0), 0)
+        self.cgroups[path] = value
+        return value
+
+    def cumulative_cgroup_memory(self, pids):
+        """Return the memory charged to the distinct cgroups of a process
+        tree.  A cgroup nested in another one is already accounted for in
+        its parent's figures."""
+        paths = set([self.procfs.cgroup(p) for p in pids])
+        paths.discard(None)
+        # the root cgroup has no memory.current of its own
+        paths.discard('/')
+        total = None
+        counted = []
+        for path in sorted(paths):
+            if [p for p in counted if path.startswith(p.rstrip('/') + '/')]:
+                continue
+            counted.append(path)
+            value = self.cgroup_memory(path)
+            if value is not None:
+                total = (total or 0) + value
+        return total
+
+    def process_tree(self):
+        """Return the host-wide process tree, taking a single snapshot per
+        tick no matter how many processes are checked against it."""
+        if self.tree is None:
+            if self.procfs is not None:
+                self.tree = ProcessTree(self.procfs.ppids())
+            else:
+                ppids = {}
+                rss = {}
+                for line in shell(self.pstreecommand).splitlines():
+                    try:
+                        pid, ppid, kb = map(int, line.split())
+                    except ValueError:
+                        # blank or garbled line
+                        continue
+                    ppids[pid] = ppid
+                    rss[pid] = kb * 1024  # rss is in KB
+                self.tree = ProcessTree(ppids, rss)
+        return self.tree
+
+def parse_limit(option, value):
+    """Parse a byte_size or percentage optionally followed by
+    comma-separated sustain=N/M, rearm=byte_size and soft=byte_size
+    rules."""
+    parts = value.split(',')
+    size = parse_size(option, parts[0], percentage=True)
+    rules = {}
+    for part in parts[1:]:
+        key, _, rule = part.partition('=')
+        if key == 'sustain':
+            rules['sustain'], rules['window'] = parse_sustain(
+                option, value, usage, rule)
+        elif key == 'rearm':
+            rules['rearm'] = parse_size(option, rule, percentage=True)
+            if (isinstance(size, Percentage) ==
+                    isinstance(rules['rearm'], Percentage) and
+                    rules['rearm'] > size):
+                print('The rearm size in %r for %r must not exceed the '
+                      'byte_size' % (value, option))
+                usage()
+        elif key == 'soft':
+            rules['soft'] = parse_size(option, rule, percentage=True)
+            if (isinstance(size, Percentage) ==
+                    isinstance(rules['soft'], Percentage) and
+                    rules['soft'] >= size):
+                print('The soft size in %r for %r must be below the '
+                      'byte_size' % (value, option))
+                usage()
+        else:
+            print('Unknown rule %r in %r for %r' % (part, value, option))
+            usage()
+    if [x for x in (size, rules.get('rearm'), rules.get('soft'))
+            if isinstance(x, Percentage)]:
+        return RelativeLimit(size, **rules)
+    if not rules:
+        return size
+    return Limit(size, **rules)
+
+def parse_size(option, value, percentage=False):
+    if percentage and value.endswith('%'):
+        return parse_percentage(option, value, usage)
+    return parse_byte_size(option, value, usage)
+
+def parse_pressure(option, value):
+    """Parse comma-separated some=percent, full=percent and avg=seconds
+    pressure levels."""
+    pressure = {}
+    for part in value.split(','):
+        key, _, level = part.partition('=')
+        try:
+            if key in ('some', 'full'):
+                pressure[key] = float(level)
+            elif key == 'avg' and int(level) in (10, 60, 300):
+                pressure[key] = int(level)
+            else:
+                raise ValueError(key)
+        except ValueError:
+            print('Unparseable pressure level %r in %r for %s, use some=N, '
+                  'full=N and avg=10|60|300' % (part, value, option))
+            usage()
+    if 'some' not in pressure and 'full' not in pressure:
+        print('No some=N or full=N pressure level in %r for %s' % (
+            value, option))
         usage()
-    return seconds
+    return pressure
 
 def memmon_from_args(arguments):
     import getopt
-    short_args = "hcp:g:a:s:m:n:u:"
+    short_args = "hcp:g:a:s:m:n:u:M:"
     long_args = [
         "help",
         "cumulative",
@@ -336,6 +1047,21 @@ def memmon_from_args(arguments):
         "email=",
         "uptime=",
         "name=",
+        "metric=",
+        "ps",
+        "leak=",
+        "leak-window=",
+        "leak-warn",
+        "pressure=",
+        "pressure-victim=",
+        "interval=",
+        "group-restarts=",
+        "group-spacing=",
+        "soft-signal=",
+        "soft-cooldown=",
+        "export=",
+        "export-format=",
+        "summary",
         ]
 
     if not arguments:
@@ -353,6 +1079,21 @@ def memmon_from_args(arguments):
     email = None
     uptime_limit = maxint
     name = None
+    use_ps = False
+    metric = 'rss'
+    leak = None
+    leak_window = 10
+    leak_warn = False
+    pressure = None
+    pressure_victim = 'largest'
+    interval = None
+    group_restarts = None
+    group_spacing = 0
+    soft_signal = 'USR1'
+    soft_cooldown = 0
+    export = None
+    export_format = 'csv'
+    summary = False
 
     for option, value in opts:
 
@@ -363,15 +1104,15 @@ def memmon_from_args(arguments):
             cumulative = True
 
         if option in ('-p', '--program'):
-            name, size = parse_namesize(option, value)
-            programs[name] = size
+            pattern, size = parse_namelimit(option, value, usage, parse_limit)
+            programs[pattern] = size
 
         if option in ('-g', '--group'):
-            name, size = parse_namesize(option, value)
-            groups[name] = size
+            pattern, size = parse_namelimit(option, value, usage, parse_limit)
+            groups[pattern] = size
 
         if option in ('-a', '--any'):
-            size = parse_size(option, value)
+            size = parse_limit(option, value)
             any = size
 
         if option in ('-s', '--sendmail_program'):
@@ -381,11 +1122,104 @@ def memmon_from_args(arguments):
             email = value
 
         if option in ('-u', '--uptime'):
-            uptime_limit = parse_seconds(option, value)
+            uptime_limit = parse_seconds(option, value, usage)
 
         if option in ('-n', '--name'):
             name = value
 
+        if option in ('-M', '--metric'):
+            if value not in METRICS:
+                print('Unknown metric %r for %r, use one of %s' % (
+                    value, option, ', '.join(METRICS)))
+                usage()
+            metric = value
+
+        if option == '--ps':
+            use_ps = True
+
+        if option == '--leak':
+            leak = parse_seconds(option, value, usage)
+
+        if option == '--leak-window':
+            leak_window = parse_count(option, value, usage, minimum=2)
+
+        if option == '--leak-warn':
+            leak_warn = True
+
+        if option == '--pressure':
+            pressure = parse_pressure(option, value)
+
+        if option == '--pressure-victim':
+            if value not in ('largest', 'fastest'):
+                print('Unknown victim %r for %r, use largest or fastest' % (
+                    value, option))
+                usage()
+            pressure_victim = value
+
+        if option == '--interval':
+            try:
+                interval = float(value)
+            except ValueError:
+                interval = 0
+            if interval < 0.1:
+                print('Expected at least 0.1 seconds in %r for %s' % (
+                    value, option))
+                usage()
+
+        if option == '--group-restarts':
+            group_restarts = parse_count(option, value, usage)
+
+        if option == '--group-spacing':
+            group_spacing = parse_seconds(option, value, usage)
+
+        if option == '--soft-signal':
+            try:
+                signal_number(value)
+            except ValueError:
+                print('Unknown signal %r for %r' % (value, option))
+                usage()
+            soft_signal = value.upper()
+            if soft_signal.startswith('SIG'):
+                soft_signal = soft_signal[3:]
+
+        if option == '--soft-cooldown':
+            soft_cooldown = parse_seconds(option, value, usage)
+
+        if option == '--export':
+            export = value
+
+        if option == '--export-format':
+            if value not in ('csv', 'openmetrics'):
+                print('Unknown format %r for %r, use csv or openmetrics' % (
+                    value, option))
+                usage()
+            export_format = value
+
+        if option == '--summary':
+            summary = True
+
+    procfs = None if use_ps else default_procfs()
+    if metric != 'rss' and procfs is None:
+        print('The %s metric needs /proc' % metric)
+        usage()
+    if pressure and procfs is None:
+        print('--pressure needs /proc/pressure/memory')
+        usage()
+    cgroupfs = None
+    limits = list(programs.values()) + list(groups.values()) + [any]
+    if [l for l in limits if isinstance(l, RelativeLimit)]:
+        if procfs is None:
+            print('Percentage limits need /proc/meminfo')
+            usage()
+        # optional: limit percentages to the cgroup supervisord runs in
+        cgroupfs = default_cgroupfs()
+    if metric in CGROUP_METRICS:
+        cgroupfs = default_cgroupfs()
+        if cgroupfs is None:
+            print('The %s metric needs a cgroup v2 hierarchy mounted '
+                  'at /sys/fs/cgroup' % metric)
+            usage()
+
     memmon = Memmon(cumulative=cumulative,
                     programs=programs,
                     groups=groups,
@@ -393,7 +1227,23 @@ def memmon_from_args(arguments):
                     sendmail=sendmail,
                     email=email,
                     email_uptime_limit=uptime_limit,
-                    name=name)
+                    name=name,
+                    procfs=procfs,
+                    metric=metric,
+                    leak=leak,
+                    leak_window=leak_window,
+                    leak_warn=leak_warn,
+                    cgroupfs=cgroupfs,
+                    pressure=pressure,
+                    pressure_victim=pressure_victim,
+                    interval=interval,
+                    group_restarts=group_restarts,
+                    group_spacing=group_spacing,
+                    soft_signal=soft_signal,
+                    soft_cooldown=soft_cooldown,
+                    export=export,
+                    export_format=export_format,
+                    summary=summary)
     return memmon
 
 def main():
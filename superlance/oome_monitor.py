@@ -1,21 +1,617 @@
 #!/usr/bin/env python
 import argparse
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import gzip
 import os
 import os.path
+import platform
+import re
+import select
+import shutil
+import socket
 import sys
+import threading
+import time
+from collections import deque
 
+try:
+    import lzma
+except ImportError: # Python < 3.3
+    lzma = None
+
+from superlance import inotify
+from superlance.compat import queue
 from superlance.compat import xmlrpclib
 from superlance.utils import ExternalService
 from supervisor import childutils
+from supervisor.datatypes import signal_number
 from supervisor.options import make_namespec
 
 DESCRIPTION = "Check individual help sections for 'single' and/or 'all'"
 
+# a sentinel file appearing in a watched directory, created in place or
+# renamed into it
+WATCH_MASK = (inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE
+              | inotify.IN_ONLYDIR)
+
+# the environment variables the oome file is derived from
+ENVIRON_NAMES = ('OOME_FILE', 'HOMEDIR')
+# stop scanning an environment after this many bytes
+ENVIRON_LIMIT = 1024 * 1024
+
+# ioprio_set(2) system call numbers, which Python has no wrapper for
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+              'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+IOPRIO_WHO_PROCESS = 1
+# the lowest level of the best-effort class
+IOPRIO_LOWEST = (2 << 13) | 7
+
+def scan_environ(f, names=ENVIRON_NAMES, limit=ENVIRON_LIMIT, chunk=4096):
+    """
+    Return the values of some variables of a NUL separated environment, as
+    found in /proc/<pid>/environ.  Reads the file in chunks and stops as
+    soon as all of the variables were found, or after `limit` bytes.
+
+    :param f: File object to read the environment from
+    :type f: file
+    :param names: Names of the variables to look for
+    :type names: tuple
+    :returns: Variable values by name
+    :rtype: dict
+    """
+    found = {}
+    tail = ''
+    count = 0
+    while count < limit:
+        data = f.read(min(chunk, limit - count))
+        if not data:
+            # the last variable isn't NUL terminated
+            entries = [tail]
+            tail = ''
+        else:
+            count += len(data)
+            entries = (tail + data).split('\x00')
+            tail = entries.pop()
+        for entry in entries:
+            name, sep, value = entry.partition('=')
+            if sep and name in names:
+                found[name] = value
+        if not data or len(found) == len(names):
+            break
+    return found
+
+def list_directory(path):
+    """
+    Return the names in a directory, without looking at the entries.
+
+    :param path: Directory name
+    :type path: str
+    :returns: Set of names, empty if the directory can't be read
+    :rtype: set
+    """
+    try:
+        return set(os.listdir(path))
+    except OSError:
+        return set()
+
+ACTIONS = ('restart', 'signal', 'notify')
+# the values a rule pattern may refer to, besides ENV_<name>
+SUBSTITUTIONS = ('pid', 'cwd', 'name', 'group')
+FIELD = re.compile(r'%\(([^)]*)\)s')
+GLOB = re.compile(r'[*?[]')
+
+class TriggerRule(object):
+    """
+    A sentinel file pattern and the action to take on the process when a
+    file matching it appears, e.g. restart a process when it drops a
+    "restart-me" file into its working directory.
+    """
+    def __init__(self, pattern, action, signal=None):
+        """
+        :param pattern: File name, which may refer to %(pid)s, %(cwd)s,
+            %(name)s, %(group)s and %(ENV_<name>)s of the process, and may
+            have glob characters in its last component
+        :type pattern: str
+        :param action: 'restart', 'signal' or 'notify'
+        :type action: str
+        :param signal: Signal name for the 'signal' action, e.g. 'QUIT'
+        :type signal: str
+        """
+        self.pattern = pattern
+        self.action = action
+        self.signal = signal
+        self.env_names = tuple([x[4:] for x in FIELD.findall(pattern)
+                                if x.startswith('ENV_')])
+
+    def __str__(self):
+        if self.signal:
+            return '{0}=signal:{1}'.format(self.pattern, self.signal)
+        return '{0}={1}'.format(self.pattern, self.action)
+
+    def resolve(self, oome_process):
+        """
+        Returns the trigger of the rule for a process.
+
+        :param oome_process: Process to substitute the values of
+        :type oome_process: OomeProcess
+        :raises KeyError: if the process lacks an environment variable the
+            pattern refers to
+        :raises OSError: if the process went away
+        :rtype: Trigger
+        """
+        return Trigger(self, self.pattern % Substitutions(oome_process))
+
+class Substitutions(object):
+    """
+    The values of a process a rule pattern refers to, looked up on demand
+    so a pattern without %(cwd)s doesn't read the cwd of the process.
+    """
+    def __init__(self, oome_process):
+        self.oome_process = oome_process
+
+    def __getitem__(self, key):
+        process = self.oome_process.process
+        if key.startswith('ENV_'):
+            return self.oome_process.env_vars[key[4:]]
+        if key == 'cwd':
+            return os.readlink('/proc/{0}/cwd'.format(process['pid']))
+        return str(process[key])
+
+class Trigger(object):
+    """
+    A rule resolved for a process: a directory and a file name or glob
+    pattern in it.  The oome file of a process is the trigger without a
+    rule.
+    """
+    def __init__(self, rule, path):
+        self.rule = rule
+        self.path = path
+        self.directory, self.name = os.path.split(path)
+        self.regex = None
+        if GLOB.search(self.name):
+            self.regex = re.compile(fnmatch.translate(self.name))
+
+    def matches(self, name):
+        """
+        Returns whether a file name in the directory matches the trigger.
+
+        :param name: File name without the directory
+        :type name: str
+        :rtype: bool
+        """
+        if self.regex is None:
+            return name == self.name
+        return self.regex.match(name) is not None
+
+    def find(self, names=None):
+        """
+        Returns the files matching the trigger.
+
+        :param names: Names in the directory, if it was listed already
+        :type names: set
+        :returns: List of absolute file names
+        :rtype: list
+        """
+        if self.regex is None and names is None:
+            names = [self.name]
+        elif names is None:
+            names = list_directory(self.directory)
+        return [os.path.join(self.directory, x) for x in sorted(names)
+                if self.matches(x) and
+                os.path.isfile(os.path.join(self.directory, x))]
+
+def parse_rule(value):
+    """
+    Parses a --rule option of the form PATTERN=ACTION, where the action is
+    'restart', 'notify' or 'signal:NAME'.
+
+    :rtype: TriggerRule
+    :raises argparse.ArgumentTypeError: if the rule is malformed
+    """
+    pattern, sep, action = value.rpartition('=')
+    if not sep or not pattern:
+        raise argparse.ArgumentTypeError(
+            'rule {0!r} is not of the form PATTERN=ACTION'.format(value))
+    fields = FIELD.findall(pattern)
+    for field in fields:
+        if field not in SUBSTITUTIONS and not field.startswith('ENV_'):
+            raise argparse.ArgumentTypeError(
+                'rule {0!r} refers to unknown value %({1})s'.format(
+                    value, field))
+    try:
+        pattern % dict([(x, 'x') for x in fields])
+    except (KeyError, TypeError, ValueError):
+        raise argparse.ArgumentTypeError(
+            'rule {0!r} has a malformed pattern'.format(value))
+    if GLOB.search(os.path.dirname(pattern)):
+        raise argparse.ArgumentTypeError(
+            'rule {0!r} may only have glob characters in the file '
+            'name'.format(value))
+    action, _, signal = action.partition(':')
+    if action not in ACTIONS:
+        raise argparse.ArgumentTypeError(
+            'rule {0!r} has an unknown action, use one of {1}'.format(
+                value, ', '.join(ACTIONS)))
+    if action == 'signal':
+        signal = signal.upper()
+        if signal.startswith('SIG'):
+            signal = signal[3:]
+        try:
+            signal_number(signal)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'rule {0!r} needs a signal name, e.g. signal:QUIT'.format(
+                    value))
+        return TriggerRule(pattern, action, signal)
+    if signal:
+        raise argparse.ArgumentTypeError(
+            'rule {0!r}: only the signal action takes an argument'.format(
+                value))
+    return TriggerRule(pattern, action)
+
+# heap dumps written by -XX:+HeapDumpOnOutOfMemoryError are named after
+# the pid of the JVM unless -XX:HeapDumpPath names the file
+HEAP_DUMP_NAME = re.compile(r'^java_pid(\d+)(\.\d+)?\.hprof$')
+
+COMPRESSIONS = ('gzip', 'lzma', 'none')
+if lzma is None:
+    COMPRESSIONS = ('gzip', 'none')
+
+def find_heap_dumps(directory, pid):
+    """
+    Return the heap dumps of a process in a directory: any .hprof file but
+    the ones named after another pid.
+
+    :param directory: Directory name
+    :type directory: str
+    :param pid: Process id
+    :type pid: int
+    :returns: List of absolute file names
+    :rtype: list
+    """
+    dumps = []
+    for name in sorted(list_directory(directory)):
+        if not name.endswith('.hprof'):
+            continue
+        match = HEAP_DUMP_NAME.match(name)
+        if match and int(match.group(1)) != pid:
+            continue
+        dumps.append(os.path.join(directory, name))
+    return dumps
+
+def ioprio_set(ioprio):
+    """
+    Set the I/O priority of the calling thread.
+
+    :param ioprio: Class and level of the priority
+    :type ioprio: int
+    :raises OSError: if the I/O priority can't be set on this platform
+    """
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, 'ioprio_set is not known on {0}'.format(
+            platform.machine()))
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+def lower_priority():
+    """
+    Give the calling thread the lowest CPU and I/O priority.  Both only
+    apply to the thread on Linux, elsewhere they would slow down the whole
+    monitor, so nothing is changed there.
+
+    :returns: Why the priorities couldn't be lowered, if they couldn't
+    :rtype: list
+    """
+    if not sys.platform.startswith('linux'):
+        return ['only supported on Linux']
+    problems = []
+    try:
+        setpriority = getattr(os, 'setpriority', None)
+        if setpriority is not None:
+            setpriority(os.PRIO_PROCESS, 0, 19)
+        else: # Python < 3.3
+            os.nice(19)
+    except OSError as e:
+        problems.append('CPU priority: {0}'.format(e))
+    try:
+        ioprio_set(IOPRIO_LOWEST)
+    except OSError as e:
+        problems.append('I/O priority: {0}'.format(e))
+    return problems
+
+class HeapDumpArchiver(threading.Thread):
+    """
+    Moves heap dumps into an archive directory right away and compresses
+    them in the background, so restarting the process isn't held up by it.
+    Compression streams the file in chunks at the lowest CPU and I/O
+    priority.
+    """
+    chunk = 1024 * 1024
+
+    def __init__(self, archive, compression='gzip', stderr=None):
+        """
+        :param archive: Directory to move the heap dumps to
+        :type archive: str
+        :param compression: 'gzip', 'lzma' or 'none'
+        :type compression: str
+        :param stderr: Stream to log to
+        :type stderr: file
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.archive = archive
+        self.compression = compression
+        self.stderr = stderr or sys.stderr
+        self.queue = queue.Queue()
+
+    def write_stderr(self, msg):
+        self.stderr.write('{0}\n'.format(msg))
+        self.stderr.flush()
+
+    def capture(self, namespec, path):
+        """
+        Move a heap dump into the archive and queue it for compression.
+        Across file systems the heap dump is copied by the background
+        worker instead.
+
+        :param namespec: Process the heap dump belongs to
+        :type namespec: str
+        :param path: Heap dump file name
+        :type path: str
+        :returns: File name in the archive
+        :rtype: str
+        """
+        target = os.path.join(self.archive, '{0}-{1}-{2}'.format(
+            namespec.replace(':', '_'), time.strftime('%Y%m%d%H%M%S'),
+            os.path.basename(path)))
+        try:
+            os.rename(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                self.write_stderr('heap dump {0} could not be archived: '
+                                  '{1}'.format(path, e))
+                return None
+            self.queue.put((path, target))
+        else:
+            self.write_stderr('heap dump {0} was moved to {1}'.format(
+                path, target))
+            self.queue.put((target, target))
+        if self.ident is None:
+            self.start()
+        return target
+
+    def run(self):
+        problems = lower_priority()
+        if problems:
+            self.write_stderr('heap dumps are compressed at normal priority, '
+                              'could not lower it: {0}'.format(
+                                  '; '.join(problems)))
+        while 1:
+            source, target = self.queue.get()
+            try:
+                self.compress(source, target)
+            finally:
+                self.queue.task_done()
+
+    def compress(self, source, target):
+        """
+        Compress a heap dump into the archive, removing the uncompressed
+        file once done.  A failure leaves the uncompressed file in place.
+
+        :param source: Uncompressed heap dump
+        :type source: str
+        :param target: Name of the heap dump in the archive, without the
+            extension of the compression
+        :type target: str
+        """
+        if self.compression == 'gzip':
+            target += '.gz'
+            output = lambda path: gzip.open(path, 'wb', 6)
+        elif self.compression == 'lzma':
+            target += '.xz'
+            output = lambda path: lzma.open(path, 'wb', preset=1)
+        elif source == target:
+            return
+        else:
+            output = lambda path: open(path, 'wb')
+        partial = target + '.part'
+        started = time.time()
+        try:
+            with open(source, 'rb') as src:
+                with output(partial) as dst:
+                    shutil.copyfileobj(src, dst, self.chunk)
+            os.rename(partial, target)
+            os.remove(source)
+        except (IOError, OSError) as e:
+            self.write_stderr('heap dump {0} could not be compressed: '
+                              '{1}'.format(source, e))
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            return
+        self.write_stderr('heap dump {0} was compressed to {1} in {2:.0f}s'
+                          .format(source, target, time.time() - started))
+
+    def wait(self):
+        """
+        Wait for the queued heap dumps to be compressed.
+        """
+        self.queue.join()
+
+class SerializedStream(object):
+    """
+    Wraps a stream written to from several threads, so that every write
+    goes out whole under the same lock as the messages of the monitor.
+    """
+    def __init__(self, stream, lock):
+        """
+        :param stream: Stream to write to
+        :type stream: file
+        :param lock: Lock held while writing
+        :type lock: threading.Lock
+        """
+        self.stream = stream
+        self.lock = lock
+
+    def write(self, data):
+        with self.lock:
+            self.stream.write(data)
+            self.stream.flush()
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        # e.g. fileno() for the output of the external service script
+        return getattr(self.stream, name)
+
+def timeout_rpc_interface(env, timeout):
+    """
+    Returns an RPC interface to supervisord like
+    childutils.getRPCInterface(), whose calls raise socket.timeout once
+    supervisord doesn't answer for `timeout` seconds instead of hanging.
+
+    :param env: Environment with the SUPERVISOR_* variables
+    :type env: dict
+    :param timeout: Socket timeout in seconds, None for no timeout
+    :type timeout: int
+    :rtype: xmlrpclib.ServerProxy
+    """
+    transport = childutils.getRPCTransport(env)
+    get_connection = transport._get_connection
+    def _get_connection():
+        connection = get_connection()
+        connect = connection.connect
+        def timeout_connect():
+            # the unix socket connection of supervisor ignores the timeout
+            # of httplib, so it is set on the socket once connected
+            connect()
+            connection.sock.settimeout(timeout)
+        connection.connect = timeout_connect
+        return connection
+    transport._get_connection = _get_connection
+    return xmlrpclib.ServerProxy('http://127.0.0.1', transport)
+
+class RestartPool(object):
+    """
+    Restarts processes in up to `size` threads at a time, so that processes
+    which ran out of memory together are restarted in parallel without
+    holding up the event listener, nor restarting everything at once.
+
+    The restart function enforces the timeout, by killing the external
+    service script or timing out its RPC calls, which frees the slot.  A
+    restart still running after the timeout is reported, and keeps its
+    slot, and its process can't be queued for another restart, until it
+    finishes.
+    """
+    def __init__(self, restart, size=4, timeout=None, write_stderr=None):
+        """
+        :param restart: Function restarting a process, called with the
+            process data structure
+        :type restart: callable
+        :param size: Maximum number of restarts in progress
+        :type size: int
+        :param timeout: Seconds after which a restart is reported as stuck,
+            None to never report it
+        :type timeout: int
+        :param write_stderr: Function to log with
+        :type write_stderr: callable
+        """
+        self.restart = restart
+        self.size = size
+        self.timeout = timeout
+        self.write_stderr = write_stderr
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.running = {}
+        self.overdue = set()
+        self.done = threading.Condition(self.lock)
+
+    def submit(self, process):
+        """
+        Queue a restart, unless the process is being restarted already.
+
+        :param process: Process data structure returned by
+            supervisor.rpc.getProcessInfo()
+        :type process: dict
+        :returns: Whether the restart was queued
+        :rtype: bool
+        """
+        namespec = make_namespec(process['group'], process['name'])
+        with self.lock:
+            if namespec in self.running or namespec in [
+                    make_namespec(x['group'], x['name']) for x in self.pending]:
+                self.write_stderr('{0} is being restarted already'.format(
+                    namespec))
+                return False
+            self.pending.append(process)
+        self.dispatch()
+        return True
+
+    def dispatch(self):
+        """
+        Report restarts which timed out and start queued ones while there
+        are free slots.
+        """
+        with self.lock:
+            now = time.time()
+            for namespec, (thread, started) in list(self.running.items()):
+                if not thread.is_alive():
+                    del self.running[namespec]
+                    self.overdue.discard(namespec)
+                elif (self.timeout and now - started > self.timeout and
+                        namespec not in self.overdue):
+                    self.write_stderr('Restart of {0} timed out after {1}s, '
+                                      'waiting for it to finish'.format(
+                                          namespec, self.timeout))
+                    self.overdue.add(namespec)
+            while self.pending and len(self.running) < self.size:
+                process = self.pending.popleft()
+                thread = threading.Thread(target=self.run, args=(process,))
+                thread.daemon = True
+                namespec = make_namespec(process['group'], process['name'])
+                self.running[namespec] = (thread, now)
+                thread.start()
+            self.done.notify_all()
+
+    def run(self, process):
+        try:
+            self.restart(process)
+        finally:
+            namespec = make_namespec(process['group'], process['name'])
+            with self.lock:
+                entry = self.running.get(namespec)
+                if entry is not None and entry[0] is threading.current_thread():
+                    del self.running[namespec]
+                if namespec in self.overdue:
+                    self.overdue.discard(namespec)
+                    self.write_stderr('Restart of {0} finished after {1:.0f}s'
+                                      .format(namespec,
+                                              time.time() - entry[1]))
+            self.dispatch()
+
+    def wait(self):
+        """
+        Wait until no restart is queued or in progress.
+        """
+        with self.lock:
+            while self.pending or self.running:
+                self.done.wait(1)
+
 class OomeProcess(object):
     """
     Class to contain process related definitions related to OomeMonitor
     """
-    def __init__(self, process_object, oome_file=None):
+    def __init__(self, process_object, oome_file=None, rules=()):
         """
         :param process_object: Process data structure returned by
             supervisor.rpc.getProcessInfo()
@@ -23,11 +619,16 @@ class OomeProcess(object):
         :param oome_file: oome file name to check if specified,
             otherwise autodetect
         :type oome_file: str
+        :param rules: Sentinel file rules to check besides the oome file
+        :type rules: list
         """
         self.process = process_object
         self.oome_file = oome_file
+        self.rules = rules
         self.stderr = sys.stderr
         self._env_vars = None
+        self.env_names = ENVIRON_NAMES + tuple(
+            [x for rule in rules for x in rule.env_names])
     
     @property
     def env_vars(self):
@@ -37,15 +638,31 @@ class OomeProcess(object):
         :returns: Process environment variables dictionary
         :rtype: dict
         """
-        if not self._env_vars:
+        if self._env_vars is None:
             with open('/proc/{0}/environ'.format(self.process['pid'])) as f:
-                self._env_vars = dict(
-                    x.split('=')
-                    for x in f.read().split('\x00')
-                    if x.startswith('OOME_FILE')
-                    or x.startswith('HOMEDIR')
-                )
+                self._env_vars = scan_environ(f, self.env_names)
         return self._env_vars
+
+    @property
+    def triggers(self):
+        """
+        Cache and return the sentinel files to look for: the oome file
+        followed by the ones of the rules.  A rule referring to an
+        environment variable the process doesn't have is left out.
+
+        :returns: List of Trigger
+        :rtype: list
+        """
+        if self._triggers is None:
+            triggers = [Trigger(None, self.oome_file)]
+            for rule in self.rules:
+                try:
+                    triggers.append(rule.resolve(self))
+                except (KeyError, OSError):
+                    # no such variable, or the cwd isn't readable
+                    continue
+            self._triggers = triggers
+        return self._triggers
     
     @property
     def oome_file(self):
@@ -81,14 +698,21 @@ class OomeProcess(object):
         :type value: str
         """
         self._oome_file = value
+        self._triggers = None
         
-    def check_oome_file(self):
+    def check_oome_file(self, names=None):
         """
         Check if "oome" file for this process exists in the file system.
 
+        :param names: Names in the directory of the oome file, if it was
+            listed already; the file is only looked at if its name is there
+        :type names: set
         :returns: Boolean result whether file exists or not
         :rtype: bool
         """
+        if (names is not None and
+                os.path.basename(self.oome_file) not in names):
+            return False
         if os.path.isfile(self.oome_file):
             return True
         else:
@@ -113,7 +737,11 @@ class OomeMonitor(object):
     state/ directory.
     """
     def __init__(self, rpc, process_name=None, all=False, dry=False,
-                 oome_file=None, ext_service=None, **kwargs):
+                 oome_file=None, ext_service=None, inotify=True,
+                 reconcile_interval=300, heap_dump_archive=None,
+                 heap_dump_compression='gzip', max_restarts=4,
+                 restart_timeout=300, rpc_factory=None, rules=None,
+                 email=None, sendmail='/usr/sbin/sendmail -t -i', **kwargs):
         """
         We explicitly define self.stdin, self.stdout, and self.stderr
         so this code could be unit tested.
@@ -129,6 +757,35 @@ class OomeMonitor(object):
         :param oome_file: oome file name to check if specified,
             otherwise autodetect
         :type oome_file: str
+        :param inotify: Watch the directories of the oome files to react to
+            them as soon as they appear, not only on TICK events
+        :type inotify: bool
+        :param reconcile_interval: Seconds between full reconciliations of
+            the processes with supervisord, in case a PROCESS_STATE event
+            was missed
+        :type reconcile_interval: int
+        :param heap_dump_archive: Directory to move the heap dumps found
+            next to an oome file to before restarting the process
+        :type heap_dump_archive: str
+        :param heap_dump_compression: 'gzip', 'lzma' or 'none'
+        :type heap_dump_compression: str
+        :param max_restarts: Maximum number of restarts in progress at once
+        :type max_restarts: int
+        :param restart_timeout: Seconds after which a restart is reported
+            as stuck, 0 to never report it.  `ext_service` and `rpc_factory`
+            are expected to time out after as long.
+        :type restart_timeout: int
+        :param rpc_factory: Function returning a new RPC interface, for the
+            threads restarting processes to use instead of sharing `rpc`
+        :type rpc_factory: callable
+        :param rules: Sentinel file rules to check besides the oome files
+        :type rules: list
+        :param email: Address to mail about the sentinel files of 'notify'
+            rules
+        :type email: str
+        :param sendmail: Command to send the mail with, which reads the
+            headers and message on stdin
+        :type sendmail: str
         """
         self.all = all
         self.dry = dry
@@ -140,22 +797,110 @@ class OomeMonitor(object):
         self.stdin = sys.stdin
         self.stdout = sys.stdout
         self.stderr = sys.stderr
-        self._generate_processes()
+        self.rules = rules or []
+        self.email = email
+        self.sendmail = sendmail
+        self.mailed = False # for unit tests
+        self.reconcile_interval = reconcile_interval
+        self.reconciled = None
+        self.processes = {}
+        self.reconcile()
         self.ext_service = ext_service
-        
-    def _generate_processes(self):
+        self.output = threading.Lock()
+        if ext_service is not None:
+            # the script runs in the restart threads
+            ext_service.stderr = SerializedStream(ext_service.stderr,
+                                                  self.output)
+        self.inotify = inotify
+        self.watcher = None
+        self.watches = {}
+        self.watched = {}
+        self.heap_dump_archive = heap_dump_archive
+        self.heap_dump_compression = heap_dump_compression
+        self.archiver = None
+        self.rpc_factory = rpc_factory
+        self.local = threading.local()
+        self.restarts = RestartPool(self.restart, max_restarts,
+                                    restart_timeout or None, self.write_stderr)
+
+    def monitors(self, name):
         """
-        Generate OomeProcess objects.
+        Returns whether a supervisord process is monitored.
+
+        :param name: Process name
+        :type name: str
+        :rtype: bool
+        """
+        return self.all or name in self.process_names
+
+    def register(self, process):
+        """
+        Add, update or remove the entry of a process in the registry of
+        monitored processes.  A process which was started anew gets a new
+        OomeProcess, so its environment and oome file are read again.
+
+        :param process: Process data structure returned by
+            supervisor.rpc.getProcessInfo(), or the equivalent fields of a
+            PROCESS_STATE event
+        :type process: dict
+        :returns: Whether the registry changed
+        :rtype: bool
         """
-        self.processes = []
-        if len(self.process_names) > 1 or self.all:
-            for process in self.procs:
-                proc = OomeProcess(process)
-                self.processes.append(proc)
+        if not self.monitors(process['name']):
+            return False
+        namespec = make_namespec(process['group'], process['name'])
+        current = self.processes.get(namespec)
+        if not process['pid']:
+            # not running, so there's no oome file to look for
+            return self.processes.pop(namespec, None) is not None
+        if current is not None and current.process['pid'] == process['pid']:
+            return False
+        if not self.all and len(self.process_names) == 1:
+            oome_process = OomeProcess(process, oome_file=self.oome_file,
+                                       rules=self.rules)
         else:
-            proc = OomeProcess(self.procs[0], oome_file=self.oome_file)
-            self.processes.append(proc)
-    
+            oome_process = OomeProcess(process, rules=self.rules)
+        self.processes[namespec] = oome_process
+        return True
+
+    def reconcile(self):
+        """
+        Bring the registry in line with the processes supervisord runs.
+
+        :returns: Whether the registry changed
+        :rtype: bool
+        """
+        changed = False
+        seen = set()
+        for process in self.procs:
+            seen.add(make_namespec(process['group'], process['name']))
+            changed = self.register(process) or changed
+        for namespec in list(self.processes):
+            if namespec not in seen:
+                del self.processes[namespec]
+                changed = True
+        self.reconciled = time.time()
+        return changed
+
+    def on_state_change(self, eventname, payload):
+        """
+        Update the registry from a PROCESS_STATE event: a RUNNING process
+        may have a new pid, other states mean it is not running.
+
+        :param eventname: Event name, e.g. PROCESS_STATE_RUNNING
+        :type eventname: str
+        :param payload: Event payload
+        :type payload: str
+        :returns: Whether the registry changed
+        :rtype: bool
+        """
+        headers = childutils.get_headers(payload)
+        pid = 0
+        if eventname == 'PROCESS_STATE_RUNNING':
+            pid = int(headers.get('pid', 0))
+        return self.register({'name': headers['processname'],
+                              'group': headers['groupname'], 'pid': pid})
+
     def write_stderr(self, msg):
         """
         Send arbitrary messages to supervisord which will be logged into file.
@@ -163,8 +908,24 @@ class OomeMonitor(object):
         :param msg: Message to send
         :type msg: str
         """
-        self.stderr.write('{0}\n'.format(msg))
-        self.stderr.flush()
+        with self.output:
+            self.stderr.write('{0}\n'.format(msg))
+            self.stderr.flush()
+
+    def worker_rpc(self):
+        """
+        Returns the RPC interface for the current thread.  xmlrpclib server
+        proxies can't be shared between threads, so every thread gets its
+        own when there is an `rpc_factory`.
+
+        :rtype: xmlrpclib.ServerProxy
+        """
+        if self.rpc_factory is None:
+            return self.rpc
+        rpc = getattr(self.local, 'rpc', None)
+        if rpc is None:
+            rpc = self.local.rpc = self.rpc_factory()
+        return rpc
     
     @property
     def procs(self):
@@ -204,47 +965,301 @@ class OomeMonitor(object):
             else:
                 self.write_stderr('%s restarted' % namespec)
         else:
+            rpc = self.worker_rpc()
             try:
-                self.rpc.supervisor.stopProcess(namespec)
-            except xmlrpclib.Fault as e:
-                self.write_stderr('Failed to stop process %s: %s' % (
+                try:
+                    rpc.supervisor.stopProcess(namespec)
+                except xmlrpclib.Fault as e:
+                    self.write_stderr('Failed to stop process %s: %s' % (
+                        namespec, e))
+                try:
+                    rpc.supervisor.startProcess(namespec)
+                except xmlrpclib.Fault as e:
+                    self.write_stderr('Failed to start process %s: %s' % (
+                        namespec, e))
+                else:
+                    self.write_stderr('%s restarted' % namespec)
+            except socket.error as e:
+                # e.g. timed out; the connection is of no use anymore
+                self.local.rpc = None
+                self.write_stderr('Gave up restarting process %s: %s' % (
                     namespec, e))
+
+        
+    def handle(self, oome_process):
+        """
+        Act on a process whose oome file was found.
+
+        :param oome_process: Process whose oome file exists
+        :type oome_process: OomeProcess
+        """
+        if self.dry:
+            self.write_stderr(
+                'oome file is detected for {0}, not restarting due '
+                'to dry-run'.format(oome_process.process['name']))
+        else:
+            if self.heap_dump_archive:
+                self.capture_heap_dumps(oome_process)
+            # delete the oome file first
+            oome_process.delete_oome_file()
+            # restart the process in the background
+            self.restarts.submit(oome_process.process)
+
+    def capture_heap_dumps(self, oome_process):
+        """
+        Move the heap dumps next to the oome file of a process into the
+        archive, leaving their compression to a background thread.
+
+        :param oome_process: Process whose oome file exists
+        :type oome_process: OomeProcess
+        """
+        if self.archiver is None:
+            self.archiver = HeapDumpArchiver(self.heap_dump_archive,
+                self.heap_dump_compression,
+                SerializedStream(self.stderr, self.output))
+        process = oome_process.process
+        namespec = make_namespec(process['group'], process['name'])
+        for path in find_heap_dumps(os.path.dirname(oome_process.oome_file),
+                                    process['pid']):
+            self.archiver.capture(namespec, path)
+
+    def poll(self):
+        """
+        Check every process for an oome file and the files of the rules.
+        A directory shared by several of them, or which a glob pattern
+        applies to, is listed once instead of looking for each file in it.
+        """
+        for path, entries in self.directories().items():
+            names = None
+            if len(entries) > 1 or entries[0][1].regex is not None:
+                names = list_directory(path)
+            for oome_process, trigger in entries:
+                if trigger.rule is None:
+                    if oome_process.check_oome_file(names):
+                        self.handle(oome_process)
+                    continue
+                for found in trigger.find(names):
+                    self.fire(oome_process, trigger.rule, found)
+
+    def directories(self):
+        """
+        Group the triggers of all processes by directory.
+
+        :returns: Lists of (OomeProcess, Trigger) by directory name
+        :rtype: dict
+        """
+        directories = {}
+        for oome_process in self.processes.values():
+            try:
+                triggers = oome_process.triggers
+            except (IOError, OSError):
+                # the process is gone or its environment isn't readable
+                continue
+            for trigger in triggers:
+                directories.setdefault(trigger.directory, []).append(
+                    (oome_process, trigger))
+        return directories
+
+    def fire(self, oome_process, rule, path):
+        """
+        Act on a process whose sentinel file was found, and delete the file
+        so the process is acted on again only once it drops a new one.
+
+        :param oome_process: Process whose sentinel file exists
+        :type oome_process: OomeProcess
+        :param rule: Rule the file matches
+        :type rule: TriggerRule
+        :param path: Sentinel file name
+        :type path: str
+        """
+        process = oome_process.process
+        namespec = make_namespec(process['group'], process['name'])
+        if self.dry:
+            self.write_stderr('{0} is detected for {1}, not acting on it due '
+                              'to dry-run'.format(path, namespec))
+            return
+        try:
+            os.remove(path)
+        except OSError as e:
+            self.write_stderr('{0} could not be removed: {1}'.format(path, e))
+        if rule.action == 'restart':
+            self.write_stderr('{0} is detected for {1}, restarting it'.format(
+                path, namespec))
+            self.restarts.submit(process)
+        elif rule.action == 'signal':
             try:
-                self.rpc.supervisor.startProcess(namespec)
+                self.rpc.supervisor.signalProcess(namespec, rule.signal)
             except xmlrpclib.Fault as e:
-                self.write_stderr('Failed to start process %s: %s' % (
+                self.write_stderr('Failed to signal process {0}: {1}'.format(
                     namespec, e))
             else:
-                self.write_stderr('%s restarted' % namespec)
+                self.write_stderr('{0} is detected for {1}, sent it SIG{2}'
+                                  .format(path, namespec, rule.signal))
+        else:
+            self.write_stderr('{0} is detected for {1}'.format(path,
+                                                               namespec))
+            if self.email:
+                self.mail(self.email, 'oome_monitor: {0} is detected for '
+                          '{1}'.format(os.path.basename(path), namespec),
+                          '{0} was detected for the process named {1} at {2}, '
+                          'matching the rule {3}'.format(path, namespec,
+                                                         time.asctime(), rule))
+
+    def mail(self, email, subject, msg):
+        """
+        Send a mail through the sendmail command.
+
+        :param email: Recipient address
+        :type email: str
+        :param subject: Subject of the mail
+        :type subject: str
+        :param msg: Message body
+        :type msg: str
+        """
+        body = 'To: {0}\n'.format(email)
+        body += 'Subject: {0}\n'.format(subject)
+        body += '\n'
+        body += msg
+        with os.popen(self.sendmail, 'w') as m:
+            m.write(body)
+        self.mailed = body
+
+    def start_watcher(self):
+        """
+        Create the inotify instance, unless it is disabled or unavailable
+        (or stdin can't be waited on, as in the tests), in which case oome
+        files are only polled for on TICK events.
+        """
+        if not self.inotify or self.watcher is not None:
+            return
+        try:
+            self.stdin.fileno()
+        except (AttributeError, ValueError, IOError, OSError):
+            return
+        try:
+            self.watcher = inotify.Inotify()
+        except OSError as e:
+            self.inotify = False
+            self.write_stderr('inotify is not available, checking for oome '
+                              'files on TICK events only: {0}'.format(e))
+
+    def watch(self):
+        """
+        Watch the directories of the oome files of all processes.  Watches
+        which can't be added yet, e.g. for a directory which doesn't exist,
+        are retried on the next TICK event.
+        """
+        if self.watcher is None:
+            return
+        wanted = set(self.directories())
+        for path in list(self.watches):
+            if path not in wanted:
+                wd = self.watches.pop(path)
+                self.watched.pop(wd, None)
+                self.watcher.rm_watch(wd)
+        for path in wanted:
+            if path in self.watches:
+                continue
+            try:
+                wd = self.watcher.add_watch(path, WATCH_MASK)
+            except OSError:
+                continue
+            self.watches[path] = wd
+            self.watched[wd] = path
+
+    def on_events(self, events):
+        """
+        Act on the processes whose oome files appeared.
+
+        :param events: Events read from the inotify instance
+        :type events: list
+        """
+        directories = self.directories()
+        for event in events:
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                # events were lost, look at everything
+                self.poll()
+                continue
+            path = self.watched.get(event.wd)
+            if path is None:
+                continue
+            if event.mask & inotify.IN_IGNORED:
+                # the directory went away, watch it again once it's back
+                del self.watched[event.wd]
+                self.watches.pop(path, None)
+                continue
+            # the same file may be reported again after it was handled
+            name = os.path.join(path, event.name)
+            for oome_process, trigger in directories.get(path, []):
+                if not trigger.matches(event.name):
+                    continue
+                if trigger.rule is None:
+                    if oome_process.check_oome_file():
+                        self.handle(oome_process)
+                elif os.path.isfile(name):
+                    self.fire(oome_process, trigger.rule, name)
+
+    def wait(self):
+        """
+        Wait for the next supervisord event like childutils.listener.wait,
+        acting on oome files reported by inotify in the meantime.
+
+        :returns: headers and payload of the event
+        :rtype: tuple
+        """
+        if self.watcher is None:
+            return childutils.listener.wait(self.stdin, self.stdout)
+        childutils.listener.ready(self.stdout)
+        while 1:
+            try:
+                readable = select.select([self.stdin, self.watcher], [], [])[0]
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.watcher in readable:
+                self.on_events(self.watcher.read())
+            if self.stdin in readable:
+                break
+        headers = childutils.get_headers(self.stdin.readline())
+        payload = self.stdin.read(int(headers['len']))
+        return headers, payload
 
-        
     def run(self, test=False):
         """
         Main event loop function of the OomeMonitor
         """
+        self.start_watcher()
+        self.watch()
         while 1:
             # read header and payload
-            headers, payload = childutils.listener.wait(self.stdin, self.stdout)
-            if not headers['eventname'].startswith('TICK'):
-                # do nothing with non-TICK events
+            headers, payload = self.wait()
+            eventname = headers['eventname']
+            if eventname.startswith('PROCESS_STATE'):
+                if self.on_state_change(eventname, payload):
+                    self.watch()
                 childutils.listener.ok(self.stdout)
+                if test:
+                    break
                 continue
-            # For each process check for an oome file and restart it if True
-            for oome_process in self.processes:
-                if oome_process.check_oome_file():
-                    if self.dry:
-                        self.write_stderr(
-                            'oome file is detected for {0}, not restarting due '
-                            'to dry-run'.format(oome_process.process['name']))
-                    else:
-                        # delete the oome file first
-                        oome_process.delete_oome_file()
-                        # restart the process
-                        self.restart(oome_process.process)
-    
+            if not eventname.startswith('TICK'):
+                # do nothing with other events
+                childutils.listener.ok(self.stdout)
+                continue
+            if time.time() - self.reconciled >= self.reconcile_interval:
+                self.reconcile()
+            # report restarts which timed out
+            self.restarts.dispatch()
+            # For each process check for an oome file and restart it if True,
+            # in case an event was missed or inotify isn't available
+            self.poll()
+            self.watch()
+
             # transition from READY to ACKNOWLEDGED
             childutils.listener.ok(self.stdout)
             if test:
+                # let the tests see the outcome of the restarts
+                self.restarts.wait()
                 break
 
 def main():
@@ -252,6 +1267,32 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter)
     dry_run_text = ('do not actually kill or restart the procesesses, '
               'only log the actions.')
+    no_inotify_text = ('only check for oome files on TICK events instead of '
+                       'watching their directories with inotify.')
+    reconcile_text = ('seconds between full reconciliations of the monitored '
+                      'processes with supervisord, in case a PROCESS_STATE '
+                      'event was missed (default: 300).')
+    heap_dump_archive_text = ('move the heap dumps (.hprof files) next to '
+                              'the oome file to this directory before '
+                              'restarting the process.')
+    heap_dump_compression_text = ('compress archived heap dumps in the '
+                                  'background (default: gzip).')
+    max_restarts_text = ('maximum number of processes restarted at once '
+                         '(default: 4).')
+    restart_timeout_text = ('seconds after which the external service script '
+                            'is killed, or a call to supervisord gives up, '
+                            '0 for never (default: 300).')
+    rule_text = ('also act on a process when a file matching PATTERN '
+                 'appears. The pattern may refer to %%(pid)s, '
+                 '%%(cwd)s, %%(name)s, %%(group)s and %%(ENV_<name>)s of the '
+                 'process, and have glob characters in its file name. The '
+                 'action is restart, notify (mail --email) or '
+                 'signal:<name>. Can be given more than once.')
+    email_text = ('mail the sentinel files of notify rules to this '
+                  'address.')
+    sendmail_text = ('the command to mail with, which must accept the '
+                     'headers and message on stdin (default: '
+                     '"/usr/sbin/sendmail -t -i").')
     subparsers = parser.add_subparsers(title='subcommands',
         description='choose one of the subcommands below',
         help='choose to monitor single supervisord process or all of them')
@@ -269,11 +1310,43 @@ def main():
             ' e.g. /etc/init.d/myprogramservicescript.'
         )
     )
+    parser_p.add_argument('--no-inotify', dest='inotify',
+        action='store_false', help=no_inotify_text)
+    parser_p.add_argument('--reconcile-interval', type=int, default=300,
+        help=reconcile_text)
+    parser_p.add_argument('--heap-dump-archive', help=heap_dump_archive_text)
+    parser_p.add_argument('--heap-dump-compression', choices=COMPRESSIONS,
+        default='gzip', help=heap_dump_compression_text)
+    parser_p.add_argument('--max-restarts', type=int, default=4,
+        help=max_restarts_text)
+    parser_p.add_argument('--restart-timeout', type=int, default=300,
+        help=restart_timeout_text)
+    parser_p.add_argument('--rule', dest='rules', action='append',
+        type=parse_rule, metavar='PATTERN=ACTION', help=rule_text)
+    parser_p.add_argument('--email', '-m', help=email_text)
+    parser_p.add_argument('--sendmail-program', '-s', dest='sendmail',
+        default='/usr/sbin/sendmail -t -i', help=sendmail_text)
     parser_a = subparsers.add_parser('all')
     parser_a.add_argument('all', action='store_true',
         help='monitor all supervisor processes.')
     parser_a.add_argument('--dry', '-d', action='store_true',
         help=dry_run_text)
+    parser_a.add_argument('--no-inotify', dest='inotify',
+        action='store_false', help=no_inotify_text)
+    parser_a.add_argument('--reconcile-interval', type=int, default=300,
+        help=reconcile_text)
+    parser_a.add_argument('--heap-dump-archive', help=heap_dump_archive_text)
+    parser_a.add_argument('--heap-dump-compression', choices=COMPRESSIONS,
+        default='gzip', help=heap_dump_compression_text)
+    parser_a.add_argument('--max-restarts', type=int, default=4,
+        help=max_restarts_text)
+    parser_a.add_argument('--restart-timeout', type=int, default=300,
+        help=restart_timeout_text)
+    parser_a.add_argument('--rule', dest='rules', action='append',
+        type=parse_rule, metavar='PATTERN=ACTION', help=rule_text)
+    parser_a.add_argument('--email', '-m', help=email_text)
+    parser_a.add_argument('--sendmail-program', '-s', dest='sendmail',
+        default='/usr/sbin/sendmail -t -i', help=sendmail_text)
     args = parser.parse_args()
     try:
         if len(args.process_name) > 1 and args.oome_file:
@@ -284,11 +1357,17 @@ def main():
     except AttributeError:
         # We don't care if "all" was selected
         pass
+    if args.heap_dump_archive and not os.path.isdir(args.heap_dump_archive):
+        sys.stderr.write('heap dump archive %s is not a directory\n'
+                         % args.heap_dump_archive)
+        sys.stderr.flush()
+        return
     try:
         rpc = childutils.getRPCInterface(os.environ)
         if 'external_service_script' in args:
             # Instantiate an ExternalService class to call the given script
-            ext_service = ExternalService(args.external_service_script)
+            ext_service = ExternalService(args.external_service_script,
+                                          args.restart_timeout or None)
         else:
             ext_service = None
     except KeyError as e:
@@ -302,7 +1381,19 @@ def main():
         sys.stderr.write('os error occurred: %s\n' % e)
         sys.stderr.flush()
         return
-    monitor = OomeMonitor(rpc, ext_service, **vars(args))
+    if args.max_restarts < 1:
+        sys.stderr.write('--max-restarts must be at least 1\n')
+        sys.stderr.flush()
+        return
+    if not args.email and [x for x in args.rules or ()
+                           if x.action == 'notify']:
+        sys.stderr.write('notify rules need an --email address to notify\n')
+        sys.stderr.flush()
+        return
+    monitor = OomeMonitor(rpc, ext_service=ext_service,
+        rpc_factory=lambda: timeout_rpc_interface(os.environ,
+                                                  args.restart_timeout or None),
+        **vars(args))
     monitor.run()
 
 if __name__ == '__main__':
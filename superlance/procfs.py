@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+#
+# Module reads per-process figures straight from a Linux procfs mount (and
+# per-cgroup figures from a cgroup2 mount), so listeners do not have to fork
+# a "ps" for every process they look at.
+#
+
+import os
+import os.path
+
+# os.scandir (Python 3.5 and later) doesn't stat the entries it lists
+scandir = getattr(os, 'scandir', None)
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+try:
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = 100
+
+def cpu_times(fields):
+    """
+    Returns the CPU time of a process from the fields of its stat file, as
+    returned by ProcFS.stat().
+
+    :returns: tuple of the seconds the process spent in user and system
+        mode, the seconds its reaped children did, and its start time in
+        seconds after boot
+    :rtype: tuple
+    """
+    try:
+        utime, stime, cutime, cstime = [int(x) for x in fields[11:15]]
+        start = int(fields[19])
+    except (IndexError, ValueError):
+        return None
+    return (float(utime + stime) / CLK_TCK, float(cutime + cstime) / CLK_TCK,
+            float(start) / CLK_TCK)
+
+class ProcFS(object):
+    """
+    Read-only accessor for a procfs tree.
+
+    Every reader returns None when the process has gone away or the file
+    can't be parsed, so callers can treat vanished pids like any other race.
+    """
+    def __init__(self, root='/proc'):
+        """
+        :param root: mount point of the procfs tree
+        :type root: str
+        """
+        self.root = root
+
+    def path(self, *parts):
+        """
+        Returns the path of a file inside the procfs tree.
+
+        :returns: absolute file name
+        :rtype: str
+        """
+        return os.path.join(self.root, *[str(x) for x in parts])
+
+    def read(self, *parts):
+        """
+        Returns the contents of a file inside the procfs tree.
+
+        :returns: file contents or None if it could not be read
+        :rtype: str
+        """
+        try:
+            with open(self.path(*parts)) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def rss(self, pid):
+        """
+        Returns the resident set size of a process from its statm file.
+
+        :param pid: process id
+        :type pid: int
+        :returns: resident set size in bytes
+        :rtype: int
+        """
+        data = self.read(pid, 'statm')
+        if not data:
+            return None
+        try:
+            return int(data.split()[1]) * PAGE_SIZE
+        except (IndexError, ValueError):
+            return None
+
+    def smaps_rollup(self, pid):
+        """
+        Returns the proportional (PSS) and unique (USS) set sizes of a process
+        along with its RSS and swap usage.  Reads smaps_rollup, or sums up the
+        full smaps file on kernels older than 4.14.
+
+        :param pid: process id
+        :type pid: int
+        :returns: dict with 'rss', 'pss', 'uss' and 'swap' in bytes
+        :rtype: dict
+        """
+        data = self.read(pid, 'smaps_rollup')
+        if data is None:
+            data = self.read(pid, 'smaps')
+        if not data:
+            return None
+        kb = {}
+        for line in data.splitlines():
+            fields = line.split()
+            # mapping headers don't end with a colon; counters do
+            if len(fields) == 3 and fields[0].endswith(':'):
+                key = fields[0][:-1]
+                try:
+                    kb[key] = kb.get(key, 0) + int(fields[1])
+                except ValueError:
+                    continue
+        if 'Pss' not in kb:
+            return None
+        return {
+            'rss': kb.get('Rss', 0) * 1024,
+            'pss': kb['Pss'] * 1024,
+            'uss': (kb.get('Private_Clean', 0) +
+                    kb.get('Private_Dirty', 0)) * 1024,
+            'swap': kb.get('Swap', 0) * 1024,
+        }
+
+    def pids(self):
+        """
+        Returns the ids of all processes currently in the procfs tree.
+
+        :rtype: list
+        """
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        return [int(x) for x in names if x.isdigit()]
+
+    def stat(self, pid):
+        """
+        Returns the fields of a process' stat file following the command
+        name, i.e. stat(pid)[0] is the state and stat(pid)[1] the ppid.
+
+        :param pid: process id
+        :type pid: int
+        :rtype: list
+        """
+        data = self.read(pid, 'stat')
+        if not data:
+            return None
+        # the command name may contain spaces and parentheses itself
+        fields = data[data.rfind(')') + 1:].split()
+        if len(fields) < 2:
+            return None
+        return fields
+
+    def ppids(self):
+        """
+        Returns a snapshot of the parent of every process on the host.
+
+        :returns: dict mapping pid to ppid
+        :rtype: dict
+        """
+        ppids = {}
+        for pid in self.pids():
+            fields = self.stat(pid)
+            if fields is not None:
+                ppids[pid] = int(fields[1])
+        return ppids
+
+    def meminfo(self):
+        """
+        Returns the host's memory counters from /proc/meminfo.
+
+        :returns: dict mapping counter names to bytes (or plain counts for
+            the few counters without a unit)
+        :rtype: dict
+        """
+        data = self.read('meminfo')
+        if not data:
+            return None
+        return parse_counters(data)
+
+    def status(self, pid):
+        """
+        Returns the numeric fields of a process' status file, e.g. VmRSS
+        and VmSwap.  Kernel threads have no Vm* fields.
+
+        :param pid: process id
+        :type pid: int
+        :returns: dict mapping field names to bytes (or plain counts for
+            the fields without a unit)
+        :rtype: dict
+        """
+        data = self.read(pid, 'status')
+        if not data:
+            return None
+        return parse_counters(data)
+
+    def pressure(self, resource='memory'):
+        """
+        Returns the pressure stall information (PSI) of a resource.
+
+        :param resource: 'memory', 'cpu' or 'io'
+        :type resource: str
+        :returns: dict mapping 'some' and 'full' to dicts of their 'avg10',
+            'avg60' and 'avg300' percentages
+        :rtype: dict
+        """
+        data = self.read('pressure', resource)
+        if not data:
+            return None
+        pressure = {}
+        for line in data.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            averages = {}
+            for field in fields[1:]:
+                key, _, value = field.partition('=')
+                if key.startswith('avg'):
+                    try:
+                        averages[key] = float(value)
+                    except ValueError:
+                        continue
+            pressure[fields[0]] = averages
+        return pressure
+
+    def io(self, pid):
+        """
+        Returns the I/O counters of a process, e.g. read_bytes and
+        write_bytes (the bytes it made the storage layer read or write).
+        Only readable for processes we may ptrace.
+
+        :param pid: process id
+        :type pid: int
+        :returns: dict mapping counter names to values
+        :rtype: dict
+        """
+        data = self.read(pid, 'io')
+        if not data:
+            return None
+        return parse_counters(data)
+
+    def fd_count(self, pid):
+        """
+        Returns the number of open file descriptors of a process.  Counts
+        the entries of its fd directory without looking at them.
+
+        :param pid: process id
+        :type pid: int
+        :rtype: int
+        """
+        path = self.path(pid, 'fd')
+        try:
+            if scandir is None:
+                return len(os.listdir(path))
+            it = scandir(path)
+            try:
+                count = 0
+                for entry in it:
+                    count += 1
+                return count
+            finally:
+                close = getattr(it, 'close', None)
+                if close is not None:
+                    close()
+        except OSError:
+            return None
+
+    def limits(self, pid):
+        """
+        Returns the soft resource limits of a process.
+
+        :param pid: process id
+        :type pid: int
+        :returns: dict mapping limit names (e.g. 'Max open files') to their
+            soft limit, None if it is unlimited
+        :rtype: dict
+        """
+        data = self.read(pid, 'limits')
+        if not data:
+            return None
+        limits = {}
+        for line in data.splitlines()[1:]:
+            # the names contain spaces; the columns are two or more apart
+            fields = [x for x in line.split('  ') if x.strip()]
+            if len(fields) < 3:
+                continue
+            soft = fields[1].strip()
+            if soft == 'unlimited':
+                limits[fields[0].strip()] = None
+                continue
+            try:
+                limits[fields[0].strip()] = int(soft)
+            except ValueError:
+                continue
+        return limits
+
+    def cgroup(self, pid):
+        """
+        Returns the cgroup v2 path a process belongs to.
+
+        :param pid: process id
+        :type pid: int
+        :returns: path relative to the cgroup2 mount, e.g. '/app.slice/foo'
+        :rtype: str
+        """
+        data = self.read(pid, 'cgroup')
+        if not data:
+            return None
+        for line in data.splitlines():
+            # the unified hierarchy is the one with id 0 and no controllers
+            if line.startswith('0::'):
+                return line[3:]
+        return None
+
+def parse_counters(data):
+    """
+    Parses "Name:   value [kB]" lines as found in meminfo and status files.
+    Lines without a numeric value are skipped.
+
+    :returns: dict mapping names to bytes (or plain counts for the values
+        without a unit)
+    :rtype: dict
+    """
+    counters = {}
+    for line in data.splitlines():
+        fields = line.split()
+        try:
+            value = int(fields[1])
+        except (IndexError, ValueError):
+            continue
+        if len(fields) > 2 and fields[2] == 'kB':
+            value *= 1024
+        counters[fields[0].rstrip(':')] = value
+    return counters
+
+class CgroupFS(object):
+    """
+    Read-only accessor for the memory controller files of a cgroup v2
+    hierarchy.  Readers return None for cgroups which have gone away.
+    """
+    def __init__(self, root='/sys/fs/cgroup'):
+        """
+        :param root: mount point of the cgroup2 filesystem
+        :type root: str
+        """
+        self.root = root
+
+    def read(self, path, name):
+        """
+        Returns the contents of a control file of a cgroup.
+
+        :param path: cgroup path as returned by ProcFS.cgroup()
+        :type path: str
+        :returns: file contents or None if it could not be read
+        :rtype: str
+        """
+        try:
+            with open(os.path.join(self.root, path.lstrip('/'), name)) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def memory_current(self, path):
+        """
+        Returns the memory charged to a cgroup, page cache included.
+
+        :rtype: int
+        """
+        data = self.read(path, 'memory.current')
+        try:
+            return int(data)
+        except (TypeError, ValueError):
+            return None
+
+    def memory_max(self, path):
+        """
+        Returns the hard memory limit of a cgroup.
+
+        :returns: limit in bytes or None if the cgroup is unlimited
+        :rtype: int
+        """
+        data = self.read(path, 'memory.max')
+        try:
+            return int(data)
+        except (TypeError, ValueError):
+            # "max" or no memory controller enabled for this cgroup
+            return None
+
+    def memory_limit(self, path):
+        """
+        Returns the effective memory limit of a cgroup, which is the lowest
+        memory.max of the cgroup and its ancestors.
+
+        :returns: limit in bytes or None if none of them is limited
+        :rtype: int
+        """
+        limit = None
+        path = path.rstrip('/')
+        while path:
+            value = self.memory_max(path)
+            if value is not None and (limit is None or value < limit):
+                limit = value
+            path = path[:path.rfind('/')]
+        return limit
+
+    def memory_stat(self, path):
+        """
+        Returns the counters of a cgroup's memory.stat file.
+
+        :returns: dict mapping counter names to values (mostly bytes)
+        :rtype: dict
+        """
+        data = self.read(path, 'memory.stat')
+        if not data:
+            return None
+        stat = {}
+        for line in data.splitlines():
+            try:
+                key, value = line.split()
+                stat[key] = int(value)
+            except ValueError:
+                continue
+        return stat
+
+def default_cgroupfs():
+    """
+    Returns a CgroupFS for the running host or None if it has no cgroup v2
+    hierarchy mounted.
+
+    :rtype: CgroupFS
+    """
+    cgroupfs = CgroupFS()
+    if os.path.isfile(os.path.join(cgroupfs.root, 'cgroup.controllers')):
+        return cgroupfs
+    return None
+
+def default_procfs():
+    """
+    Returns a ProcFS for the running host or None if there is no usable
+    procfs (e.g. on OS X).
+
+    :rtype: ProcFS
+    """
+    procfs = ProcFS()
+    if os.path.isfile(procfs.path('self', 'statm')):
+        return procfs
+    return None
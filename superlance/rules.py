@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+#
+# Module holds what the listeners checking supervisord's processes against
+# -p, -g and -a limits have in common: the rule table the limits are looked
+# up in, the per-process state for acting on sustained breaches and trends,
+# the parsing of their options, and restarting a process and mailing about
+# it.
+#
+
+import os
+import re
+import time
+from array import array
+from fnmatch import translate
+from superlance.compat import xmlrpclib
+
+from supervisor import childutils
+from supervisor.datatypes import byte_size, SuffixMultiplier
+
+class ProcessTree:
+    """A snapshot of the host's process table, indexed from parent to
+    children once so that any subtree can be walked in linear time."""
+    def __init__(self, ppids, rss=None):
+        self.ppids = ppids
+        self.rss = rss
+        self.children = {}
+        for pid, ppid in ppids.items():
+            self.children.setdefault(ppid, []).append(pid)
+
+    def subtree(self, pid):
+        """Return pid followed by all of its descendants, or None if pid
+        isn't in the snapshot."""
+        if pid not in self.ppids:
+            return None
+        pids = [pid]
+        # pids grows while we walk it; each process is visited exactly once
+        for parent in pids:
+            pids.extend(self.children.get(parent, ()))
+        return pids
+
+class SampleRing:
+    """The last few (time, bytes) samples of a process, kept in fixed-size
+    arrays so memory use stays the same however long the process runs."""
+    def __init__(self, size, pid=None):
+        self.pid = pid
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        self.count = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, when, value):
+        self.times[self.next] = when
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def slope(self):
+        """Return the growth rate in bytes per second as a least squares
+        fit over the samples, or None if it can't be determined."""
+        n = self.count
+        if n < 2:
+            return None
+        # a least squares fit doesn't care about the order of the samples,
+        # so there's no need to unwind the ring
+        times = self.times[:n]
+        values = self.values[:n]
+        mean_time = sum(times) / n
+        mean_value = sum(values) / n
+        covariance = 0.0
+        variance = 0.0
+        for t, v in zip(times, values):
+            covariance += (t - mean_time) * (v - mean_value)
+            variance += (t - mean_time) ** 2
+        if not variance:
+            return None
+        return covariance / variance
+
+class Limit(int):
+    """A byte size along with the rules for acting on it: restart only when
+    the process was over it in `sustain` of its last `window` samples, and
+    keep counting samples as over until it drops to the `rearm` size.  With
+    a `soft` size, signal the process when it goes over that first and only
+    restart it if it is still over the limit after the cool-down."""
+    def __new__(cls, size, sustain=1, window=1, rearm=None, soft=None):
+        self = int.__new__(cls, size)
+        self.sustain = sustain
+        self.window = window
+        self.rearm = size if rearm is None else rearm
+        self.soft = soft
+        return self
+
+    def __str__(self):
+        spec = [int.__repr__(self)]
+        if self.window > 1:
+            spec.append('sustain=%d/%d' % (self.sustain, self.window))
+        if self.rearm != self:
+            spec.append('rearm=%d' % self.rearm)
+        if self.soft is not None:
+            spec.append('soft=%d' % self.soft)
+        return ','.join(spec)
+
+class Percentage(float):
+    """A limit given as a percentage of a total, e.g. of the memory
+    available to the programs of supervisord."""
+    def __str__(self):
+        return '%g%%' % self
+
+    def of(self, total):
+        return int(total * self / 100)
+
+class BreachState(object):
+    """Per-process record of the most recent samples that were over the
+    limit, one bit per sample."""
+    __slots__ = ('pid', 'bits', 'over')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.bits = 0
+        self.over = False
+
+    def update(self, value, limit, rearm, window):
+        """Record a sample and return in how many of the last `window`
+        samples the process was over the limit."""
+        return self.record(value > limit or (self.over and value > rearm),
+                           window)
+
+    def record(self, over, window):
+        """Record whether the process was over its limit in a sample and
+        return in how many of the last `window` samples it was."""
+        self.over = over
+        self.bits = ((self.bits << 1) | over) & ((1 << window) - 1)
+        return bin(self.bits).count('1')
+
+class RuleTable:
+    """The -p, -g and -a limits compiled into a lookup table.  Patterns
+    are only matched the first time a process is looked up; after that,
+    the limit of a process is a dict lookup until the process list changes."""
+    def __init__(self, programs, groups, any):
+        self.programs = {}
+        self.program_patterns = []
+        self.groups = {}
+        self.group_patterns = []
+        self.any = any
+        for names, patterns, rules in (
+                (self.programs, self.program_patterns, programs),
+                (self.groups, self.group_patterns, groups)):
+            # sorted, so that overlapping patterns always match in one order
+            for name in sorted(rules):
+                pattern = compile_pattern(name)
+                if pattern is None:
+                    names[name] = rules[name]
+                else:
+                    patterns.append((pattern, rules[name]))
+        self.cache = {}
+        self.processes = None
+
+    def refresh(self, processes):
+        """Forget the cached lookups when the process list changed."""
+        processes = frozenset(processes)
+        if processes != self.processes:
+            self.cache = {}
+            self.processes = processes
+
+    def lookup(self, name, group, pname):
+        try:
+            return self.cache[pname]
+        except KeyError:
+            limit = self.cache[pname] = self.match(name, group, pname)
+            return limit
+
+    def match(self, name, group, pname):
+        for n in pname, name:
+            if n in self.programs:
+                return self.programs[n]
+        for pattern, limit in self.program_patterns:
+            if pattern.match(pname) or pattern.match(name):
+                return limit
+        if group in self.groups:
+            return self.groups[group]
+        for pattern, limit in self.group_patterns:
+            if pattern.match(group):
+                return limit
+        return self.any
+
+def compile_pattern(name):
+    """Compile a 're:' prefixed regular expression or a glob pattern into
+    a regular expression matching whole names.  Returns None for plain
+    names."""
+    if name.startswith('re:'):
+        return re.compile('(?:%s)\\Z' % name[3:])
+    if [c for c in '*?[' if c in name]:
+        return re.compile(translate(name))
+    return None
+
+class RuleListener:
+    """The event loop of a listener which checks supervisord's processes
+    against their limits on every TICK, the sustain and rearm rules of the
+    limits, and restarting a process along with mailing about it.
+    Subclasses implement tick(), and set `listener` to their name and
+    `because` to the reason they restart processes for, for the messages
+    and mails."""
+    listener = None
+    because = None
+
+    def runforever(self, test=False):
+        while 1:
+            # we explicitly use self.stdin, self.stdout, and self.stderr
+            # instead of sys.* so we can unit test this code
+            headers, payload = childutils.listener.wait(self.stdin, self.stdout)
+
+            if not headers['eventname'].startswith('TICK'):
+                # do nothing with non-TICK events
+                childutils.listener.ok(self.stdout)
+                if test:
+                    break
+                continue
+
+            status = self.status()
+            if status:
+                self.stderr.write('\n'.join(status) + '\n')
+            self.tick()
+
+            self.stderr.flush()
+            childutils.listener.ok(self.stdout)
+            if test:
+                break
+
+    def status(self):
+        """Return the lines logged on every TICK about what is checked."""
+        status = []
+        if self.programs:
+            keys = sorted(self.programs.keys())
+            status.append(
+                'Checking programs %s' % ', '.join(
+                [ '%s=%s' % (k, self.programs[k]) for k in keys ])
+                )
+
+        if self.groups:
+            keys = sorted(self.groups.keys())
+            status.append(
+                'Checking groups %s' % ', '.join(
+                [ '%s=%s' % (k, self.groups[k]) for k in keys ])
+                )
+        if self.any is not None:
+            status.append('Checking any=%s' % self.any)
+        return status
+
+    def tick(self):
+        """Check the processes against their limits and act on the ones
+        over them.  This is abstract: every listener measures something
+        else, so subclasses must implement it."""
+        raise NotImplementedError
+
+    def states(self):
+        """Return the dicts of per-process state, keyed by process name."""
+        return (self.breaches,)
+
+    def forget(self, seen):
+        """Drop the state of the processes not in `seen`."""
+        for table in self.states():
+            for pname in list(table):
+                if pname not in seen:
+                    del table[pname]
+
+    def breached(self, name, pid, value, limit, over=None):
+        """Return True if the process went over its limit in enough of its
+        recent samples.  Once over the limit, samples keep counting as over
+        until `value` drops to the limit's re-arm size.  A limit made of
+        several (e.g. fds and threads) is checked by the listener, which
+        passes whether the process is over any of them as `over` instead
+        of a `value`."""
+        sustain = getattr(limit, 'sustain', 1)
+        window = getattr(limit, 'window', 1)
+        rearm = getattr(limit, 'rearm', limit)
+        if sustain == 1 and rearm == limit:
+            # no state needed for the plain "restart when over" rule
+            return value > limit if over is None else over
+        state = self.breaches.get(name)
+        if state is None or state.pid != pid:
+            state = self.breaches[name] = BreachState(pid)
+        if over is None:
+            count = state.update(value, limit, rearm, window)
+        else:
+            count = state.record(over, window)
+        if count >= sustain:
+            return True
+        if state.over:
+            self.stderr.write('%s was over its limits in %d of the last %d '
+                              'samples\n' % (name, count, window))
+        return False
+
+    def restart(self, name, reason, info):
+        """Stop and start a process.  The listener exits, by raising the
+        fault, if the process can't be stopped or started."""
+        self.stderr.write('Restarting %s\n' % name)
+        try:
+            self.rpc.supervisor.stopProcess(name)
+        except xmlrpclib.Fault as e:
+            msg = ('Failed to stop process %s (%s), exiting: %s' %
+                   (name, reason, e))
+            self.stderr.write(str(msg))
+            if self.email:
+                subject = '%s: failed to stop process %s, exiting' % (
+                    self.label(), name)
+                self.mail(self.email, subject, msg)
+            raise
+
+        try:
+            self.rpc.supervisor.startProcess(name)
+        except xmlrpclib.Fault as e:
+            msg = ('Failed to start process %s after stopping it, '
+                   'exiting: %s' % (name, e))
+            self.stderr.write(str(msg))
+            if self.email:
+                subject = '%s: failed to start process %s, exiting' % (
+                    self.label(), name)
+                self.mail(self.email, subject, msg)
+            raise
+
+        # a new process starts with a clean slate
+        for table in self.states():
+            table.pop(name, None)
+
+        msg = ('%s.py restarted the process named %s at %s because %s '
+               '(%s)' % (self.listener, name, time.asctime(), self.because,
+                         reason))
+        self.notify(name, 'process %s restarted' % name, msg, info)
+
+    def notify(self, name, subject, msg, info):
+        """Mail about an action taken on a process, unless its uptime is
+        over the email uptime limit."""
+        uptime = info['now'] - info['start'] #uptime in seconds
+        if self.email and uptime <= self.email_uptime_limit:
+            self.mail(self.email, '%s: %s' % (self.label(), subject), msg)
+
+    def label(self):
+        """Return the listener's name, and the -n name if given, for the
+        mail subjects."""
+        name = getattr(self, '%sName' % self.listener)
+        return '%s%s' % (self.listener, name and " [%s]" % name or "")
+
+    def mail(self, email, subject, msg):
+        body = 'To: %s\n' % self.email
+        body += 'Subject: %s\n' % subject
+        body += '\n'
+        body += msg
+        with os.popen(self.sendmail, 'w') as m:
+            m.write(body)
+        self.mailed = body
+
+# The option parsers print what's wrong and call the listener's usage(),
+# which exits.
+
+def parse_namelimit(option, value, usage, parse_limit):
+    """Parse a name=limit pair, the name being a plain name, a glob
+    pattern or a 're:' prefixed regular expression and the limit being
+    parsed by `parse_limit`."""
+    try:
+        name, limit = value.split('=', 1)
+    except ValueError:
+        print('Unparseable value %r for %r' % (value, option))
+        usage()
+    try:
+        compile_pattern(name)
+    except re.error as e:
+        print('Unparseable regular expression %r for %r: %s' % (
+            name, option, e))
+        usage()
+    limit = parse_limit(option, limit)
+    return name, limit
+
+def parse_sustain(option, value, usage, rule):
+    """Parse the N/M of a sustain=N/M rule in `value` into (N, M)."""
+    try:
+        sustain, window = [int(x) for x in rule.split('/')]
+    except ValueError:
+        sustain = window = 0
+    if not 0 < sustain <= window <= 64:
+        print('Unparseable sustain=N/M in %r for %r, N and M must '
+              'satisfy 0 < N <= M <= 64' % (value, option))
+        usage()
+    return sustain, window
+
+def parse_percentage(option, value, usage):
+    """Parse a percentage above 0 and up to 100, followed by '%'."""
+    try:
+        size = Percentage(value[:-1])
+    except ValueError:
+        size = None
+    if size is None or not value.endswith('%') or not 0 < size <= 100:
+        print('Unparseable percentage in %r for %r' % (value, option))
+        usage()
+    return size
+
+def parse_byte_size(option, value, usage):
+    try:
+        size = byte_size(value)
+    except:
+        print('Unparseable byte_size in %r for %r' % (value, option))
+        usage()
+
+    return size
+
+def parse_count(option, value, usage, minimum=1):
+    try:
+        count = int(value)
+    except ValueError:
+        count = None
+    if count is None or count < minimum:
+        print('Expected an integer of at least %s in %r for %s' % (
+            minimum, value, option))
+        usage()
+    return count
+
+seconds_size = SuffixMultiplier({'s': 1,
+                                 'm': 60,
+                                 'h': 60 * 60,
+                                 'd': 60 * 60 * 24
+                                 })
+
+def parse_seconds(option, value, usage):
+    try:
+        seconds = seconds_size(value)
+    except:
+        print('Unparseable value for time in %r for %s' % (value, option))
+        usage()
+    return seconds
@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from superlance.compat import StringIO
+from superlance.compat import maxint
+from superlance.cpumon import cpumon_from_args
+from superlance.procfs import CLK_TCK
+from superlance.tests.dummy import DummyRPCServer
+
+class CpumonTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.cpumon import Cpumon
+        return Cpumon
+
+    def _makeOne(self, *opts):
+        return self._getTargetClass()(*opts)
+
+    def _makeProcFS(self):
+        from superlance.procfs import ProcFS
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        return ProcFS(root)
+
+    def _writeStat(self, procfs, pid, ppid, seconds, reaped=0, start=1000):
+        path = procfs.path(pid)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        with open(os.path.join(path, 'stat'), 'w') as f:
+            f.write('%d (a (b) c) R %d %s %d 0 %d 0 20 0 1 0 %d\n' % (
+                pid, ppid, ' '.join(['0'] * 9), seconds * CLK_TCK,
+                reaped * CLK_TCK, start))
+
+    def _makeOnePopulated(self, programs, groups, any):
+        rpc = DummyRPCServer()
+        cumulative = False
+        sendmail = 'cat - > /dev/null'
+        email = 'chrism@plope.com'
+        name = 'test'
+        uptime_limit = 2000
+        procfs = self._makeProcFS()
+        cpumon = self._makeOne(cumulative, programs, groups, any, sendmail,
+                               email, uptime_limit, name, rpc, procfs)
+        cpumon.stdin = StringIO()
+        cpumon.stdout = StringIO()
+        cpumon.stderr = StringIO()
+        for pid in 11, 12:
+            self._writeStat(procfs, pid, 1, 0)
+        return cpumon
+
+    def _tick(self, cpumon, elapsed=10):
+        # pretend the previous tick was `elapsed` seconds ago
+        self.now = getattr(self, 'now', 1000000) + elapsed
+        cpumon.stdin = StringIO('eventname:TICK len:0\n')
+        cpumon.stderr = StringIO()
+        with mock.patch('superlance.cpumon.time.time', return_value=self.now):
+            cpumon.runforever(test=True)
+        return cpumon.stderr.getvalue().split('\n')
+
+    def test_runforever_notatick(self):
+        cpumon = self._makeOnePopulated({'foo': 0}, {}, None)
+        cpumon.stdin.write('eventname:NOTATICK len:0\n')
+        cpumon.stdin.seek(0)
+        cpumon.runforever(test=True)
+        self.assertEqual(cpumon.stderr.getvalue(), '')
+
+    def test_runforever_tick_programs(self):
+        cpumon = self._makeOnePopulated({'foo': 50, 'bar': maxint}, {}, None)
+        lines = self._tick(cpumon)
+        self.assertEqual(lines, ['Checking programs bar=%s, foo=50' % maxint,
+                                 ''])
+        self._writeStat(cpumon.procfs, 11, 1, 8)
+        self._writeStat(cpumon.procfs, 12, 1, 1)
+        lines = self._tick(cpumon)
+        self.assertEqual(lines[1], 'CPU of foo:foo is 80.0%')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.assertEqual(lines[3], 'CPU of bar:bar is 10.0%')
+        self.assertEqual(len(lines), 5)
+        mailed = cpumon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: cpumon [test]: process foo:foo restarted')
+        self.assertTrue(mailed[3].startswith('cpumon.py restarted'))
+
+    def test_runforever_tick_groups_and_any(self):
+        cpumon = self._makeOnePopulated({}, {'foo': 90}, 5)
+        self._tick(cpumon)
+        self._writeStat(cpumon.procfs, 11, 1, 8)
+        self._writeStat(cpumon.procfs, 12, 1, 1)
+        lines = self._tick(cpumon)
+        self.assertEqual(lines[0], 'Checking groups foo=90')
+        self.assertEqual(lines[1], 'Checking any=5')
+        self.assertEqual(lines[2], 'CPU of foo:foo is 80.0%')
+        self.assertEqual(lines[3], 'CPU of bar:bar is 10.0%')
+        self.assertEqual(lines[4], 'Restarting bar:bar')
+
+    def test_runforever_sustained(self):
+        from superlance.cpumon import parse_limit
+        cpumon = self._makeOnePopulated({'foo': parse_limit('-p', '50,sustain=2/3')},
+                                        {}, None)
+        cpumon.rpc.supervisor.all_process_info = \
+            cpumon.rpc.supervisor.all_process_info[:1]
+        self._tick(cpumon)
+        self._writeStat(cpumon.procfs, 11, 1, 10)
+        lines = self._tick(cpumon)
+        self.assertEqual(lines[2], 'foo:foo was over its limits in 1 of the '
+                                   'last 3 samples')
+        self._writeStat(cpumon.procfs, 11, 1, 11)
+        lines = self._tick(cpumon)
+        self.assertEqual(len(lines), 3)
+        self._writeStat(cpumon.procfs, 11, 1, 21)
+        lines = self._tick(cpumon)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def test_runforever_new_process(self):
+        cpumon = self._makeOnePopulated({'foo': 50}, {}, None)
+        self._tick(cpumon)
+        # same pid, but started anew: no usage until the next tick
+        self._writeStat(cpumon.procfs, 11, 1, 8, start=2000)
+        lines = self._tick(cpumon)
+        self.assertEqual(len(lines), 2)
+
+    def test_cpu_time_cumulative(self):
+        cpumon = self._makeOnePopulated({}, {}, None)
+        cpumon.cumulative = True
+        self._writeStat(cpumon.procfs, 11, 1, 1, reaped=2)
+        self._writeStat(cpumon.procfs, 13, 11, 3)
+        self._writeStat(cpumon.procfs, 14, 13, 4, reaped=5)
+        self.assertEqual((15.0, 1000.0 / CLK_TCK), cpumon.cpu_time(11))
+        self.assertEqual(None, cpumon.cpu_time(99))
+
+    def test_stopprocess_fails_to_stop(self):
+        cpumon = self._makeOnePopulated({'BAD_NAME': 0}, {}, None)
+        info = dict(cpumon.rpc.supervisor.all_process_info[0])
+        info.update(name='BAD_NAME', group='BAD_NAME')
+        cpumon.rpc.supervisor.all_process_info = [info]
+        self._tick(cpumon)
+        self._writeStat(cpumon.procfs, 11, 1, 1)
+        from superlance.compat import xmlrpclib
+        self.assertRaises(xmlrpclib.Fault, self._tick, cpumon)
+        lines = cpumon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[2], 'Restarting BAD_NAME:BAD_NAME')
+        self.assertTrue(lines[3].startswith('Failed'))
+        mailed = cpumon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+          'Subject: cpumon [test]: failed to stop process BAD_NAME:BAD_NAME, exiting')
+
+    def test_parse_limit(self):
+        from superlance.cpumon import parse_limit
+        self.assertEqual(parse_limit('-a', '90'), 90)
+        self.assertEqual(parse_limit('-a', '250%'), 250)
+        limit = parse_limit('-a', '90,sustain=3/5,rearm=50')
+        self.assertEqual((limit.sustain, limit.window, limit.rearm),
+                         (3, 5, 50))
+        self.assertEqual(str(limit), '90,sustain=3/5,rearm=50')
+        self.assertRaises(SystemExit, parse_limit, '-a', 'lots')
+        self.assertRaises(SystemExit, parse_limit, '-a', '50,rearm=90')
+
+    def test_argparser(self):
+        self.assertEqual(cpumon_from_args(['-h']), None)
+        arguments = ['-c',
+                     '-p', 'foo=90',
+                     '-g', 'bar=50,sustain=2/3',
+                     '--any', '250',
+                     '-s', 'mutt',
+                     '-m', 'me@you.com',
+                     '-u', '1d',
+                     '-n', 'myproject']
+        cpumon = cpumon_from_args(arguments)
+        self.assertEqual(cpumon.cumulative, True)
+        self.assertEqual(cpumon.programs, {'foo': 90})
+        self.assertEqual(cpumon.groups['bar'].sustain, 2)
+        self.assertEqual(cpumon.any, 250)
+        self.assertEqual(cpumon.sendmail, 'mutt')
+        self.assertEqual(cpumon.email, 'me@you.com')
+        self.assertEqual(cpumon.email_uptime_limit, 1 * 24 * 60 * 60)
+        self.assertEqual(cpumon.cpumonName, 'myproject')
+
+if __name__ == '__main__':
+    unittest.main()
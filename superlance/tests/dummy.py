@@ -1,7 +1,7 @@
 class DummyRPCServer:
     def __init__(self):
         self.supervisor = DummySupervisorRPCNamespace()
-        self.system = DummySystemRPCNamespace()
+        self.system = DummySystemRPCNamespace(self)
 
 class DummyResponse:
     status = 200
@@ -11,7 +11,24 @@ class DummyResponse:
         return self.body
 
 class DummySystemRPCNamespace:
-    pass
+    def __init__(self, server=None):
+        self.server = server
+        self.multicalls = []
+
+    def multicall(self, calls):
+        # like supervisord: the value of each call, or a fault struct
+        from superlance.compat import xmlrpclib
+        self.multicalls.append(calls)
+        results = []
+        for call in calls:
+            namespace, method = call['methodName'].split('.', 1)
+            func = getattr(getattr(self.server, namespace), method)
+            try:
+                results.append(func(*call['params']))
+            except xmlrpclib.Fault as e:
+                results.append({'faultCode': e.faultCode,
+                                'faultString': e.faultString})
+        return results
 
 
 import time
@@ -81,6 +98,14 @@ class DummySupervisorRPCNamespace:
             raise xmlrpclib.Fault(xmlrpc.Faults.SPAWN_ERROR, 'SPAWN_ERROR')
         return True
 
+    def signalProcess(self, name, signal):
+        from supervisor import xmlrpc
+        from superlance.compat import xmlrpclib
+        if name.endswith('NOT_RUNNING'):
+            raise xmlrpclib.Fault(xmlrpc.Faults.NOT_RUNNING, 'NOT_RUNNING')
+        self.signalled = getattr(self, 'signalled', []) + [(name, signal)]
+        return True
+
     def stopProcess(self, name):
         from supervisor import xmlrpc
         from superlance.compat import xmlrpclib
@@ -90,3 +115,49 @@ class DummySupervisorRPCNamespace:
             raise xmlrpclib.Fault(xmlrpc.Faults.FAILED, 'FAILED')
         return True
 
+
+class DummyProcessTableRPCNamespace(DummySupervisorRPCNamespace):
+    """A supervisord running one RUNNING program per pid, for benchmarks.
+    Counts the calls made to it by method name."""
+    def __init__(self, pids):
+        self.all_process_info = []
+        self.by_name = {}
+        self.calls = {}
+        for i, pid in enumerate(pids):
+            info = {
+                'name':'prog_%05d' % i,
+                'group':'group_%03d' % (i // 100),
+                'pid':pid,
+                'state':ProcessStates.RUNNING,
+                'statename':'RUNNING',
+                'start':_NOW - 100,
+                'stop':0,
+                'spawnerr':'',
+                'now':_NOW,
+                'description':'pid %d, uptime 0:01:40' % pid,
+                }
+            self.all_process_info.append(info)
+            self.by_name['%s:%s' % (info['group'], info['name'])] = info
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def getAllProcessInfo(self):
+        self.count('getAllProcessInfo')
+        return self.all_process_info
+
+    def getProcessInfo(self, name):
+        self.count('getProcessInfo')
+        return self.by_name.get(name)
+
+    def startProcess(self, name):
+        self.count('startProcess')
+        return True
+
+    def stopProcess(self, name):
+        self.count('stopProcess')
+        return True
+
+    def signalProcess(self, name, signal):
+        self.count('signalProcess')
+        return True
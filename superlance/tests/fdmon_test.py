@@ -0,0 +1,195 @@
+import os
+import shutil
+import tempfile
+import unittest
+from superlance.compat import StringIO
+from superlance.fdmon import fdmon_from_args
+from superlance.tests.dummy import DummyRPCServer
+
+LIMITS = """\
+Limit                     Soft Limit           Hard Limit           Units
+Max cpu time              unlimited            unlimited            seconds
+Max processes             63704                63704                processes
+Max open files            %s                 4096                 files
+"""
+
+class FdmonTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.fdmon import Fdmon
+        return Fdmon
+
+    def _makeOne(self, *opts, **kw):
+        return self._getTargetClass()(*opts, **kw)
+
+    def _makeProcFS(self):
+        from superlance.procfs import ProcFS
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        return ProcFS(root)
+
+    def _writeProcess(self, procfs, pid, fds, threads=None, nofile=1024):
+        path = procfs.path(pid)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.join(path, 'fd'))
+        for fd in range(fds):
+            os.symlink('/dev/null', os.path.join(path, 'fd', str(fd)))
+        if threads is not None:
+            with open(os.path.join(path, 'status'), 'w') as f:
+                f.write('Name:\tjava\nState:\tS (sleeping)\nThreads:\t%d\n'
+                        % threads)
+        with open(os.path.join(path, 'limits'), 'w') as f:
+            f.write(LIMITS % nofile)
+
+    def _makeOnePopulated(self, programs, groups, any, **kw):
+        rpc = DummyRPCServer()
+        sendmail = 'cat - > /dev/null'
+        email = 'chrism@plope.com'
+        name = 'test'
+        uptime_limit = 2000
+        procfs = self._makeProcFS()
+        fdmon = self._makeOne(programs, groups, any, sendmail, email,
+                              uptime_limit, name, rpc, procfs, **kw)
+        fdmon.stdin = StringIO()
+        fdmon.stdout = StringIO()
+        fdmon.stderr = StringIO()
+        fdmon.rpc.supervisor.all_process_info = \
+            fdmon.rpc.supervisor.all_process_info[:2]
+        self._writeProcess(procfs, 11, 10, threads=4)
+        self._writeProcess(procfs, 12, 20, threads=40)
+        return fdmon
+
+    def _tick(self, fdmon):
+        fdmon.stdin = StringIO('eventname:TICK len:0\n')
+        fdmon.stderr = StringIO()
+        fdmon.runforever(test=True)
+        return fdmon.stderr.getvalue().split('\n')
+
+    def test_runforever_notatick(self):
+        fdmon = self._makeOnePopulated({}, {}, None)
+        fdmon.stdin.write('eventname:NOTATICK len:0\n')
+        fdmon.stdin.seek(0)
+        fdmon.runforever(test=True)
+        self.assertEqual(fdmon.stderr.getvalue(), '')
+
+    def test_runforever_tick_programs(self):
+        from superlance.fdmon import parse_limit
+        fdmon = self._makeOnePopulated({'foo': parse_limit('-p', '15'),
+                                        'bar': parse_limit('-p', '15')},
+                                       {}, None)
+        lines = self._tick(fdmon)
+        self.assertEqual(lines[0], 'Checking programs bar=15, foo=15')
+        self.assertEqual(lines[1], 'foo:foo has 10 fds and 4 threads')
+        self.assertEqual(lines[2], 'bar:bar has 20 fds and 40 threads')
+        self.assertEqual(lines[3], 'Restarting bar:bar')
+        self.assertEqual(len(lines), 5)
+        mailed = fdmon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: fdmon [test]: process bar:bar restarted')
+        self.assertTrue(mailed[3].endswith('(20 fds, over 15)'))
+
+    def test_runforever_threads(self):
+        from superlance.fdmon import parse_limit
+        fdmon = self._makeOnePopulated({}, {}, parse_limit('-a', 'threads=30'))
+        lines = self._tick(fdmon)
+        self.assertEqual(lines[0], 'Checking any=threads=30')
+        self.assertEqual(lines[3], 'Restarting bar:bar')
+        self.assertEqual(len(lines), 5)
+
+    def test_runforever_percentage_of_nofile(self):
+        from superlance.fdmon import parse_limit
+        fdmon = self._makeOnePopulated({}, {'foo': parse_limit('-g', '50%')},
+                                       None)
+        self._writeProcess(fdmon.procfs, 11, 10, nofile=32)
+        self.assertEqual(len(self._tick(fdmon)), 3)
+        self._writeProcess(fdmon.procfs, 11, 10, nofile=16)
+        lines = self._tick(fdmon)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self._writeProcess(fdmon.procfs, 11, 10, nofile='unlimited')
+        self.assertEqual(len(self._tick(fdmon)), 3)
+
+    def test_runforever_sustained(self):
+        from superlance.fdmon import parse_limit
+        fdmon = self._makeOnePopulated({}, {'foo': parse_limit(
+            '-g', '5,sustain=2/3')}, None)
+        lines = self._tick(fdmon)
+        self.assertEqual(lines[2], 'foo:foo was over its limits in 1 of the '
+                                   'last 3 samples')
+        lines = self._tick(fdmon)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def test_runforever_trend(self):
+        from superlance.fdmon import parse_limit
+        fdmon = self._makeOnePopulated({}, {'foo': parse_limit('-g', '100')},
+                                       None, trend=3600, trend_window=3)
+        for fds in 10, 20:
+            self._writeProcess(fdmon.procfs, 11, fds, threads=4)
+            self.assertEqual(len(self._tick(fdmon)), 3)
+            # pretend the samples were taken a minute apart
+            for ring in fdmon.history['foo:foo']:
+                for i in range(len(ring)):
+                    ring.times[i] -= 60
+        self._writeProcess(fdmon.procfs, 11, 30, threads=4)
+        lines = self._tick(fdmon)
+        self.assertTrue(lines[2].startswith('foo:foo is heading for its '
+                                            'limits: fds grow by 0.1'))
+        self.assertEqual(lines[3], 'Restarting foo:foo')
+
+    def test_runforever_trend_over_limit_sustained(self):
+        from superlance.fdmon import parse_limit
+        fdmon = self._makeOnePopulated({}, {'foo': parse_limit(
+            '-g', '15,sustain=3/3')}, None, trend=60, trend_window=2)
+        self._writeProcess(fdmon.procfs, 11, 10, threads=4)
+        self.assertEqual(len(self._tick(fdmon)), 3)
+        self._writeProcess(fdmon.procfs, 11, 16, threads=4)
+        for count in 1, 2:
+            for ring in fdmon.history['foo:foo']:
+                for i in range(len(ring)):
+                    ring.times[i] -= 60
+            lines = self._tick(fdmon)
+            self.assertEqual(lines[2], 'foo:foo was over its limits in %d of '
+                                       'the last 3 samples' % count)
+            self.assertEqual(len(lines), 4)
+        lines = self._tick(fdmon)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def test_fd_count(self):
+        fdmon = self._makeOnePopulated({}, {}, None)
+        self.assertEqual(fdmon.procfs.fd_count(11), 10)
+        self.assertEqual(fdmon.procfs.fd_count(99), None)
+        self.assertEqual(fdmon.procfs.limits(11)['Max open files'], 1024)
+        self.assertEqual(fdmon.procfs.limits(11)['Max cpu time'], None)
+
+    def test_parse_limit(self):
+        from superlance.fdmon import parse_limit
+        self.assertEqual(str(parse_limit('-a', '1000')), '1000')
+        limit = parse_limit('-a', '80%,threads=500,sustain=2/3')
+        self.assertEqual(str(limit), '80%,threads=500,sustain=2/3')
+        self.assertEqual(limit.fds.of(1024), 819)
+        self.assertEqual(parse_limit('-a', 'threads=50').fds, None)
+        self.assertRaises(SystemExit, parse_limit, '-a', 'sustain=1/2')
+        self.assertRaises(SystemExit, parse_limit, '-a', '120%')
+        self.assertRaises(SystemExit, parse_limit, '-a', 'many')
+
+    def test_argparser(self):
+        self.assertEqual(fdmon_from_args(['-h']), None)
+        arguments = ['-p', 'foo=1000',
+                     '-g', 'bar=80%',
+                     '--any', 'threads=500',
+                     '-m', 'me@you.com',
+                     '-u', '1d',
+                     '-n', 'myproject',
+                     '--trend', '1h',
+                     '--trend-window', '5']
+        fdmon = fdmon_from_args(arguments)
+        self.assertEqual(fdmon.programs['foo'].fds, 1000)
+        self.assertEqual(str(fdmon.groups['bar']), '80%')
+        self.assertEqual(fdmon.any.threads, 500)
+        self.assertEqual(fdmon.email, 'me@you.com')
+        self.assertEqual(fdmon.email_uptime_limit, 1 * 24 * 60 * 60)
+        self.assertEqual(fdmon.fdmonName, 'myproject')
+        self.assertEqual(fdmon.trend, 3600)
+        self.assertEqual(fdmon.trend_window, 5)
+
+if __name__ == '__main__':
+    unittest.main()
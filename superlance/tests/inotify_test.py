@@ -0,0 +1,50 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+from superlance import inotify
+
+class InotifyTests(unittest.TestCase):
+    def setUp(self):
+        if not sys.platform.startswith('linux'):
+            self.skipTest('inotify is only available on Linux')
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.inotify = inotify.Inotify()
+        self.addCleanup(self.inotify.close)
+
+    def test_read_nothing_pending(self):
+        self.assertEqual(self.inotify.read(), [])
+
+    def test_add_watch(self):
+        wd = self.inotify.add_watch(self.dir, inotify.IN_CREATE)
+        open(os.path.join(self.dir, 'oome'), 'w').close()
+        events = self.inotify.read()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].wd, wd)
+        self.assertEqual(events[0].name, 'oome')
+        self.assertTrue(events[0].mask & inotify.IN_CREATE)
+
+    def test_add_watch_missing(self):
+        self.assertRaises(OSError, self.inotify.add_watch,
+                          os.path.join(self.dir, 'missing'), inotify.IN_CREATE)
+
+    def test_rm_watch(self):
+        wd = self.inotify.add_watch(self.dir, inotify.IN_CREATE)
+        self.inotify.rm_watch(wd)
+        open(os.path.join(self.dir, 'oome'), 'w').close()
+        events = self.inotify.read()
+        self.assertEqual([e.mask for e in events], [inotify.IN_IGNORED])
+
+    def test_parse_events(self):
+        data = (struct.pack('iIII', 1, inotify.IN_CREATE, 0, 8) + b'oome\0\0\0\0'
+                + struct.pack('iIII', 2, inotify.IN_IGNORED, 0, 0))
+        events = inotify.parse_events(data)
+        self.assertEqual([(e.wd, e.name) for e in events],
+                         [(1, 'oome'), (2, '')])
+
+if __name__ == '__main__':
+    unittest.main()
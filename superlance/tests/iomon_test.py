@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from superlance.compat import StringIO
+from superlance.iomon import iomon_from_args
+from superlance.tests.dummy import DummyRPCServer
+
+class IomonTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.iomon import Iomon
+        return Iomon
+
+    def _makeOne(self, *opts, **kw):
+        return self._getTargetClass()(*opts, **kw)
+
+    def _makeProcFS(self):
+        from superlance.procfs import ProcFS
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        return ProcFS(root)
+
+    def _writeIO(self, procfs, pid, read, write):
+        path = procfs.path(pid)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        with open(os.path.join(path, 'io'), 'w') as f:
+            f.write('rchar: 1\nwchar: 2\nsyscr: 3\nsyscw: 4\n'
+                    'read_bytes: %d\nwrite_bytes: %d\n'
+                    'cancelled_write_bytes: 0\n' % (read, write))
+
+    def _makeOnePopulated(self, programs, groups, any, **kw):
+        from superlance.iomon import parse_limit
+        for limits in programs, groups:
+            for name in limits:
+                limits[name] = parse_limit('-p', limits[name])
+        if any is not None:
+            any = parse_limit('-a', any)
+        rpc = DummyRPCServer()
+        sendmail = 'cat - > /dev/null'
+        email = 'chrism@plope.com'
+        name = 'test'
+        uptime_limit = 2000
+        procfs = self._makeProcFS()
+        iomon = self._makeOne(programs, groups, any, sendmail, email,
+                              uptime_limit, name, rpc, procfs, **kw)
+        iomon.stdin = StringIO()
+        iomon.stdout = StringIO()
+        iomon.stderr = StringIO()
+        iomon.rpc.supervisor.all_process_info = \
+            iomon.rpc.supervisor.all_process_info[:2]
+        self._writeIO(procfs, 11, 0, 0)
+        self._writeIO(procfs, 12, 0, 0)
+        return iomon
+
+    def _tick(self, iomon, elapsed=10):
+        # pretend the previous tick was `elapsed` seconds ago
+        self.now = getattr(self, 'now', 1000000) + elapsed
+        iomon.stdin = StringIO('eventname:TICK len:0\n')
+        iomon.stderr = StringIO()
+        with mock.patch('superlance.iomon.time.time', return_value=self.now):
+            iomon.runforever(test=True)
+        return iomon.stderr.getvalue().split('\n')
+
+    def test_runforever_notatick(self):
+        iomon = self._makeOnePopulated({}, {}, None)
+        iomon.stdin.write('eventname:NOTATICK len:0\n')
+        iomon.stdin.seek(0)
+        iomon.runforever(test=True)
+        self.assertEqual(iomon.stderr.getvalue(), '')
+
+    def test_runforever_tick_restart(self):
+        iomon = self._makeOnePopulated({'foo': '1MB', 'bar': 'write=1MB'},
+                                       {}, None)
+        lines = self._tick(iomon)
+        self.assertEqual(lines, ['Checking programs bar=write=1048576, '
+                                 'foo=1048576', ''])
+        self._writeIO(iomon.procfs, 11, 10485760, 10485760)
+        self._writeIO(iomon.procfs, 12, 104857600, 0)
+        lines = self._tick(iomon)
+        self.assertEqual(lines[1],
+                         'foo:foo reads 1048576 and writes 1048576 bytes/s')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.assertEqual(lines[3], 'bar:bar reads 10485760 and writes 0 bytes/s')
+        self.assertEqual(len(lines), 5)
+        mailed = iomon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: iomon [test]: process foo:foo restarted')
+        self.assertTrue('I/O of 2097152 bytes/s, over 1048576' in mailed[3])
+
+    def test_runforever_rate_window(self):
+        iomon = self._makeOnePopulated({'foo': '100MB'}, {}, None,
+                                       rate_window=2)
+        self._tick(iomon)
+        self._writeIO(iomon.procfs, 11, 20971520, 0)
+        lines = self._tick(iomon)
+        self.assertEqual(lines[1], 'foo:foo reads 2097152 and writes 0 bytes/s')
+        # 20MB over the last two ticks (20 seconds)
+        lines = self._tick(iomon)
+        self.assertEqual(lines[1], 'foo:foo reads 1048576 and writes 0 bytes/s')
+        lines = self._tick(iomon)
+        self.assertEqual(lines[1], 'foo:foo reads 0 and writes 0 bytes/s')
+
+    def test_runforever_signal_once(self):
+        iomon = self._makeOnePopulated({}, {'foo': '1MB'}, None,
+                                       action='signal', signal='STOP')
+        self._tick(iomon)
+        for total in 104857600, 209715200:
+            self._writeIO(iomon.procfs, 11, total, 0)
+            lines = self._tick(iomon)
+        self.assertEqual(len(iomon.rpc.supervisor.signalled), 1)
+        self.assertEqual(iomon.rpc.supervisor.signalled[0], ('foo:foo', 'STOP'))
+        self._tick(iomon)
+        self._writeIO(iomon.procfs, 11, 314572800, 0)
+        lines = self._tick(iomon)
+        self.assertTrue(lines[2].startswith('Sending SIGSTOP to foo:foo'))
+        self.assertEqual(len(iomon.rpc.supervisor.signalled), 2)
+
+    def test_runforever_report_sustained(self):
+        iomon = self._makeOnePopulated({}, {}, 'read=1MB,sustain=2/2',
+                                       action='report')
+        self._tick(iomon)
+        self._writeIO(iomon.procfs, 11, 104857600, 0)
+        lines = self._tick(iomon)
+        self.assertEqual(lines[2], 'foo:foo was over its limits in 1 of the '
+                                   'last 2 samples')
+        self._writeIO(iomon.procfs, 11, 209715200, 0)
+        lines = self._tick(iomon)
+        self.assertTrue(lines[2].startswith('foo:foo is doing too much I/O '
+                                            '(reads of 1048'))
+        self.assertEqual(iomon.mailed.split('\n')[1],
+          'Subject: iomon [test]: process foo:foo is doing too much I/O')
+
+    def test_parse_limit(self):
+        from superlance.iomon import parse_limit
+        limit = parse_limit('-a', '50MB,read=10MB,sustain=3/5')
+        self.assertEqual(limit.total, 50 * 1024 * 1024)
+        self.assertEqual(str(limit), '52428800,read=10485760,sustain=3/5')
+        self.assertEqual(parse_limit('-a', 'write=1KB').total, None)
+        self.assertRaises(SystemExit, parse_limit, '-a', 'sustain=1/2')
+        self.assertRaises(SystemExit, parse_limit, '-a', 'lots')
+
+    def test_argparser(self):
+        self.assertEqual(iomon_from_args(['-h']), None)
+        arguments = ['-p', 'foo=50MB',
+                     '-g', 'bar=write=1MB',
+                     '--any', '200MB',
+                     '-m', 'me@you.com',
+                     '-u', '1d',
+                     '-n', 'myproject',
+                     '--rate-window', '3',
+                     '--action', 'signal',
+                     '--signal', 'SIGUSR2']
+        iomon = iomon_from_args(arguments)
+        self.assertEqual(iomon.programs['foo'].total, 50 * 1024 * 1024)
+        self.assertEqual(iomon.groups['bar'].write, 1024 * 1024)
+        self.assertEqual(iomon.any.total, 200 * 1024 * 1024)
+        self.assertEqual(iomon.email_uptime_limit, 1 * 24 * 60 * 60)
+        self.assertEqual(iomon.iomonName, 'myproject')
+        self.assertEqual(iomon.rate_window, 3)
+        self.assertEqual(iomon.action, 'signal')
+        self.assertEqual(iomon.signal, 'USR2')
+
+if __name__ == '__main__':
+    unittest.main()
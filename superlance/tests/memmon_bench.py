@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Benchmarks memmon ticks against a synthetic process table: thousands of
+# pids, with every supervised program at the root of a deep tree of
+# children.  The table is served to memmon by a "sampler":
+#
+#   memory  an in-memory procfs, which renders /proc files as strings and
+#           measures the cost of memmon's own bookkeeping and parsing
+#   disk    the real ProcFS reading the table written out to a directory
+#   ps      the ps fallback, with ps answered from the table instead of
+#           forked, which counts the forks memmon would do
+#
+# and supervisord by DummyProcessTableRPCNamespace.  For plain and
+# cumulative mode, it reports the median and worst tick latency, the /proc
+# files read and ps processes forked per tick, and the peak memory a tick
+# allocates.
+
+doc = """\
+memmon_bench.py [-n processes] [-p programs] [-c children] [-d depth]
+                [-t ticks] [-s sampler]
+
+Options:
+
+-n -- the number of processes in the synthetic process table, supervised
+      or not (default 5000).
+
+-p -- the number of programs supervisord runs (default 100).
+
+-c -- the number of descendants of each program (default 20).
+
+-d -- the depth of the tree of descendants of each program (default 10).
+
+-t -- the number of ticks to time (default 10).
+
+-s -- the sampler to serve the process table with, memory, disk or ps.
+      Can be given more than once (default memory and ps).
+"""
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError: # Python < 3.4
+    tracemalloc = None
+
+from superlance import memmon
+from superlance.compat import StringIO
+from superlance.compat import maxint
+from superlance.procfs import PAGE_SIZE
+from superlance.procfs import ProcFS
+from superlance.tests.dummy import DummyProcessTableRPCNamespace
+from superlance.tests.dummy import DummyRPCServer
+
+SAMPLERS = ('memory', 'disk', 'ps')
+MODES = ('plain', 'cumulative')
+
+def usage():
+    print(doc)
+    sys.exit(255)
+
+class ProcessTable:
+    """A synthetic host process table.  Pid 1 is init and pid 2 runs
+    supervisord, whose programs each have `children` descendants nested
+    `depth` levels deep.  Unsupervised processes fill up the table."""
+    def __init__(self, count=5000, programs=100, children=20, depth=10):
+        self.ppids = {1: 0, 2: 1}
+        self.rss = {1: 1024, 2: 16384}
+        self.programs = []
+        self.children = children
+        pid = 3
+        for i in range(programs):
+            root = pid
+            self.programs.append(root)
+            self.add(root, 2)
+            pid += 1
+            parent = root
+            for j in range(children):
+                # chains of `depth` processes hanging off the program
+                if j % depth == 0:
+                    parent = root
+                self.add(pid, parent)
+                parent = pid
+                pid += 1
+        while pid <= count:
+            self.add(pid, 1)
+            pid += 1
+
+    def add(self, pid, ppid):
+        self.ppids[pid] = ppid
+        self.rss[pid] = 1024 * (1 + pid % 64)  # in KB
+
+    def files(self, pid):
+        """Return the /proc files of a process memmon may read."""
+        kb = self.rss[pid]
+        return {
+            'statm': '%d %d 100 10 0 %d 0\n' % (
+                kb * 4 // (PAGE_SIZE // 1024), kb // (PAGE_SIZE // 1024),
+                kb // (PAGE_SIZE // 1024)),
+            'stat': '%d (java) S %d %d %d 0 -1 4194560 100 0 0 0 1 1 0 0 '
+                    '20 0 1 0 1000 %d %d\n' % (
+                        pid, self.ppids[pid], pid, pid, kb * 4096,
+                        kb // (PAGE_SIZE // 1024)),
+            'status': 'Name:\tjava\nState:\tS (sleeping)\nPid:\t%d\n'
+                      'PPid:\t%d\nVmRSS:\t%8d kB\nVmSwap:\t%8d kB\n'
+                      'Threads:\t1\n' % (pid, self.ppids[pid], kb, kb // 4),
+            'smaps_rollup': '00400000-7fff0000 ---p 00000000 00:00 0 '
+                            '[rollup]\nRss: %d kB\nPss: %d kB\n'
+                            'Private_Clean: 0 kB\nPrivate_Dirty: %d kB\n'
+                            'Swap: %d kB\n' % (kb, kb // 2, kb // 4, kb // 4),
+            'cgroup': '0::/system.slice/prog-%d.service\n' % (
+                pid % 100),
+            }
+
+    def write(self, root):
+        """Write the table out as a procfs tree under `root`."""
+        for pid in self.ppids:
+            path = os.path.join(root, str(pid))
+            os.mkdir(path)
+            for name, data in self.files(pid).items():
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(data)
+
+    def ps(self, cmd):
+        """Answer the ps commands memmon runs from the table."""
+        if cmd.startswith('ps ax'):
+            return ''.join(['%d %d %d\n' % (pid, self.ppids[pid],
+                            self.rss[pid]) for pid in sorted(self.ppids)])
+        pid = int(cmd.split()[-1])
+        return '%d\n' % self.rss[pid] if pid in self.rss else ''
+
+class SyntheticProcFS(ProcFS):
+    """Serves a ProcessTable through the ProcFS readers without touching
+    the disk, counting the files read."""
+    def __init__(self, table):
+        ProcFS.__init__(self, '/proc')
+        self.table = table
+        self.reads = 0
+        self.cache = {}
+
+    def read(self, *parts):
+        self.reads += 1
+        if len(parts) != 2:
+            return None
+        pid, name = parts
+        try:
+            files = self.cache[pid]
+        except KeyError:
+            if pid not in self.table.ppids:
+                return None
+            files = self.cache[pid] = self.table.files(pid)
+        return files.get(name)
+
+    def pids(self):
+        self.reads += 1
+        return list(self.table.ppids)
+
+class CountingProcFS(ProcFS):
+    """The real ProcFS, counting the files read."""
+    reads = 0
+
+    def read(self, *parts):
+        self.reads += 1
+        return ProcFS.read(self, *parts)
+
+    def pids(self):
+        self.reads += 1
+        return ProcFS.pids(self)
+
+class Forks:
+    """Stands in for memmon.shell, answering from the table instead of
+    forking ps."""
+    def __init__(self, table):
+        self.table = table
+        self.count = 0
+
+    def __call__(self, cmd):
+        self.count += 1
+        return self.table.ps(cmd)
+
+def make_sampler(sampler, table, root):
+    """Return the procfs memmon should read the table through (None for
+    the ps fallback) and the stand-in for memmon.shell."""
+    forks = Forks(table)
+    if sampler == 'memory':
+        return SyntheticProcFS(table), forks
+    if sampler == 'disk':
+        if not os.listdir(root):
+            table.write(root)
+        return CountingProcFS(root), forks
+    if sampler == 'ps':
+        return None, forks
+    raise ValueError('unknown sampler %r' % sampler)
+
+def bench(table, sampler, mode, ticks, root=None):
+    """Time `ticks` memmon ticks over the table.
+
+    Returns a dict with the tick latencies in seconds ('latencies'), the
+    /proc files read and processes forked per tick ('reads', 'forks'), the
+    supervisord calls per tick ('rpc') and the peak bytes allocated by a
+    tick ('peak', None where it can't be measured)."""
+    procfs, forks = make_sampler(sampler, table, root)
+    rpc = DummyRPCServer()
+    rpc.supervisor = DummyProcessTableRPCNamespace(table.programs)
+    # every program measured, none restarted
+    monitor = memmon.Memmon(mode == 'cumulative', {}, {}, maxint, None, None,
+                            None, 'bench', rpc, procfs)
+    monitor.stderr = StringIO()
+    shell = memmon.shell
+    memmon.shell = forks
+    try:
+        # warm up, e.g. compile the rule table
+        monitor.tick()
+        reads = procfs and procfs.reads
+        count = forks.count
+        calls = sum(rpc.supervisor.calls.values())
+        latencies = []
+        for i in range(ticks):
+            monitor.stderr = StringIO()
+            start = time.time()
+            monitor.tick()
+            latencies.append(time.time() - start)
+        result = {
+            'latencies': latencies,
+            'reads': ((procfs.reads - reads) // ticks if procfs else 0),
+            'forks': (forks.count - count) // ticks,
+            'rpc': (sum(rpc.supervisor.calls.values()) - calls) // ticks,
+            'peak': None,
+            }
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            try:
+                monitor.tick()
+                result['peak'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        memmon.shell = shell
+    return result
+
+def report(stream, table, results):
+    stream.write('%d processes, %d programs with %d descendants each\n\n' % (
+        len(table.ppids), len(table.programs), table.children))
+    stream.write('%-8s %-10s %10s %10s %8s %8s %6s %10s\n' % (
+        'sampler', 'mode', 'median ms', 'max ms', 'reads', 'forks', 'rpc',
+        'peak KB'))
+    for sampler, mode, result in results:
+        latencies = sorted(result['latencies'])
+        peak = result['peak']
+        stream.write('%-8s %-10s %10.2f %10.2f %8d %8d %6d %10s\n' % (
+            sampler, mode, latencies[len(latencies) // 2] * 1000,
+            latencies[-1] * 1000, result['reads'], result['forks'],
+            result['rpc'], 'n/a' if peak is None else peak // 1024))
+
+def main(argv=sys.argv):
+    short_args = 'hn:p:c:d:t:s:'
+    long_args = ['help']
+    try:
+        opts, args = getopt.getopt(argv[1:], short_args, long_args)
+    except:
+        usage()
+
+    sizes = {'-n': 5000, '-p': 100, '-c': 20, '-d': 10, '-t': 10}
+    samplers = []
+    for option, value in opts:
+        if option in ('-h', '--help'):
+            usage()
+        if option == '-s':
+            if value not in SAMPLERS:
+                print('%s must be one of %s' % (option, ', '.join(SAMPLERS)))
+                usage()
+            samplers.append(value)
+            continue
+        try:
+            sizes[option] = int(value)
+        except ValueError:
+            print('%s must be a number' % option)
+            usage()
+        if sizes[option] < 1:
+            print('%s must be at least 1' % option)
+            usage()
+
+    table = ProcessTable(sizes['-n'], sizes['-p'], sizes['-c'], sizes['-d'])
+    root = tempfile.mkdtemp()
+    try:
+        results = []
+        for sampler in samplers or ['memory', 'ps']:
+            for mode in MODES:
+                results.append((sampler, mode, bench(table, sampler, mode,
+                                                     sizes['-t'], root)))
+    finally:
+        shutil.rmtree(root)
+    report(sys.stdout, table, results)
+
+if __name__ == '__main__':
+    main()
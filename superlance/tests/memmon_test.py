@@ -1,8 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
 from superlance.compat import StringIO
 from superlance.compat import maxint
 from superlance.memmon import memmon_from_args
 from superlance.memmon import seconds_size
+from superlance.procfs import PAGE_SIZE
 from superlance.tests.dummy import DummyRPCServer
 
 class MemmonTests(unittest.TestCase):
@@ -197,6 +201,34 @@ class MemmonTests(unittest.TestCase):
         self.assertEqual(mailed[2], '')
         self.assertTrue(mailed[3].startswith('Failed'))
 
+    def test_restarts_batched_in_multicall(self):
+        memmon = self._makeOnePopulated({}, {}, 0)
+        self._tick(memmon, 1024000)
+        multicalls = memmon.rpc.system.multicalls
+        self.assertEqual(len(multicalls), 2)
+        self.assertEqual([(x['methodName'], x['params']) for x in multicalls[0]],
+                         [('supervisor.stopProcess', ['foo:foo']),
+                          ('supervisor.stopProcess', ['bar:bar']),
+                          ('supervisor.stopProcess', ['baz:baz_01'])])
+        self.assertEqual([x['methodName'] for x in multicalls[1]],
+                         ['supervisor.startProcess'] * 3)
+
+    def test_restarts_batched_stop_fault(self):
+        memmon = self._makeOnePopulated({}, {}, 0)
+        info = dict(memmon.rpc.supervisor.all_process_info[0])
+        info.update(name='FAILED', group='FAILED')
+        memmon.rpc.supervisor.all_process_info = [
+            info, memmon.rpc.supervisor.all_process_info[1]]
+        from superlance.compat import xmlrpclib
+        self.assertRaises(xmlrpclib.Fault, self._tick, memmon, 1024000)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[2], 'Restarting FAILED:FAILED')
+        self.assertEqual(lines[4], 'Restarting bar:bar')
+        self.assertTrue(lines[5].startswith(
+            'Failed to stop process FAILED:FAILED'))
+        starts = memmon.rpc.system.multicalls[1]
+        self.assertEqual([x['params'] for x in starts], [['bar:bar']])
+
     def test_subject_no_name(self):
         """set the name to None to check if subject
         stays `memmon:...` instead `memmon [<name>]:...`
@@ -319,6 +351,724 @@ class MemmonTests(unittest.TestCase):
             'Cumulative RSS of the test process and its three children '
             'should add up to 1000 kb.')
 
+    def _makeProcFS(self, statm, ppids=None, smaps=None, cgroups=None,
+                    status=None):
+        from superlance.procfs import ProcFS
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for pid, data in statm.items():
+            os.mkdir(os.path.join(root, str(pid)))
+            with open(os.path.join(root, str(pid), 'statm'), 'w') as f:
+                f.write(data)
+        for pid, ppid in (ppids or {}).items():
+            with open(os.path.join(root, str(pid), 'stat'), 'w') as f:
+                f.write('%s (a (b) c) S %s %s 0 0\n' % (pid, ppid, pid))
+        for pid, data in (smaps or {}).items():
+            with open(os.path.join(root, str(pid), 'smaps_rollup'), 'w') as f:
+                f.write(data)
+        for pid, path in (cgroups or {}).items():
+            with open(os.path.join(root, str(pid), 'cgroup'), 'w') as f:
+                f.write('1:name=systemd:/\n0::%s\n' % path)
+        for pid, data in (status or {}).items():
+            with open(os.path.join(root, str(pid), 'status'), 'w') as f:
+                f.write(data)
+        return ProcFS(root)
+
+    def test_calc_rss_swap(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        status = ('Name:\tjava\nState:\tS (sleeping)\nVmRSS:\t    1000 kB\n'
+                  'VmSwap:\t    3000 kB\nThreads:\t40\n')
+        smaps = 'Rss: 8 kB\nPss: 6 kB\nPrivate_Dirty: 2 kB\nSwap: 3000 kB\n'
+        memmon.procfs = self._makeProcFS({1: '0 1 0', 2: '0 1 0'},
+                                         smaps={1: smaps},
+                                         status={1: status,
+                                                 2: 'Name:\tkthreadd\n'})
+        memmon.metric = 'swap'
+        self.assertEqual(3000 * 1024, memmon.calc_rss(1))
+        self.assertEqual(None, memmon.calc_rss(2))
+        memmon.reset_caches()
+        memmon.metric = 'rss+swap'
+        self.assertEqual(4000 * 1024, memmon.calc_rss(1))
+        memmon.reset_caches()
+        memmon.metric = 'pss+swap'
+        self.assertEqual(3006 * 1024, memmon.calc_rss(1))
+
+    def _makeCgroupFS(self, cgroups):
+        from superlance.procfs import CgroupFS
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for path, (current, inactive_file) in cgroups.items():
+            os.makedirs(os.path.join(root, path.lstrip('/')))
+            with open(os.path.join(root, path.lstrip('/'),
+                                   'memory.current'), 'w') as f:
+                f.write('%d\n' % current)
+            with open(os.path.join(root, path.lstrip('/'),
+                                   'memory.stat'), 'w') as f:
+                f.write('anon 1024\ninactive_file %d\n' % inactive_file)
+        return CgroupFS(root)
+
+    def test_calc_rss_procfs(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.procfs = self._makeProcFS({1: '5000 16 8 1 0 100 0\n',
+                                          2: 'garbage\n'})
+        memmon.pscommand = 'exit 1; %s'
+        self.assertEqual(16 * PAGE_SIZE, memmon.calc_rss(1))
+        self.assertEqual(None, memmon.calc_rss(2))
+        self.assertEqual(
+            None, memmon.calc_rss(3),
+            'A pid without a /proc entry (exited process) should result in '
+            'calc_rss() returning None.')
+
+    def test_calc_rss_cumulative_procfs(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.cumulative = True
+        memmon.procfs = self._makeProcFS(
+            {1: '0 1 0', 2: '0 2 0', 3: '0 3 0', 4: '0 4 0', 99: '0 99 0'},
+            {1: 99, 2: 1, 3: 2, 4: 2, 99: 0})
+        self.assertEqual(10 * PAGE_SIZE, memmon.calc_rss(1))
+        self.assertEqual(7 * PAGE_SIZE, memmon.calc_rss(3) + memmon.calc_rss(4))
+        self.assertEqual(None, memmon.calc_rss(5))
+
+    def test_calc_rss_cumulative_single_snapshot(self):
+        """All processes checked during a tick share one ps invocation"""
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.cumulative = True
+        calls = []
+        def shell(cmd):
+            calls.append(cmd)
+            return '1 0 10\n2 1 20\n3 0 40\n4 3 80\n'
+        import superlance.memmon
+        original = superlance.memmon.shell
+        superlance.memmon.shell = shell
+        try:
+            self.assertEqual(30 * 1024, memmon.calc_rss(1))
+            self.assertEqual(120 * 1024, memmon.calc_rss(3))
+            self.assertEqual(20 * 1024, memmon.calc_rss(2))
+        finally:
+            superlance.memmon.shell = original
+        self.assertEqual(1, len(calls))
+
+    def test_calc_rss_cumulative_pss(self):
+        """A pre-forked pool is measured by what it really costs: the
+        master and workers' proportional share of their common pages"""
+        smaps = ('00400000-7ffe00000000 ---p 00000000 00:00 0  [rollup]\n'
+                 'Rss:                %d kB\n'
+                 'Pss:                %d kB\n'
+                 'Shared_Clean:       900 kB\n'
+                 'Private_Clean:      %d kB\n'
+                 'Private_Dirty:      10 kB\n'
+                 'Swap:               0 kB\n'
+                 'VmFlags: rd ex mr\n')
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.cumulative = True
+        memmon.metric = 'pss'
+        memmon.procfs = self._makeProcFS(
+            {1: '0 250 0', 2: '0 250 0', 3: '0 250 0'},
+            {1: 0, 2: 1, 3: 1},
+            {1: smaps % (1000, 400, 90),
+             2: smaps % (1000, 300, 40),
+             3: smaps % (1000, 300, 40)})
+        self.assertEqual(1000 * 1024, memmon.calc_rss(1))
+        memmon.samples = {}
+        memmon.metric = 'uss'
+        self.assertEqual(200 * 1024, memmon.calc_rss(1))
+        memmon.samples = {}
+        memmon.metric = 'rss'
+        self.assertEqual(3 * 250 * PAGE_SIZE, memmon.calc_rss(1))
+
+    def test_calc_rss_cgroup(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.metric = 'cgroup'
+        memmon.procfs = self._makeProcFS(
+            {1: '0 1 0', 2: '0 1 0', 3: '0 1 0', 4: '0 1 0'},
+            cgroups={1: '/app.slice/foo', 2: '/app.slice/foo',
+                     3: '/app.slice/gone', 4: '/'})
+        memmon.cgroupfs = self._makeCgroupFS({'/app.slice/foo': (5000, 1000)})
+        reads = []
+        memory_current = memmon.cgroupfs.memory_current
+        def counting(path):
+            reads.append(path)
+            return memory_current(path)
+        memmon.cgroupfs.memory_current = counting
+        self.assertEqual(5000, memmon.calc_rss(1))
+        self.assertEqual(5000, memmon.calc_rss(2))
+        self.assertEqual(None, memmon.calc_rss(3))
+        self.assertEqual(None, memmon.calc_rss(4))
+        self.assertEqual(['/app.slice/foo'], reads[:1])
+        self.assertEqual(1, reads.count('/app.slice/foo'))
+        memmon.cgroups = {}
+        memmon.samples = {}
+        memmon.metric = 'cgroup-ws'
+        self.assertEqual(4000, memmon.calc_rss(1))
+
+    def test_calc_rss_cumulative_cgroup(self):
+        """Each cgroup of a process tree counts once; nested cgroups are
+        included in their parent's figures"""
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.cumulative = True
+        memmon.metric = 'cgroup'
+        memmon.procfs = self._makeProcFS(
+            {1: '0 1 0', 2: '0 1 0', 3: '0 1 0', 4: '0 1 0', 5: '0 1 0'},
+            {1: 0, 2: 1, 3: 1, 4: 3, 5: 4},
+            cgroups={1: '/foo', 2: '/foo', 3: '/foo/helper', 4: '/bar',
+                     5: '/'})
+        memmon.cgroupfs = self._makeCgroupFS({'/foo': (5000, 0),
+                                              '/foo/helper': (1000, 0),
+                                              '/bar': (700, 0)})
+        self.assertEqual(5700, memmon.calc_rss(1))
+        self.assertEqual(1700, memmon.calc_rss(3))
+        self.assertEqual(None, memmon.calc_rss(5))
+
+    def test_runforever_tick_procfs(self):
+        memmon = self._makeOnePopulated({}, {}, 0)
+        memmon.procfs = self._makeProcFS({11: '5000 16 8 1 0 100 0\n'})
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is %s' % (16 * PAGE_SIZE))
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.assertEqual(len(lines), 4)
+
+    def test_sample_ring(self):
+        from superlance.memmon import SampleRing
+        ring = SampleRing(4)
+        self.assertEqual(None, ring.slope())
+        for t in range(100):
+            ring.append(t * 60.0, 1000.0 + t * 60 * 5)
+        self.assertEqual(4, len(ring))
+        self.assertEqual(4, len(ring.values))
+        self.assertAlmostEqual(5.0, ring.slope())
+        ring = SampleRing(3)
+        for t in range(3):
+            ring.append(0.0, 1000.0 * t)
+        self.assertEqual(None, ring.slope())
+
+    def _makeLeaking(self, limit, leak, leak_warn=False):
+        from superlance.memmon import SampleRing
+        import time
+        memmon = self._makeOnePopulated({'foo': limit}, {}, None)
+        memmon.leak = leak
+        memmon.leak_window = 3
+        memmon.leak_warn = leak_warn
+        memmon.rpc.supervisor.all_process_info = \
+            memmon.rpc.supervisor.all_process_info[:1]
+        # growing by 1000 bytes/s up to the 2264064 bytes of this tick
+        ring = memmon.history['foo:foo'] = SampleRing(3, 11)
+        now = time.time()
+        ring.append(now - 120, 2264064 - 120000)
+        ring.append(now - 60, 2264064 - 60000)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        return memmon
+
+    def test_runforever_leak_restart(self):
+        memmon = self._makeLeaking(3000000, 3600)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is 2264064')
+        self.assertTrue(lines[2].startswith('RSS of foo:foo grows by '))
+        self.assertTrue(' bytes/s and will exceed 3000000 in 73' in lines[2])
+        self.assertEqual(lines[3], 'Restarting foo:foo')
+        self.assertEqual(len(lines), 5)
+
+    def test_runforever_leak_beyond_horizon(self):
+        memmon = self._makeLeaking(3000000, 600)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is 2264064')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(3, len(memmon.history['foo:foo']))
+
+    def test_runforever_leak_warn(self):
+        memmon = self._makeLeaking(3000000, 3600, leak_warn=True)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertTrue(lines[2].startswith('RSS of foo:foo grows by'))
+        self.assertEqual(len(lines), 4)
+        mailed = memmon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+          'Subject: memmon [test]: process foo:foo is leaking memory')
+
+    def test_runforever_leak_warn_once(self):
+        """A leak is warned about once, until it is no longer predicted"""
+        memmon = self._makeLeaking(3000000, 3600, leak_warn=True)
+        memmon.runforever(test=True)
+        memmon.mailed = False
+        lines = self._tick(memmon, 2264064)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(memmon.mailed, False)
+        self.assertEqual(memmon.warned, {'foo:foo': 11})
+        memmon.leak = 60
+        self._tick(memmon, 2264064)
+        self.assertEqual(memmon.warned, {})
+
+    def test_runforever_leak_warn_uptime_over_limit(self):
+        memmon = self._makeLeaking(3000000, 3600, leak_warn=True)
+        memmon.email_uptime_limit = 0
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertTrue(lines[2].startswith('RSS of foo:foo grows by'))
+        self.assertEqual(memmon.mailed, False)
+
+    def test_runforever_leak_history_reset(self):
+        """A new pid (restarted process) starts a new history"""
+        memmon = self._makeLeaking(3000000, 3600)
+        memmon.history['foo:foo'].pid = 10
+        memmon.history['gone:gone'] = memmon.history['foo:foo']
+        memmon.runforever(test=True)
+        self.assertEqual(['foo:foo'], list(memmon.history))
+        self.assertEqual(1, len(memmon.history['foo:foo']))
+
+    def _tick(self, memmon, rss):
+        memmon.pscommand = 'echo %d; : %%s' % (rss // 1024)
+        memmon.stdin = StringIO('eventname:TICK len:0\n')
+        memmon.stderr = StringIO()
+        memmon.runforever(test=True)
+        return memmon.stderr.getvalue().split('\n')
+
+    def test_runforever_sustained_breach(self):
+        from superlance.memmon import Limit
+        memmon = self._makeOnePopulated(
+            {'foo': Limit(1024000, sustain=2, window=3)}, {}, None)
+        memmon.rpc.supervisor.all_process_info = \
+            memmon.rpc.supervisor.all_process_info[:1]
+        lines = self._tick(memmon, 2048000)
+        self.assertEqual(lines[2],
+                         'foo:foo was over its limits in 1 of the last 3 '
+                         'samples')
+        self.assertEqual(len(lines), 4)
+        lines = self._tick(memmon, 512000)
+        self.assertEqual(len(lines), 3)
+        lines = self._tick(memmon, 2048000)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        # the earlier breaches drop out of the window
+        self._tick(memmon, 512000)
+        self._tick(memmon, 512000)
+        lines = self._tick(memmon, 2048000)
+        self.assertEqual(lines[2],
+                         'foo:foo was over its limits in 1 of the last 3 '
+                         'samples')
+
+    def test_runforever_rearm(self):
+        from superlance.memmon import Limit
+        memmon = self._makeOnePopulated(
+            {'foo': Limit(1024000, sustain=3, window=3, rearm=512000)},
+            {}, None)
+        memmon.rpc.supervisor.all_process_info = \
+            memmon.rpc.supervisor.all_process_info[:1]
+        lines = self._tick(memmon, 2048000)
+        self.assertEqual(len(lines), 4)
+        # hovering just below the limit still counts as over
+        lines = self._tick(memmon, 1000448)
+        self.assertEqual(lines[2],
+                         'foo:foo was over its limits in 2 of the last 3 '
+                         'samples')
+        lines = self._tick(memmon, 1000448)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        # a new pid starts over, and dropping to the rearm size disarms
+        memmon.rpc.supervisor.all_process_info = [
+            dict(memmon.rpc.supervisor.all_process_info[0], pid=13)]
+        self._tick(memmon, 2048000)
+        self._tick(memmon, 512000)
+        lines = self._tick(memmon, 1000448)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(1, bin(memmon.breaches['foo:foo'].bits).count('1'))
+
+    def _makeSoft(self, cooldown=0):
+        from superlance.memmon import Limit
+        memmon = self._makeOnePopulated(
+            {'foo': Limit(2048000, soft=1024000)}, {}, None)
+        memmon.rpc.supervisor.all_process_info = \
+            memmon.rpc.supervisor.all_process_info[:1]
+        memmon.soft_cooldown = cooldown
+        return memmon
+
+    def test_runforever_soft_limit_signal_then_restart(self):
+        memmon = self._makeSoft()
+        lines = self._tick(memmon, 1536000)
+        self.assertEqual(lines[2], 'RSS of foo:foo is over its soft limit '
+                         '1024000, sending it SIGUSR1')
+        self.assertEqual(memmon.rpc.supervisor.signalled,
+                         [('foo:foo', 'USR1')])
+        self.assertEqual(len(lines), 4)
+        lines = self._tick(memmon, 1536000)
+        self.assertEqual(len(lines), 3)
+        lines = self._tick(memmon, 3072000)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.assertEqual(len(memmon.rpc.supervisor.signalled), 1)
+
+    def test_runforever_soft_limit_recovers(self):
+        memmon = self._makeSoft()
+        self._tick(memmon, 1536000)
+        lines = self._tick(memmon, 512000)
+        self.assertEqual(len(lines), 3)
+        self.assertFalse('foo:foo' in memmon.signalled)
+        # went straight over the limit: signal first, restart next tick
+        lines = self._tick(memmon, 3072000)
+        self.assertTrue(lines[2].endswith('sending it SIGUSR1'))
+        self.assertEqual(len(memmon.rpc.supervisor.signalled), 2)
+        lines = self._tick(memmon, 3072000)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def test_runforever_soft_limit_cooldown(self):
+        memmon = self._makeSoft(cooldown=3600)
+        self._tick(memmon, 3072000)
+        lines = self._tick(memmon, 3072000)
+        self.assertEqual(lines[2], 'Waiting for foo:foo to recover from '
+                         'SIGUSR1 before restarting it')
+        self.assertEqual(len(lines), 4)
+        memmon.signalled['foo:foo'].time -= 3600
+        lines = self._tick(memmon, 3072000)
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def test_runforever_summary(self):
+        memmon = self._makeOnePopulated({'foo': maxint}, {}, 0)
+        memmon.summary = True
+        lines = self._tick(memmon, 1024000)
+        self.assertEqual(lines, [
+            'Restarting bar:bar',
+            'Restarting baz:baz_01',
+            'Checked 3 processes, RSS total 3072000, largest foo:foo is '
+            '1024000',
+            ''])
+
+    def test_runforever_export_csv(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        memmon = self._makeOnePopulated({'foo': maxint}, {}, None)
+        memmon.export = os.path.join(root, 'memmon.csv')
+        self._tick(memmon, 1024000)
+        self._tick(memmon, 2048000)
+        with open(memmon.export) as f:
+            rows = [line.split(',') for line in f.read().splitlines()]
+        self.assertEqual(rows[0], ['time', 'name', 'pid', 'metric', 'value',
+                                   'limit'])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][1:], ['foo:foo', '11', 'rss', '1024000',
+                                       str(maxint)])
+        self.assertEqual(rows[2][4], '2048000')
+
+    def test_runforever_export_openmetrics(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        memmon = self._makeOnePopulated({'foo': 2048000}, {}, None)
+        memmon.export = os.path.join(root, 'memmon.prom')
+        memmon.export_format = 'openmetrics'
+        self._tick(memmon, 1024000)
+        self._tick(memmon, 1536000)
+        self.assertEqual(os.listdir(root), ['memmon.prom'])
+        with open(memmon.export) as f:
+            lines = f.read().splitlines()
+        labels = '{name="foo:foo",group="foo",metric="rss"}'
+        self.assertTrue('memmon_memory_bytes%s 1536000' % labels in lines)
+        self.assertTrue('memmon_limit_bytes%s 2048000' % labels in lines)
+        self.assertEqual(lines[-1], '# EOF')
+
+    def test_runforever_most_specific_limit(self):
+        programs = {'foo': maxint}
+        groups = {'foo': 0}
+        memmon = self._makeOnePopulated(programs, groups, 0)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[3], 'RSS of foo:foo is 2264064')
+        self.assertEqual(lines[4], 'RSS of bar:bar is 2265088')
+        self.assertEqual(lines[5], 'Restarting bar:bar')
+
+    def test_parse_limit(self):
+        from superlance.memmon import parse_limit
+        self.assertEqual(parse_limit('-a', '1KB'), 1024)
+        self.assertFalse(hasattr(parse_limit('-a', '1KB'), 'sustain'))
+        limit = parse_limit('-a', '1MB,sustain=3/5,rearm=512KB')
+        self.assertEqual(limit, 1024 * 1024)
+        self.assertEqual(limit.sustain, 3)
+        self.assertEqual(limit.window, 5)
+        self.assertEqual(limit.rearm, 512 * 1024)
+        self.assertEqual(str(limit), '1048576,sustain=3/5,rearm=524288')
+        import sys
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for value in ('1MB,sustain=5/3', '1MB,sustain=1/65',
+                          '1MB,sustain=x', '1MB,rearm=2MB', '1MB,foo=1'):
+                self.assertRaises(SystemExit, parse_limit, '-a', value)
+        finally:
+            sys.stdout = stdout
+
+    def test_runforever_relative_limit(self):
+        from superlance.memmon import parse_limit
+        memmon = self._makeOnePopulated({}, {}, parse_limit('-a', '50%'))
+        memmon.rpc.supervisor.all_process_info = \
+            memmon.rpc.supervisor.all_process_info[:1]
+        memmon.procfs = self._makeProcFS({11: '0 512 0', 'self': '0 1 0'},
+                                         cgroups={'self': '/sv/memmon'})
+        with open(memmon.procfs.path('meminfo'), 'w') as f:
+            f.write('MemTotal:        4096 kB\nHugePages_Total:       0\n')
+        lines = self._tick(memmon, 0)
+        self.assertEqual(lines[0], 'Checking any=50%')
+        self.assertEqual(lines[1], 'Resolving relative limits against '
+                                   '4194304 bytes of memory')
+        self.assertEqual(lines[2], 'RSS of foo:foo is %s' % (512 * PAGE_SIZE))
+        self.assertEqual(len(lines), 4)
+        # supervisord's cgroup is limited to less than the host's memory
+        memmon.cgroupfs = self._makeCgroupFS({'/sv/memmon': (0, 0)})
+        with open(os.path.join(memmon.cgroupfs.root, 'sv', 'memory.max'),
+                  'w') as f:
+            f.write('%d\n' % (1024 * PAGE_SIZE - 2))
+        with open(os.path.join(memmon.cgroupfs.root, 'sv', 'memmon',
+                               'memory.max'), 'w') as f:
+            f.write('max\n')
+        lines = self._tick(memmon, 0)
+        self.assertEqual(lines[1], 'Resolving relative limits against '
+                                   '%s bytes of memory' % (1024 * PAGE_SIZE - 2))
+        self.assertEqual(lines[3], 'Restarting foo:foo')
+        lines = self._tick(memmon, 0)
+        self.assertEqual(lines[1], 'RSS of foo:foo is %s' % (512 * PAGE_SIZE))
+
+    def test_parse_limit_soft(self):
+        from superlance.memmon import parse_limit
+        from superlance.memmon import RelativeLimit
+        limit = parse_limit('-a', '2MB,soft=1MB')
+        self.assertEqual(limit.soft, 1048576)
+        self.assertEqual(str(limit), '2097152,soft=1048576')
+        limit = parse_limit('-a', '20%,soft=10%')
+        self.assertTrue(isinstance(limit, RelativeLimit))
+        self.assertEqual(limit.resolve(1000).soft, 100)
+        self.assertRaises(SystemExit, parse_limit, '-a', '1MB,soft=2MB')
+
+    def test_parse_limit_percentage(self):
+        from superlance.memmon import parse_limit
+        limit = parse_limit('-a', '15%,sustain=2/3,rearm=10%')
+        self.assertEqual(str(limit), '15%,sustain=2/3,rearm=10%')
+        self.assertEqual(None, limit.resolve(None))
+        resolved = limit.resolve(1000)
+        self.assertEqual(150, resolved)
+        self.assertEqual(100, resolved.rearm)
+        self.assertEqual(2, resolved.sustain)
+        self.assertTrue(resolved is limit.resolve(1000))
+        self.assertEqual(300, limit.resolve(2000))
+        limit = parse_limit('-a', '10%,rearm=1MB')
+        self.assertEqual(100, limit.resolve(1000).rearm)
+        limit = parse_limit('-a', '1MB,rearm=50%')
+        self.assertEqual(500, limit.resolve(1000).rearm)
+        import sys
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for value in ('0%', '101%', 'x%', '10%,rearm=20%'):
+                self.assertRaises(SystemExit, parse_limit, '-a', value)
+        finally:
+            sys.stdout = stdout
+
+    def _makePressured(self, some, victim='largest'):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.pressure = {'some': 20.0}
+        memmon.pressure_victim = victim
+        memmon.procfs = self._makeProcFS({11: '0 100 0', 12: '0 200 0'})
+        os.mkdir(memmon.procfs.path('pressure'))
+        with open(memmon.procfs.path('pressure', 'memory'), 'w') as f:
+            f.write('some avg10=%.2f avg60=1.00 avg300=0.50 total=1\n'
+                    'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n' % some)
+        return memmon
+
+    def test_runforever_pressure(self):
+        memmon = self._makePressured(25)
+        lines = self._tick(memmon, 0)
+        self.assertEqual(lines[0], 'Checking memory pressure some=20.0')
+        self.assertEqual(lines[1], 'RSS of foo:foo is %s' % (100 * PAGE_SIZE))
+        self.assertEqual(lines[2], 'RSS of bar:bar is %s' % (200 * PAGE_SIZE))
+        self.assertEqual(lines[3], 'RSS of baz:baz_01 is %s' % (200 * PAGE_SIZE))
+        self.assertEqual(lines[4], 'Memory pressure some avg10=25.00, '
+                                   'restarting the largest process bar:bar')
+        self.assertEqual(lines[5], 'Restarting bar:bar')
+        self.assertEqual(len(lines), 7)
+        # give the pressure average time to come down after a restart
+        lines = self._tick(memmon, 0)
+        self.assertEqual(len(lines), 5)
+        memmon.pressure_restarted -= 10
+        lines = self._tick(memmon, 0)
+        self.assertEqual(lines[5], 'Restarting bar:bar')
+
+    def test_runforever_pressure_below_level(self):
+        memmon = self._makePressured(15)
+        lines = self._tick(memmon, 0)
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(memmon.mailed, False)
+
+    def test_runforever_pressure_fastest(self):
+        from superlance.memmon import SampleRing
+        memmon = self._makePressured(25, victim='fastest')
+        memmon.any = maxint
+        memmon.leak_window = 3
+        ring = memmon.history['foo:foo'] = SampleRing(3, 11)
+        ring.append(0, 0)
+        lines = self._tick(memmon, 0)
+        self.assertEqual(lines[5], 'Memory pressure some avg10=25.00, '
+                                   'restarting the fastest process foo:foo')
+
+    def test_check_fastest_without_leak(self):
+        from superlance.memmon import SampleRing
+        memmon = self._makePressured(25, victim='fastest')
+        memmon.leak = None
+        memmon.leak_window = 3
+        ring = memmon.history['foo:foo'] = SampleRing(3, 11)
+        for now, rss in (0, 0), (1, 100), (2, 200):
+            ring.append(now, rss)
+        self.assertEqual(memmon.check('foo:foo', 11, 200, 300), False)
+        self.assertEqual(memmon.stderr.getvalue(), '')
+
+    def test_parse_pressure(self):
+        from superlance.memmon import parse_pressure
+        self.assertEqual(parse_pressure('--pressure', 'some=20,avg=60'),
+                         {'some': 20.0, 'avg': 60})
+        self.assertEqual(parse_pressure('--pressure', 'full=2.5'),
+                         {'full': 2.5})
+        import sys
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for value in ('avg=10', 'some=x', 'some=1,avg=30', 'other=1'):
+                self.assertRaises(SystemExit, parse_pressure, '--pressure',
+                                  value)
+        finally:
+            sys.stdout = stdout
+
+    def test_runforever_peak_between_ticks(self):
+        memmon = self._makeOnePopulated({'foo': 3000000}, {}, None)
+        memmon.rpc.supervisor.all_process_info = \
+            memmon.rpc.supervisor.all_process_info[:1]
+        lines = self._tick(memmon, 1024000)
+        self.assertEqual({'foo:foo': 11}, memmon.watched)
+        # the process balloons and shrinks again in between ticks
+        for kb in 2000, 4000, 1000:
+            memmon.pscommand = 'echo %d; : %%s' % kb
+            memmon.sample_between_ticks()
+        lines = self._tick(memmon, 1024000)
+        self.assertEqual(lines[1], 'RSS of foo:foo is 4096000 (max of 4 '
+                                   'samples, mean 2048000)')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.assertEqual({}, memmon.peaks)
+        lines = self._tick(memmon, 1024000)
+        self.assertEqual(lines[1], 'RSS of foo:foo is 1024000')
+
+    def test_sampler_thread(self):
+        from superlance.memmon import Sampler
+        import threading
+        sampled = threading.Event()
+        class DummyMemmon:
+            def sample_between_ticks(self):
+                sampled.set()
+        sampler = Sampler(DummyMemmon(), 0.01)
+        sampler.start()
+        sampled.wait(5)
+        sampler.stop()
+        sampler.join(5)
+        self.assertTrue(sampled.is_set())
+        self.assertFalse(sampler.is_alive())
+
+    def test_rule_table(self):
+        from superlance.memmon import RuleTable
+        table = RuleTable({'worker_*': 1, 'web:worker_01': 2,
+                           're:web:worker_0[2-3]': 3, 'cron': 4},
+                          {'web': 5, 'db?': 6}, 7)
+        self.assertEqual(2, table.lookup('worker_01', 'web', 'web:worker_01'))
+        self.assertEqual(3, table.lookup('worker_02', 'web', 'web:worker_02'))
+        self.assertEqual(1, table.lookup('worker_04', 'web', 'web:worker_04'))
+        self.assertEqual(1, table.lookup('worker_01', 'bg', 'bg:worker_01'))
+        self.assertEqual(4, table.lookup('cron', 'cron', 'cron:cron'))
+        self.assertEqual(5, table.lookup('nginx', 'web', 'web:nginx'))
+        self.assertEqual(6, table.lookup('db1', 'db1', 'db1:db1'))
+        self.assertEqual(7, table.lookup('db10', 'db10', 'db10:db10'))
+        table = RuleTable({}, {}, None)
+        self.assertEqual(None, table.lookup('foo', 'foo', 'foo:foo'))
+
+    def test_rule_table_cache(self):
+        from superlance.memmon import RuleTable
+        table = RuleTable({'worker_*': 1}, {}, None)
+        table.refresh([('web', 'worker_01')])
+        self.assertEqual(1, table.lookup('worker_01', 'web', 'web:worker_01'))
+        table.program_patterns = []
+        self.assertEqual(1, table.lookup('worker_01', 'web', 'web:worker_01'))
+        table.refresh([('web', 'worker_01')])
+        self.assertEqual(1, table.lookup('worker_01', 'web', 'web:worker_01'))
+        table.refresh([('web', 'worker_01'), ('web', 'worker_02')])
+        self.assertEqual(None, table.lookup('worker_01', 'web', 'web:worker_01'))
+
+    def test_runforever_tick_program_patterns(self):
+        programs = {'ba*': 0, 're:foo:f.o': maxint}
+        memmon = self._makeOnePopulated(programs, {}, None)
+        lines = self._tick(memmon, 1024000)
+        self.assertEqual(lines[0], 'Checking programs ba*=0, re:foo:f.o=%s'
+                         % maxint)
+        self.assertEqual(lines[1], 'RSS of foo:foo is 1024000')
+        self.assertEqual(lines[2], 'RSS of bar:bar is 1024000')
+        self.assertEqual(lines[3], 'Restarting bar:bar')
+        self.assertEqual(lines[4], 'RSS of baz:baz_01 is 1024000')
+        self.assertEqual(lines[5], 'Restarting baz:baz_01')
+        self.assertEqual(len(lines), 7)
+
+    def _makeGroup(self, group_restarts, group_spacing):
+        memmon = self._makeOnePopulated({}, {'web': 0}, None)
+        memmon.group_restarts = group_restarts
+        memmon.group_spacing = group_spacing
+        info = memmon.rpc.supervisor.all_process_info[0]
+        memmon.rpc.supervisor.all_process_info = [
+            dict(info, group='web', name='w%d' % (pid // 100), pid=pid)
+            for pid in (100, 300, 200)]
+        # each process' RSS in KB is its pid
+        memmon.pscommand = 'echo %s'
+        return memmon
+
+    def test_runforever_group_restarts(self):
+        memmon = self._makeGroup(2, 0)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of web:w1 is 102400')
+        self.assertEqual(lines[4], 'Restarting web:w3')
+        self.assertEqual(lines[5], 'Restarting web:w2')
+        self.assertEqual(lines[6], 'Deferring restart of web:w1')
+        self.assertEqual(len(lines), 8)
+
+    def test_runforever_group_spacing(self):
+        memmon = self._makeGroup(None, 60)
+        memmon.stdin = StringIO('eventname:TICK len:0\n')
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[4], 'Restarting web:w3')
+        self.assertEqual(lines[5], 'Deferring restart of web:w2')
+        self.assertEqual(lines[6], 'Deferring restart of web:w1')
+        memmon.stdin = StringIO('eventname:TICK len:0\n')
+        memmon.stderr = StringIO()
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[4], 'Deferring restart of web:w3')
+        memmon.group_restarted['web'] -= 60
+        memmon.stdin = StringIO('eventname:TICK len:0\n')
+        memmon.stderr = StringIO()
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[4], 'Restarting web:w3')
+
+    def test_bench_reads_per_tick(self):
+        from superlance.tests.memmon_bench import ProcessTable, bench
+        table = ProcessTable(count=200, programs=5, children=6, depth=3)
+        # one statm per program
+        result = bench(table, 'memory', 'plain', 2)
+        self.assertEqual((result['reads'], result['forks'], result['rpc']),
+                         (5, 0, 1))
+        # a single snapshot of the process table, then the statm of every
+        # process in the programs' trees
+        result = bench(table, 'memory', 'cumulative', 2)
+        self.assertEqual(result['reads'], 1 + 200 + 5 * 7)
+        # one ps per program, or a single ps of the whole table
+        self.assertEqual(bench(table, 'ps', 'plain', 2)['forks'], 5)
+        self.assertEqual(bench(table, 'ps', 'cumulative', 2)['forks'], 1)
+        self.assertEqual(len(result['latencies']), 2)
+
     def test_argparser(self):
         """test if arguments are parsed correctly
         """
@@ -363,6 +1113,75 @@ class MemmonTests(unittest.TestCase):
         memmon = memmon_from_args(arguments)
         self.assertEqual(memmon.email, None)
 
+        arguments = ['-p', 'foo=50MB', '--ps']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.procfs, None)
+        self.assertEqual(memmon.metric, 'rss')
+
+        arguments = ['-p', 'foo=50MB', '-M', 'pss']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.metric, 'pss')
+
+        arguments = ['-p', 'foo=50MB', '-M', 'rss+swap']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.metric, 'rss+swap')
+        self.assertEqual(memmon.leak, None)
+
+        arguments = ['-a', '1GB', '--leak', '1h', '--leak-window', '5',
+                     '--leak-warn']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.leak, 3600)
+        self.assertEqual(memmon.leak_window, 5)
+        self.assertEqual(memmon.leak_warn, True)
+
+        arguments = ['-a', '1GB,sustain=2/4', '-p', 'a:b=1MB,rearm=1KB']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.any.sustain, 2)
+        self.assertEqual(memmon.programs['a:b'].rearm, 1024)
+        self.assertEqual(memmon.pressure, None)
+
+        arguments = ['--pressure', 'full=10', '--pressure-victim', 'fastest']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.pressure, {'full': 10.0})
+        self.assertEqual(memmon.pressure_victim, 'fastest')
+        self.assertEqual(memmon.interval, None)
+
+        arguments = ['-a', '1GB', '--interval', '0.5']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.interval, 0.5)
+
+        arguments = ['-n', 'myproject', '-p', 'worker_*=1MB', '-g', 're:w.*=1MB']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.memmonName, 'myproject')
+        self.assertEqual(memmon.programs, {'worker_*': 1024 * 1024})
+        self.assertEqual(memmon.groups, {'re:w.*': 1024 * 1024})
+        self.assertEqual(memmon.group_restarts, None)
+        self.assertEqual(memmon.group_spacing, 0)
+
+        arguments = ['-g', 'web=1GB', '--group-restarts', '2',
+                     '--group-spacing', '1m']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.group_restarts, 2)
+        self.assertEqual(memmon.group_spacing, 60)
+        self.assertEqual(memmon.soft_signal, 'USR1')
+        self.assertEqual(memmon.soft_cooldown, 0)
+
+        arguments = ['-a', '1GB,soft=800MB', '--soft-signal', 'SIGUSR2',
+                     '--soft-cooldown', '2m']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.any.soft, 800 * 1024 * 1024)
+        self.assertEqual(memmon.soft_signal, 'USR2')
+        self.assertEqual(memmon.soft_cooldown, 120)
+        self.assertEqual(memmon.export, None)
+        self.assertEqual(memmon.summary, False)
+
+        arguments = ['-a', '1GB', '--export', '/tmp/memmon.prom',
+                     '--export-format', 'openmetrics', '--summary']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.export, '/tmp/memmon.prom')
+        self.assertEqual(memmon.export_format, 'openmetrics')
+        self.assertEqual(memmon.summary, True)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -118,6 +118,245 @@ class TestOomeProcess(unittest.TestCase):
                          self.stderr.getvalue())
     
 
+    def test_scan_environ(self):
+        """
+        Tests scanning an environment stops once all variables were found
+        """
+        from superlance.oome_monitor import scan_environ
+        environ = StringIO('OOME_FILE_DIR=x\x00HOMEDIR=/home/a=b\x00'
+                           'OOME_FILE=/tmp/oome\x00' + 'X=y\x00' * 10000)
+        self.assertEqual(scan_environ(environ, chunk=16),
+                         {'HOMEDIR': '/home/a=b', 'OOME_FILE': '/tmp/oome'})
+        self.assertEqual(environ.tell(), 64)
+        # the last variable isn't NUL terminated
+        self.assertEqual(scan_environ(StringIO('A=1\x00HOMEDIR=h'), chunk=3),
+                         {'HOMEDIR': 'h'})
+        # a variable cut off by the limit is not reported
+        self.assertEqual(scan_environ(StringIO('HOMEDIR=abcdef\x00'),
+                                      limit=10), {})
+
+    @mock.patch('superlance.oome_monitor.os.path.isfile', return_value=True)
+    def test_check_oome_file_listed(self, mock_isfile):
+        """
+        Tests checking oome_file existence against a directory listing
+        """
+        self.assertFalse(self.process.check_oome_file(set(['other'])))
+        self.assertTrue(self.process.check_oome_file(set(['oome_file'])))
+        self.assertEqual(mock_isfile.call_count, 1)
+
+class TestHeapDumpArchiver(unittest.TestCase):
+    """
+    Test class to test capturing heap dumps
+    """
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.archive = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive)
+        self.stderr = StringIO()
+
+    def _write(self, name, data='heap' * 1000):
+        import os
+        path = os.path.join(self.workdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_find_heap_dumps(self):
+        """
+        Tests finding the heap dumps of a process
+        """
+        from superlance.oome_monitor import find_heap_dumps
+        for name in ('java_pid11.hprof', 'java_pid99.hprof', 'custom.hprof',
+                     'java_pid11.0001.hprof', 'oome'):
+            self._write(name)
+        self.assertEqual(
+            [x[len(self.workdir) + 1:] for x in
+             find_heap_dumps(self.workdir, 11)],
+            ['custom.hprof', 'java_pid11.0001.hprof', 'java_pid11.hprof'])
+
+    def test_handle_captures_heap_dump(self):
+        """
+        Functional test for an oome file with a heap dump next to it, which
+        is moved to the archive before the restart and compressed later
+        """
+        import gzip
+        import os
+        oome_file = self._write('oome', '')
+        self._write('java_pid11.hprof')
+        monitor = OomeMonitor(DummyRPCServer(), process_name=['foo'],
+                              oome_file=oome_file,
+                              heap_dump_archive=self.archive)
+        monitor.stderr = monitor.processes['foo'].stderr = self.stderr
+        monitor.handle(monitor.processes['foo'])
+        monitor.restarts.wait()
+        monitor.archiver.wait()
+        self.assertEqual(os.listdir(self.workdir), [])
+        archived = os.listdir(self.archive)
+        self.assertEqual(len(archived), 1)
+        self.assertTrue(archived[0].startswith('foo-'))
+        self.assertTrue(archived[0].endswith('-java_pid11.hprof.gz'))
+        with gzip.open(os.path.join(self.archive, archived[0])) as f:
+            self.assertEqual(f.read(), b'heap' * 1000)
+        lines = self.stderr.getvalue().split('\n')
+        self.assertTrue(lines[0].startswith('heap dump %s was moved to'
+            % os.path.join(self.workdir, 'java_pid11.hprof')))
+        # the compression may finish before or after the restart
+        self.assertTrue('oome file %s was deleted' % oome_file in lines)
+        self.assertTrue(lines.index('foo restarted') >
+                        lines.index('oome file %s was deleted' % oome_file))
+        self.assertEqual(len([x for x in lines if x.endswith('.gz in 0s')]),
+                         1)
+
+    def test_capture_across_file_systems(self):
+        """
+        Tests that a heap dump which can't be renamed into the archive is
+        copied by the background worker
+        """
+        import errno
+        import os
+        from superlance.oome_monitor import HeapDumpArchiver
+        path = self._write('java_pid11.hprof')
+        rename = os.rename
+        def cross_device(source, target):
+            if source == path:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(source, target)
+        archiver = HeapDumpArchiver(self.archive, 'none', self.stderr)
+        with mock.patch('superlance.oome_monitor.os.rename',
+                        side_effect=cross_device):
+            target = archiver.capture('foo:foo', path)
+            archiver.wait()
+        self.assertEqual(os.listdir(self.workdir), [])
+        self.assertEqual(os.listdir(self.archive), [os.path.basename(target)])
+        self.assertTrue(os.path.basename(target).startswith('foo_foo-'))
+
+    @mock.patch('superlance.oome_monitor.ioprio_set')
+    @mock.patch('superlance.oome_monitor.os.nice', create=True)
+    def test_lower_priority_without_setpriority(self, mock_nice,
+                                                mock_ioprio_set):
+        """
+        Tests that without os.setpriority (Python < 3.3) the thread is
+        niced instead, and its I/O priority set through ioprio_set
+        """
+        from superlance.oome_monitor import IOPRIO_LOWEST, lower_priority
+        with mock.patch('superlance.oome_monitor.os.setpriority', None,
+                        create=True):
+            with mock.patch('sys.platform', 'linux2'):
+                self.assertEqual(lower_priority(), [])
+        mock_nice.assert_called_once_with(19)
+        mock_ioprio_set.assert_called_once_with(IOPRIO_LOWEST)
+
+    @mock.patch('superlance.oome_monitor.platform.machine',
+                return_value='vax')
+    def test_lower_priority_unsupported(self, mock_machine):
+        """
+        Tests that the priorities which can't be lowered are reported
+        """
+        import errno
+        from superlance.oome_monitor import lower_priority
+        with mock.patch('superlance.oome_monitor.os.setpriority',
+                        side_effect=OSError(1, 'Operation not permitted'),
+                        create=True):
+            with mock.patch('superlance.oome_monitor.os.PRIO_PROCESS', 0,
+                            create=True):
+                with mock.patch('sys.platform', 'linux'):
+                    problems = lower_priority()
+        self.assertEqual(problems, [
+            'CPU priority: [Errno 1] Operation not permitted',
+            'I/O priority: [Errno %d] ioprio_set is not known on vax'
+            % errno.ENOSYS])
+        with mock.patch('sys.platform', 'darwin'):
+            self.assertEqual(lower_priority(), ['only supported on Linux'])
+
+class TestRestartPool(unittest.TestCase):
+    """
+    Test class to test restarting processes in parallel
+    """
+    def setUp(self):
+        import threading
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0
+        self.restarted = []
+        self.log = []
+
+    def _restart(self, process):
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        self.release.wait(5)
+        with self.lock:
+            self.running -= 1
+            self.restarted.append(process['name'])
+
+    def _process(self, name):
+        return {'name': name, 'group': name, 'pid': 1}
+
+    def test_concurrency_limit(self):
+        """
+        Tests that no more than `size` restarts run at once
+        """
+        from superlance.oome_monitor import RestartPool
+        pool = RestartPool(self._restart, 2, None, self.log.append)
+        for i in range(5):
+            self.assertTrue(pool.submit(self._process('p%d' % i)))
+        self.assertEqual(len(pool.running), 2)
+        self.assertEqual(len(pool.pending), 3)
+        # already queued
+        self.assertFalse(pool.submit(self._process('p4')))
+        self.assertEqual(self.log, ['p4 is being restarted already'])
+        self.release.set()
+        pool.wait()
+        self.assertEqual(sorted(self.restarted), ['p0', 'p1', 'p2', 'p3', 'p4'])
+        self.assertEqual(self.most, 2)
+
+    def test_timeout(self):
+        """
+        Tests that a restart which takes too long is reported, but keeps
+        its slot and its process until it finishes
+        """
+        import time
+        from superlance.oome_monitor import RestartPool
+        pool = RestartPool(self._restart, 1, 0.01, self.log.append)
+        pool.submit(self._process('slow'))
+        pool.submit(self._process('next'))
+        time.sleep(0.05)
+        pool.dispatch()
+        pool.dispatch()
+        self.assertEqual(self.log, ['Restart of slow timed out after 0.01s, '
+                                    'waiting for it to finish'])
+        self.assertEqual(list(pool.running), ['slow'])
+        self.assertEqual(len(pool.pending), 1)
+        self.assertFalse(pool.submit(self._process('slow')))
+        self.release.set()
+        pool.wait()
+        self.assertEqual(self.restarted, ['slow', 'next'])
+        self.assertEqual(self.most, 1)
+        self.assertTrue(self.log[-1].startswith('Restart of slow finished '
+                                                'after'))
+
+    def test_serialized_stream(self):
+        """
+        Tests that writes from other threads go out under the output lock
+        """
+        import threading
+        from superlance.oome_monitor import SerializedStream
+        stream = StringIO()
+        lock = threading.Lock()
+        serialized = SerializedStream(stream, lock)
+        lock.acquire()
+        thread = threading.Thread(target=serialized.write, args=('late\n',))
+        thread.start()
+        stream.write('first\n')
+        lock.release()
+        thread.join(5)
+        self.assertEqual(stream.getvalue(), 'first\nlate\n')
+        self.assertEqual(serialized.getvalue, stream.getvalue)
+
 class TestOomeMonitor(unittest.TestCase):
     """
     Test class to test OomeMonitor methods and properties
@@ -152,12 +391,66 @@ class TestOomeMonitor(unittest.TestCase):
         
     def test_generate_processes(self):
         """
-        Tests OomeMonitor _generate_processes method
+        Tests the registry of processes built by OomeMonitor at startup
         """
         self.assertEqual(len(self.oome_monitor_all.processes),
             len(DummySupervisorRPCNamespace.all_process_info))
         self.assertEqual(len(self.oome_monitor_single.processes), 1)
     
+    def test_reconcile(self):
+        """
+        Tests that a full reconcile drops processes supervisord no longer
+        runs and picks up new ones
+        """
+        monitor = self.oome_monitor_all
+        foo = monitor.processes['foo']
+        info = dict(DummySupervisorRPCNamespace.all_process_info[0],
+                    name='new', group='new', pid=21)
+        monitor.rpc.supervisor.all_process_info = [
+            DummySupervisorRPCNamespace.all_process_info[0], info]
+        self.assertTrue(monitor.reconcile())
+        self.assertEqual(sorted(monitor.processes), ['foo', 'new'])
+        # unchanged processes keep their cached environment
+        self.assertTrue(monitor.processes['foo'] is foo)
+        self.assertFalse(monitor.reconcile())
+
+    def test_on_state_change(self):
+        """
+        Tests updating the registry from PROCESS_STATE events
+        """
+        monitor = self.oome_monitor_single
+        foo = monitor.processes['foo']
+        self.assertFalse(monitor.on_state_change('PROCESS_STATE_RUNNING',
+            'processname:foo groupname:foo from_state:STARTING pid:11'))
+        self.assertTrue(monitor.processes['foo'] is foo)
+        self.assertTrue(monitor.on_state_change('PROCESS_STATE_EXITED',
+            'processname:foo groupname:foo from_state:RUNNING expected:0 '
+            'pid:11'))
+        self.assertEqual(monitor.processes, {})
+        monitor.oome_file = '/tmp/foo.oome'
+        self.assertTrue(monitor.on_state_change('PROCESS_STATE_RUNNING',
+            'processname:foo groupname:foo from_state:STARTING pid:42'))
+        self.assertEqual(monitor.processes['foo'].process['pid'], 42)
+        # the oome file given on the command line survives the restart
+        self.assertEqual(monitor.processes['foo'].oome_file, '/tmp/foo.oome')
+        # other programs are not monitored in single mode
+        self.assertFalse(monitor.on_state_change('PROCESS_STATE_RUNNING',
+            'processname:bar groupname:bar from_state:STARTING pid:43'))
+
+    def test_run_process_state(self):
+        """
+        Functional test for run() with a PROCESS_STATE event, which is
+        acknowledged right away
+        """
+        self.stdin.write('eventname:PROCESS_STATE_RUNNING len:58\n'
+                         'processname:new groupname:new from_state:STARTING '
+                         'pid:21')
+        self.stdin.seek(0)
+        self.oome_monitor_all.run(test=True)
+        self.assertEqual(self.oome_monitor_all.processes['new'].process['pid'],
+                         21)
+        self.assertEqual(self.stdout.getvalue(), 'READY\nRESULT 2\nOK')
+
     def test_write_stderr(self):
         """
         Tests write_stderr
@@ -202,6 +495,44 @@ class TestOomeMonitor(unittest.TestCase):
         self.assertEqual("Failed to stop process foo: <Fault stop: 'error'>\n"
             "Failed to start process foo: <Fault start: 'error'>\n",
             self.stderr.getvalue())
+
+    def test_restart_timed_out(self):
+        """
+        Tests that a restart whose RPC call timed out is given up on, with
+        a new RPC interface for the next one
+        """
+        import socket
+        rpc = mock.MagicMock()
+        rpc.supervisor.stopProcess.side_effect = socket.timeout('timed out')
+        factory = mock.MagicMock(return_value=rpc)
+        self.oome_monitor_all.rpc_factory = factory
+        self.oome_monitor_all.restart(
+            DummySupervisorRPCNamespace.all_process_info[0])
+        self.assertEqual('Gave up restarting process foo: timed out\n',
+                         self.stderr.getvalue())
+        self.assertFalse(rpc.supervisor.startProcess.called)
+        self.oome_monitor_all.worker_rpc()
+        self.assertEqual(factory.call_count, 2)
+
+    def test_timeout_rpc_interface(self):
+        """
+        Tests that RPC calls time out when supervisord doesn't answer
+        """
+        import os
+        import shutil
+        import socket
+        import tempfile
+        from superlance.oome_monitor import timeout_rpc_interface
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        path = os.path.join(workdir, 'supervisor.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        server.listen(1)
+        rpc = timeout_rpc_interface({'SUPERVISOR_SERVER_URL': 'unix://' + path},
+                                    0.05)
+        self.assertRaises(socket.timeout, rpc.supervisor.getState)
     
     @mock.patch('superlance.oome_monitor.os.readlink')
     def test_run(self, mock_readlink):
@@ -213,9 +544,9 @@ class TestOomeMonitor(unittest.TestCase):
         self.stdin.write('eventname:TICK len:0\n')
         self.stdin.seek(0)
         # returning that the process has an oome file
-        self.oome_monitor_all.processes[1].check_oome_file = mock.MagicMock()
+        self.oome_monitor_all.processes['bar'].check_oome_file = mock.MagicMock()
         # mocking the actual file delete
-        self.oome_monitor_all.processes[1].delete_oome_file = mock.MagicMock()
+        self.oome_monitor_all.processes['bar'].delete_oome_file = mock.MagicMock()
         with mock.patch('superlance.oome_monitor.open',
                         mock.mock_open(read_data='test'), create=True) as m:
             self.oome_monitor_all.run(test=True)
@@ -231,10 +562,10 @@ class TestOomeMonitor(unittest.TestCase):
         self.stdin.write('eventname:TICK len:0\n')
         self.stdin.seek(0)
         # returning that the process has an oome file
-        self.oome_monitor_single.processes[0].check_oome_file = \
+        self.oome_monitor_single.processes['foo'].check_oome_file = \
             mock.MagicMock()
         # mocking the actual file delete
-        self.oome_monitor_single.processes[0].delete_oome_file = \
+        self.oome_monitor_single.processes['foo'].delete_oome_file = \
             mock.MagicMock()
         with mock.patch('superlance.oome_monitor.open',
                         mock.mock_open(read_data='test'), create=True) as m:
@@ -252,14 +583,199 @@ class TestOomeMonitor(unittest.TestCase):
         self.stdin.seek(0)
         self.oome_monitor_all.dry = True
         # returning that the process has an oome file
-        self.oome_monitor_all.processes[1].check_oome_file = mock.MagicMock()
+        self.oome_monitor_all.processes['bar'].check_oome_file = mock.MagicMock()
         # mocking the actual file delete
-        self.oome_monitor_all.processes[1].delete_oome_file = mock.MagicMock()
+        self.oome_monitor_all.processes['bar'].delete_oome_file = mock.MagicMock()
         with mock.patch('superlance.oome_monitor.open',
                         mock.mock_open(read_data='test'), create=True) as m:
             self.oome_monitor_all.run(test=True)
         self.assertEqual("oome file is detected for bar, not restarting due to"
                          " dry-run\n", self.stderr.getvalue())
         
+    def test_wait_inotify(self):
+        """
+        Functional test for an oome file detected by inotify while waiting
+        for the next event from supervisord
+        """
+        import os
+        import shutil
+        import tempfile
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        oome_file = os.path.join(workdir, 'oome')
+        monitor = OomeMonitor(DummyRPCServer(), process_name=['foo'],
+                              oome_file=oome_file)
+        r, w = os.pipe()
+        monitor.stdin = os.fdopen(r)
+        self.addCleanup(monitor.stdin.close)
+        monitor.stdout = StringIO()
+        monitor.stderr = monitor.processes['foo'].stderr = StringIO()
+        monitor.start_watcher()
+        if monitor.watcher is None:
+            self.skipTest('inotify is not available')
+        self.addCleanup(monitor.watcher.close)
+        monitor.watch()
+        self.assertEqual(list(monitor.watches), [workdir])
+        open(oome_file, 'w').close()
+        os.write(w, b'eventname:TICK len:0\n')
+        os.close(w)
+        headers, payload = monitor.wait()
+        monitor.restarts.wait()
+        self.assertEqual(headers['eventname'], 'TICK')
+        self.assertEqual(monitor.stdout.getvalue(), 'READY\n')
+        self.assertEqual('oome file %s was deleted\nfoo restarted\n'
+                         % oome_file, monitor.stderr.getvalue())
+        self.assertFalse(os.path.exists(oome_file))
+
+    def test_poll_shared_directory(self):
+        """
+        Tests that oome files sharing a directory are found with a single
+        listing of it
+        """
+        import os
+        import shutil
+        import tempfile
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        monitor = self.oome_monitor_all
+        for name, oome_process in monitor.processes.items():
+            oome_process.oome_file = os.path.join(workdir, name + '.oome')
+        open(os.path.join(workdir, 'bar.oome'), 'w').close()
+        monitor.processes['bar'].stderr = StringIO()
+        with mock.patch('superlance.oome_monitor.os.listdir',
+                        wraps=os.listdir) as listdir:
+            monitor.poll()
+        monitor.restarts.wait()
+        self.assertEqual(listdir.call_count, 1)
+        self.assertEqual('bar restarted\n', self.stderr.getvalue())
+        self.assertEqual(os.listdir(workdir), [])
+
+    def _makeRuleMonitor(self, *rules):
+        import os
+        import shutil
+        import tempfile
+        from superlance.oome_monitor import parse_rule
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        monitor = OomeMonitor(DummyRPCServer(), all=True, rules=[
+            parse_rule(os.path.join(workdir, x)) for x in rules])
+        monitor.stderr = StringIO()
+        for name, oome_process in monitor.processes.items():
+            oome_process.oome_file = os.path.join(workdir, name + '.oome')
+        return monitor, workdir
+
+    def test_poll_rules(self):
+        """
+        Tests acting on the sentinel files of rules, found by a single
+        listing of their directory
+        """
+        import os
+        monitor, workdir = self._makeRuleMonitor(
+            '%(name)s-restart-me=restart',
+            '%(name)s.*.deadlock=signal:SIGQUIT',
+            '%(group)s-pressure=notify')
+        for name in ('foo-restart-me', 'bar.1.deadlock', 'baz-pressure'):
+            open(os.path.join(workdir, name), 'w').close()
+        with mock.patch('superlance.oome_monitor.os.listdir',
+                        wraps=os.listdir) as listdir:
+            monitor.poll()
+        monitor.restarts.wait()
+        self.assertEqual(listdir.call_count, 1)
+        self.assertEqual(os.listdir(workdir), [])
+        self.assertEqual(monitor.rpc.supervisor.signalled, [('bar', 'QUIT')])
+        lines = sorted(monitor.stderr.getvalue().splitlines())
+        self.assertEqual(lines, [
+            '%s/bar.1.deadlock is detected for bar, sent it SIGQUIT' % workdir,
+            '%s/baz-pressure is detected for baz:baz_01' % workdir,
+            '%s/foo-restart-me is detected for foo, restarting it' % workdir,
+            'foo restarted'])
+
+    def test_on_events_rules(self):
+        """
+        Tests acting on a sentinel file reported by inotify, and leaving it
+        alone in dry-run mode
+        """
+        import os
+        from superlance import inotify
+        monitor, workdir = self._makeRuleMonitor('%(name)s-*=notify')
+        monitor.watched = {1: workdir}
+        monitor.watches = {workdir: 1}
+        path = os.path.join(workdir, 'foo-now')
+        open(path, 'w').close()
+        monitor.dry = True
+        monitor.on_events([inotify.Event(1, inotify.IN_CREATE, 0, 'foo-now')])
+        self.assertTrue(os.path.exists(path))
+        monitor.dry = False
+        monitor.on_events([inotify.Event(1, inotify.IN_CREATE, 0, 'foo-now'),
+                           inotify.Event(1, inotify.IN_CREATE, 0, 'foo-now')])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(monitor.stderr.getvalue(),
+            '%s is detected for foo, not acting on it due to dry-run\n'
+            '%s is detected for foo\n' % (path, path))
+        self.assertEqual(monitor.mailed, False)
+
+    def test_notify_mails(self):
+        """
+        Tests that the sentinel files of notify rules are mailed about
+        """
+        import os
+        monitor, workdir = self._makeRuleMonitor('%(name)s-pressure=notify')
+        monitor.email = 'chrism@plope.com'
+        monitor.sendmail = 'cat - > /dev/null'
+        path = os.path.join(workdir, 'foo-pressure')
+        open(path, 'w').close()
+        monitor.poll()
+        mailed = monitor.mailed.split('\n')
+        self.assertEqual(mailed[0], 'To: chrism@plope.com')
+        self.assertEqual(mailed[1], 'Subject: oome_monitor: foo-pressure is '
+                                    'detected for foo')
+        self.assertTrue(mailed[3].startswith(
+            '%s was detected for the process named foo at ' % path))
+        self.assertTrue(mailed[3].endswith(
+            ', matching the rule %s=notify' % os.path.join(
+                workdir, '%(name)s-pressure')))
+
+    def test_rule_env_substitution(self):
+        """
+        Tests that rules referring to a missing environment variable are
+        left out for that process only
+        """
+        from superlance.oome_monitor import parse_rule
+        rule = parse_rule('%(ENV_APP_HOME)s/restart-me=restart')
+        monitor = OomeMonitor(DummyRPCServer(), all=True, rules=[rule])
+        foo, bar = monitor.processes['foo'], monitor.processes['bar']
+        self.assertEqual(foo.env_names, ('OOME_FILE', 'HOMEDIR', 'APP_HOME'))
+        foo._env_vars = {'OOME_FILE': '/tmp/foo.oome', 'APP_HOME': '/app'}
+        bar._env_vars = {'OOME_FILE': '/tmp/bar.oome'}
+        self.assertEqual([x.path for x in foo.triggers],
+                         ['/tmp/foo.oome', '/app/restart-me'])
+        self.assertEqual([x.path for x in bar.triggers], ['/tmp/bar.oome'])
+
+    def test_parse_rule(self):
+        """
+        Tests parsing --rule options
+        """
+        import argparse
+        from superlance.oome_monitor import parse_rule
+        rule = parse_rule('%(cwd)s/work/*.deadlock=signal:sigquit')
+        self.assertEqual(str(rule), '%(cwd)s/work/*.deadlock=signal:QUIT')
+        self.assertEqual(parse_rule('/a=b/c=notify').pattern, '/a=b/c')
+        for value in ('/tmp/x', '/tmp/x=boom', '/tmp/x=signal',
+                      '/tmp/x=notify:1', '/tmp/%(foo)s=notify',
+                      '/tmp/%(pid)d=notify', '/tmp/*/x=restart'):
+            self.assertRaises(argparse.ArgumentTypeError, parse_rule, value)
+
+    def test_on_events_ignored(self):
+        """
+        Tests that a watch dropped by the kernel is forgotten, so the next
+        tick adds it again
+        """
+        from superlance import inotify
+        monitor = self.oome_monitor_single
+        monitor.watches = {'/tmp': 1}
+        monitor.watched = {1: '/tmp'}
+        monitor.on_events([inotify.Event(1, inotify.IN_IGNORED, 0, '')])
+        self.assertEqual((monitor.watches, monitor.watched), ({}, {}))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import sys
+import unittest
+from superlance.compat import StringIO
+from superlance.compat import xmlrpclib
+from superlance.tests.dummy import DummyRPCServer
+
+def usage():
+    sys.exit(255)
+
+class RuleParserTests(unittest.TestCase):
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_parse_namelimit(self):
+        from superlance.rules import parse_count
+        from superlance.rules import parse_namelimit
+        parse_limit = lambda option, value: parse_count(option, value, usage)
+        self.assertEqual(parse_namelimit('-p', 'foo_*=10', usage, parse_limit),
+                         ('foo_*', 10))
+        self.assertEqual(parse_namelimit('-p', 're:foo_[0-9]+=5', usage,
+                                         parse_limit), ('re:foo_[0-9]+', 5))
+        for value in ('foo', 're:(=10', 'foo=x'):
+            self.assertRaises(SystemExit, parse_namelimit, '-p', value, usage,
+                              parse_limit)
+
+    def test_parse_sustain(self):
+        from superlance.rules import parse_sustain
+        self.assertEqual(parse_sustain('-a', '1,sustain=3/5', usage, '3/5'),
+                         (3, 5))
+        for rule in ('5/3', '0/1', '1/65', 'x'):
+            self.assertRaises(SystemExit, parse_sustain, '-a', rule, usage,
+                              rule)
+        self.assertTrue('N and M must satisfy' in sys.stdout.getvalue())
+
+    def test_parse_percentage(self):
+        from superlance.rules import Percentage
+        from superlance.rules import parse_percentage
+        size = parse_percentage('-a', '12.5%', usage)
+        self.assertTrue(isinstance(size, Percentage))
+        self.assertEqual(size.of(1000), 125)
+        for value in ('0%', '101%', 'x%', '50'):
+            self.assertRaises(SystemExit, parse_percentage, '-a', value,
+                              usage)
+
+    def test_parse_count_and_seconds(self):
+        from superlance.rules import parse_count
+        from superlance.rules import parse_seconds
+        self.assertEqual(parse_count('--window', '2', usage, minimum=2), 2)
+        self.assertRaises(SystemExit, parse_count, '--window', '1', usage,
+                          minimum=2)
+        self.assertEqual(parse_seconds('-u', '1h', usage), 3600)
+        self.assertRaises(SystemExit, parse_seconds, '-u', '1x', usage)
+
+class RuleListenerTests(unittest.TestCase):
+    def _makeOne(self, name='test'):
+        from superlance.rules import RuleListener
+        class Listener(RuleListener):
+            listener = 'testmon'
+            because = 'it was tested'
+        listener = Listener()
+        listener.testmonName = name
+        listener.rpc = DummyRPCServer()
+        listener.sendmail = 'cat - > /dev/null'
+        listener.email = 'chrism@plope.com'
+        listener.email_uptime_limit = 2000
+        listener.breaches = {'foo:foo': object(), 'bar:bar': object()}
+        listener.stderr = StringIO()
+        listener.mailed = False
+        return listener
+
+    def test_restart(self):
+        listener = self._makeOne()
+        info = listener.rpc.supervisor.getProcessInfo('foo')
+        listener.restart('foo:foo', '3 widgets', info)
+        self.assertEqual(listener.stderr.getvalue(), 'Restarting foo:foo\n')
+        self.assertEqual(list(listener.breaches), ['bar:bar'])
+        mailed = listener.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: testmon [test]: process foo:foo restarted')
+        self.assertTrue(mailed[3].startswith('testmon.py restarted the '
+                                             'process named foo:foo at'))
+        self.assertTrue(mailed[3].endswith('because it was tested '
+                                           '(3 widgets)'))
+
+    def test_restart_uptime_over_limit(self):
+        listener = self._makeOne(name=None)
+        listener.email_uptime_limit = 0
+        info = listener.rpc.supervisor.getProcessInfo('foo')
+        listener.restart('foo:foo', '3 widgets', info)
+        self.assertEqual(listener.mailed, False)
+        self.assertEqual(listener.label(), 'testmon')
+
+    def test_restart_failure(self):
+        listener = self._makeOne()
+        info = listener.rpc.supervisor.getProcessInfo('foo')
+        self.assertRaises(xmlrpclib.Fault, listener.restart,
+                          'BAD_NAME:BAD_NAME', '3 widgets', info)
+        self.assertTrue(listener.stderr.getvalue().startswith(
+            'Restarting BAD_NAME:BAD_NAME\nFailed to stop process '
+            'BAD_NAME:BAD_NAME (3 widgets), exiting:'))
+        self.assertEqual(listener.mailed.split('\n')[1],
+                         'Subject: testmon [test]: failed to stop process '
+                         'BAD_NAME:BAD_NAME, exiting')
+
+    def test_breached(self):
+        from superlance.rules import Limit
+        listener = self._makeOne()
+        self.assertTrue(listener.breached('foo:foo', 1, 11, 10))
+        self.assertFalse(listener.breached('foo:foo', 1, 10, 10))
+        limit = Limit(10, sustain=2, window=3, rearm=5)
+        self.assertFalse(listener.breached('baz:baz', 1, 11, limit))
+        # still over until it drops to the rearm size
+        self.assertTrue(listener.breached('baz:baz', 1, 6, limit))
+        self.assertEqual(listener.stderr.getvalue(), 'baz:baz was over its '
+                         'limits in 1 of the last 3 samples\n')
+        # a new pid starts over
+        self.assertFalse(listener.breached('baz:baz', 2, 11, limit))
+
+    def test_breached_over(self):
+        from superlance.rules import Limit
+        listener = self._makeOne()
+        limit = Limit(0, sustain=2, window=2)
+        self.assertFalse(listener.breached('baz:baz', 1, None, limit,
+                                           over=True))
+        self.assertTrue(listener.breached('baz:baz', 1, None, limit,
+                                          over=True))
+        self.assertFalse(listener.breached('foo:foo', 1, None, Limit(0),
+                                           over=False))
+
+    def test_tick_is_abstract(self):
+        listener = self._makeOne()
+        self.assertRaises(NotImplementedError, listener.tick)
+
+    def test_forget(self):
+        listener = self._makeOne()
+        listener.forget(set(['bar:bar']))
+        self.assertEqual(list(listener.breaches), ['bar:bar'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -76,6 +76,36 @@ class TestExternalService(unittest.TestCase):
         self.assertEqual('process was unable to stop. Cmd used to stop: cmd',
                          self.stderr.getvalue())
 
+    @mock.patch('subprocess.Popen')
+    def test_stop_process_timeout(self, mock_popen):
+        """
+        Tests that a script running into the timeout is killed
+        """
+        import threading
+        killed = threading.Event()
+        script = mock_popen.return_value
+        script.poll.return_value = None
+        script.kill.side_effect = killed.set
+        script.wait.side_effect = lambda: killed.wait(5) and -9
+        self.ext_service.timeout = 0.01
+        self.ext_service.stopProcess('process')
+        self.assertTrue(script.kill.called)
+        self.assertEqual('process did not stop within 0.01s, killed the '
+                         'script\n', self.stderr.getvalue())
+
+    @mock.patch('subprocess.Popen')
+    def test_start_process_within_timeout(self, mock_popen):
+        """
+        Tests that a script finishing within the timeout is left alone
+        """
+        script = mock_popen.return_value
+        script.wait.return_value = 1
+        self.ext_service.timeout = 60
+        self.ext_service.startProcess('process')
+        self.assertFalse(script.kill.called)
+        self.assertTrue(self.stderr.getvalue().startswith(
+            'process was unable to start.'))
+
 
 class TestLog(unittest.TestCase):
     """
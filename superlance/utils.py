@@ -7,6 +7,7 @@ import logging
 import os.path
 import subprocess
 import sys
+import threading
 
 from supervisor.rpcinterface import SupervisorNamespaceRPCInterface
 
@@ -19,12 +20,15 @@ class ExternalService(object):
     functions of this class instead of ones in RPC interface to supervisord.
 
     External service script needs to accept "start" and "stop" arguments and
-    obviously perform the same.
+    obviously perform the same.  With a timeout, a script which runs for
+    longer is killed.
     """
-    def __init__(self, external_service):
+    def __init__(self, external_service, timeout=None):
         """ Initialise and setup an external service script
 
         @param string external_service External service script path
+        @param int timeout Seconds after which the script is killed, None to
+            let it run for as long as it takes
         """
         if os.path.isfile(external_service):
             self.service = external_service
@@ -32,8 +36,40 @@ class ExternalService(object):
             raise OSError(2,
                 'service script does not exist or permission was denied',
                 external_service)
+        self.timeout = timeout
         self.stderr = sys.stderr
 
+    def call(self, action):
+        """ Run the service script, killing it once it runs into the timeout
+
+        @param string action  "start" or "stop"
+        @return boolean result     False if the script was killed
+        """
+        cmd = [self.service, action]
+        if self.timeout is None:
+            subprocess.check_call(cmd, stdout=self.stderr)
+            return True
+        script = subprocess.Popen(cmd, stdout=self.stderr)
+        killed = []
+        def kill():
+            if script.poll() is None:
+                killed.append(True)
+                try:
+                    script.kill()
+                except OSError:
+                    # it exited in the meantime
+                    pass
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        try:
+            returncode = script.wait()
+        finally:
+            timer.cancel()
+        if killed:
+            return False
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return True
 
     def startProcess(self, name, wait=True):
         """ Start a process
@@ -44,8 +80,11 @@ class ExternalService(object):
 
         """
         try:
-            subprocess.check_call([self.service, 'start'], stdout=self.stderr)
-            self.stderr.write('{0} started successfully\n'.format(name))
+            if self.call('start'):
+                self.stderr.write('{0} started successfully\n'.format(name))
+            else:
+                self.stderr.write('{0} did not start within {1}s, killed the '
+                                  'script\n'.format(name, self.timeout))
         except subprocess.CalledProcessError as e:
             self.stderr.write('{0} was unable to start. Cmd used to start: {1}'
                 .format(name, e.cmd))
@@ -60,8 +99,11 @@ class ExternalService(object):
         @return boolean result     Always return True unless error
         """
         try:
-            subprocess.check_call([self.service, 'stop'], stdout=self.stderr)
-            self.stderr.write('{0} stopped successfully\n'.format(name))
+            if self.call('stop'):
+                self.stderr.write('{0} stopped successfully\n'.format(name))
+            else:
+                self.stderr.write('{0} did not stop within {1}s, killed the '
+                                  'script\n'.format(name, self.timeout))
         except subprocess.CalledProcessError as e:
             self.stderr.write('{0} was unable to stop. Cmd used to stop: {1}'
                 .format(name, e.cmd))